@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.utils.translation import ugettext_lazy
 from modoboa.lib import parameters, events
 
@@ -52,6 +53,8 @@ def load_core_settings():
     parameters.register(GeneralParametersForm, ugettext_lazy("General"))
     parameters.register(UserSettings, ugettext_lazy("General"))
     events.declare(base_events)
+    if getattr(settings, "MODOBOA_EVENTS_PROFILING", False):
+        events.enable_profiling()
 
 
 @events.observe("ExtDisabled")
@@ -1,5 +1,6 @@
 from django.conf import settings
 from django.conf.urls import include
+from modoboa.lib.cacheutils import SharedVersion
 
 
 class ModoExtension(object):
@@ -39,6 +40,8 @@ class ExtensionsPool(object):
 
     def __init__(self):
         self.extensions = {}
+        self._states = None
+        self.states_version = SharedVersion("modoboa.extensions.states")
 
     def register_extension(self, ext, show=True):
         self.extensions[ext.name] = dict(cls=ext, show=show)
@@ -50,12 +53,54 @@ class ExtensionsPool(object):
             self.extensions[name]["instance"] = self.extensions[name]["cls"]()
         return self.extensions[name]["instance"]
 
-    def is_extension_enabled(self, name):
-        from modoboa.core.models import Extension
+    def get_extension_state(self, name):
+        """Tell if an extension is enabled or not.
+
+        States are loaded from the database on first access and kept
+        in memory until :meth:`invalidate_states` is called by any
+        process (see ``states_version``).
+
+        :param str name: the extension's name
+        :return: a boolean or None if the extension is not recorded
+        """
+        cached = self._states
+        if cached is None or not self.states_version.is_valid(cached[0]):
+            from modoboa.core.models import Extension
+
+            stamp = self.states_version.stamp()
+            cached = (
+                stamp, dict(Extension.objects.values_list("name", "enabled"))
+            )
+            self._states = cached
+        return cached[1].get(name)
+
+    def invalidate_states(self):
+        """Forget extension states.
+
+        They will be reloaded from the database on next access (by
+        every process).
+        """
+        self._states = None
+        self.states_version.bump()
+
+    def is_extension_active(self, name):
+        """Tell if callbacks and views of an extension can be used.
 
+        An extension is active if it is enabled or if it is always
+        active and not recorded yet.
+
+        :param str name: the extension's name
+        :rtype: bool
+        """
+        state = self.get_extension_state(name)
+        if state is None:
+            return self.get_extension(name).always_active
+        return state
+
+    def is_extension_enabled(self, name):
         if not name in self.extensions:
             return False
-        return Extension.objects.get(name=name).enabled
+        return self.get_extension_state(name) is True
 
     def get_extension_infos(self, name):
         instance = self.get_extension(name)
@@ -74,8 +119,6 @@ class ExtensionsPool(object):
 
         :return: a list of url maps
         """
-        from modoboa.core.models import Extension
-
         result = []
         for ext in settings.MODOBOA_APPS:
             __import__(ext)
@@ -91,13 +134,9 @@ class ExtensionsPool(object):
             except ImportError:
                 # No urls for this extension
                 pass
-            if not extinstance.always_active:
-                try:
-                    ext = Extension.objects.get(name=extname)
-                    if not ext.enabled:
-                        continue
-                except Extension.DoesNotExist:
-                    continue
+            if not extinstance.always_active \
+                    and not self.get_extension_state(extname):
+                continue
             extinstance.load()
         return result
 
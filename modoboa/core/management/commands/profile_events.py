@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# coding: utf-8
+import json
+from optparse import make_option
+from django.conf import settings
+from django.contrib.auth import login
+from django.core.management.base import BaseCommand, CommandError
+from django.http import HttpRequest
+from django.test.client import Client
+from django.test.utils import override_settings
+from django.utils.importlib import import_module
+from modoboa.core.models import User
+from modoboa.lib import events
+
+
+class Command(BaseCommand):
+    args = '<url url ...>'
+    help = 'Profile the events raised while the given urls are requested'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--username', default='admin',
+                    help='The account used to send requests'),
+        make_option('--repeat', type='int', default=1,
+                    help='The number of times each url is requested'),
+        make_option('--json', action='store_true', default=False,
+                    help='Output statistics using JSON'),
+    )
+
+    def _get_client(self, username):
+        """Return a test client authenticated as the given user.
+
+        The session is directly created (no password is needed).
+        """
+        try:
+            user = User.objects.get(username=username)
+        except User.DoesNotExist:
+            raise CommandError("User %s does not exist" % username)
+        user.backend = settings.AUTHENTICATION_BACKENDS[0]
+        engine = import_module(settings.SESSION_ENGINE)
+        request = HttpRequest()
+        request.session = engine.SessionStore()
+        login(request, user)
+        request.session.save()
+        client = Client()
+        client.cookies[settings.SESSION_COOKIE_NAME] = \
+            request.session.session_key
+        return client
+
+    def _print_report(self, data):
+        for event, stats in sorted(data.items(),
+                                   key=lambda e: e[1]["time"], reverse=True):
+            print "%-60s %6d calls %10.2f ms %6d queries" % (
+                event, stats["calls"], stats["time"] * 1000, stats["queries"]
+            )
+            for name, cbstats in sorted(stats["callbacks"].items(),
+                                        key=lambda c: c[1]["time"],
+                                        reverse=True):
+                print "  %-58s %6d calls %10.2f ms %6d queries" % (
+                    name, cbstats["calls"], cbstats["time"] * 1000,
+                    cbstats["queries"]
+                )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError("You must provide at least one url")
+        client = self._get_client(options["username"])
+        events.enable_profiling()
+        events.reset_profiling()
+        with override_settings(ALLOWED_HOSTS=["*"]):
+            for url in args:
+                for cpt in range(options["repeat"]):
+                    response = client.get(
+                        url, HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+                    )
+                    if response.status_code != 200:
+                        self.stderr.write(
+                            "%s: unexpected status code %d\n"
+                            % (url, response.status_code)
+                        )
+        client.logout()
+        data = events.get_profiling_data()
+        if options["json"]:
+            print json.dumps(data, indent=2)
+        else:
+            self._print_report(data)
@@ -3,8 +3,8 @@ import os
 import re
 import logging
 import reversion
-from django.db import models
-from django.db.models.signals import post_delete
+from django.db import models, connection
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.conf import settings
 from django.dispatch import receiver
 from django.utils import timezone
@@ -30,6 +30,38 @@ except ImportError:
     ldap_available = False
 
 
+class AccountManager(UserManager):
+
+    def role_sql(self):
+        """Return the SQL expression computing the role of an account.
+
+        Same result as ``User.group``.
+        """
+        qn = connection.ops.quote_name
+        field = self.model._meta.get_field("groups")
+        return (
+            "CASE WHEN {user}.{is_superuser} THEN 'SuperAdmins' ELSE "
+            "COALESCE((SELECT MIN(g.{name}) FROM {group} g "
+            "INNER JOIN {rel} r ON r.{group_id} = g.{id} "
+            "WHERE r.{user_id} = {user}.{id}), '---') END"
+        ).format(
+            user=qn(self.model._meta.db_table),
+            is_superuser=qn("is_superuser"), name=qn("name"),
+            group=qn(field.rel.to._meta.db_table), id=qn("id"),
+            rel=qn(field.m2m_db_table()),
+            group_id=qn(field.m2m_reverse_name()),
+            user_id=qn(field.m2m_column_name())
+        )
+
+    def with_role(self):
+        """Return accounts annotated with their role.
+
+        ``User.group`` uses the annotation instead of querying
+        groups.
+        """
+        return self.get_query_set().extra(select={"role": self.role_sql()})
+
+
 class User(PermissionsMixin):
     """Custom User model.
 
@@ -52,7 +84,15 @@ class User(PermissionsMixin):
         ugettext_lazy('last login'), default=timezone.now
     )
 
-    objects = UserManager()
+    objects = AccountManager()
+
+    #: Incremented each time group memberships change (used to
+    #: invalidate the roles cached by ``group``)
+    roles_generation = 0
+
+    #: Maximum number of identifiers inlined by
+    #: ``get_administered_filter``
+    MAX_INLINE_IDS = 500
 
     USERNAME_FIELD = 'username'
     REQUIRED_FIELDS = ['email']
@@ -74,7 +114,7 @@ class User(PermissionsMixin):
         * Otherwise, the check is made on the user
         """
         from modoboa.lib.permissions import \
-            get_object_owner, grant_access_to_object, ungrant_access_to_object
+            get_object_owner, grant_access_to_objects, ungrant_access_to_object
 
         if fromuser == self:
             raise PermDeniedException(
@@ -85,13 +125,21 @@ class User(PermissionsMixin):
             raise PermDeniedException
 
         owner = get_object_owner(self)
-        for ooentry in self.objectaccess_set.filter(is_owner=True):
-            if ooentry.content_object is not None:
-                grant_access_to_object(owner, ooentry.content_object, True)
+        owned = self.objectaccess_set.filter(is_owner=True)
+        for ct_id in set(owned.values_list("content_type", flat=True)):
+            ct = ContentType.objects.get_for_id(ct_id)
+            model = ct.model_class()
+            if model is None:
+                continue
+            objects = model.objects.filter(
+                pk__in=owned.filter(content_type=ct).values("object_id")
+            )
+            grant_access_to_objects(owner, objects, ct, is_owner=True)
 
         events.raiseEvent("AccountDeleted", self, fromuser, **kwargs)
         ungrant_access_to_object(self)
         super(User, self).delete()
+        ObjectAccess.entries_changed()
 
     def _crypt_password(self, raw_value):
         scheme = parameters.get_admin("PASSWORD_SCHEME")
@@ -187,14 +235,37 @@ class User(PermissionsMixin):
             return "%s %s" % (self.first_name, self.last_name)
         return "----"
 
+    @classmethod
+    def roles_changed(cls):
+        """Invalidate the roles cached by all instances.
+
+        Must be called after bulk operations on group memberships (no
+        signal is sent).
+        """
+        cls.roles_generation += 1
+
     @property
     def group(self):
+        """The role of this account.
+
+        It is resolved once per instance (unless memberships change)
+        using, in this order, the annotation added by
+        ``User.objects.with_role()``, groups loaded by
+        ``prefetch_related("groups")`` or a query.
+        """
         if self.is_superuser:
             return "SuperAdmins"
-        try:
-            return self.groups.all()[0].name
-        except IndexError:
-            return "---"
+        cache = self.__dict__.get("_group_cache")
+        if cache is not None and cache[0] == User.roles_generation:
+            return cache[1]
+        role = self.__dict__.pop("role", None)
+        if role is None:
+            try:
+                role = self.groups.all()[0].name
+            except IndexError:
+                role = "---"
+        self._group_cache = (User.roles_generation, role)
+        return role
 
     @property
     def enabled(self):
@@ -221,6 +292,86 @@ class User(PermissionsMixin):
             return False
         return True
 
+    def _get_access_index(self, ct, kind="access"):
+        """Return the identifiers of the objects of a given type this
+        user can access.
+
+        Identifiers are loaded (using one query) the first time a type
+        is checked and kept with this instance (ie. during the current
+        request) until access entries are modified.
+
+        :param ct: a ``ContentType`` object
+        :param str kind: "access" (all reachable objects), "direct"
+                         (objects with an access entry for this user)
+                         or "owned"
+        :return: a set of identifiers
+        """
+        cache = getattr(self, "_access_index", None)
+        if cache is None or cache["generation"] != ObjectAccess.generation:
+            cache = self._access_index = {
+                "generation": ObjectAccess.generation, "access": {},
+                "direct": {}, "owned": {}
+            }
+        index = cache[kind]
+        if not ct.id in index:
+            entries = ObjectAccess.objects.filter(content_type=ct)
+            if kind == "owned":
+                entries = entries.filter(user=self, is_owner=True)
+            elif kind == "direct" or ct.model == "user":
+                entries = entries.filter(user=self)
+            else:
+                # Objects owned by the users this user can access are
+                # also reachable
+                users = self.objectaccess_set.filter(
+                    content_type=ContentType.objects.get_for_model(User)
+                ).values("object_id")
+                entries = entries.filter(
+                    models.Q(user=self) |
+                    models.Q(user__in=users, is_owner=True)
+                )
+            index[ct.id] = set(entries.values_list("object_id", flat=True))
+        return index[ct.id]
+
+    def get_administered_ids(self, model):
+        """Return the identifiers of the objects of a given type this
+        user has been given access to.
+
+        This is the membership index used to restrict listings to the
+        domains (or other objects) an administrator manages. It is
+        loaded using one query (on the ``(user, content_type)`` prefix
+        of the access entries unique index, so its cost only depends
+        on the number of objects of this user) and kept until access
+        entries are modified (see ``ObjectAccess.entries_changed``).
+
+        :param model: a model class
+        :return: a set of identifiers
+        """
+        return self._get_access_index(
+            ContentType.objects.get_for_model(model), "direct"
+        )
+
+    def get_administered_filter(self, model, lookup="pk"):
+        """Return a condition selecting the objects of a given type
+        this user has been given access to.
+
+        Identifiers come from the membership index (see
+        ``get_administered_ids``). Databases limit the number of
+        parameters of a statement so, above ``MAX_INLINE_IDS``
+        objects, a subquery is used instead.
+
+        :param model: a model class
+        :param str lookup: the field holding identifiers
+        :return: a ``Q`` object
+        """
+        ids = self.get_administered_ids(model)
+        if len(ids) > self.MAX_INLINE_IDS:
+            ids = self.objectaccess_set.filter(
+                content_type=ContentType.objects.get_for_model(model)
+            ).values("object_id")
+        else:
+            ids = sorted(ids)
+        return models.Q(**{"%s__in" % lookup: ids})
+
     def is_owner(self, obj):
         """Tell is the user is the unique owner of this object
 
@@ -228,19 +379,14 @@ class User(PermissionsMixin):
         :return: a boolean
         """
         ct = ContentType.objects.get_for_model(obj)
-        try:
-            ooentry = self.objectaccess_set.get(content_type=ct, object_id=obj.id)
-        except ObjectAccess.DoesNotExist:
-            return False
-        return ooentry.is_owner
+        return obj.id in self._get_access_index(ct, "owned")
 
     def can_access(self, obj):
         """Check if the user can access a specific object
 
-        This function is recursive: if the given user hasn't got
-        direct access to this object and if he has got access to other
-        ``User`` objects, we check if one of those users owns the
-        object.
+        The user can access an object if he has got direct access to
+        it or if he has got access to another ``User`` object owning
+        it.
 
         :param obj: a admin object
         :return: a boolean
@@ -249,21 +395,7 @@ class User(PermissionsMixin):
             return True
 
         ct = ContentType.objects.get_for_model(obj)
-        try:
-            ooentry = self.objectaccess_set.get(content_type=ct, object_id=obj.id)
-        except ObjectAccess.DoesNotExist:
-            pass
-        else:
-            return True
-        if ct.model == "user":
-            return False
-
-        ct = ContentType.objects.get_for_model(self)
-        qs = self.objectaccess_set.filter(content_type=ct)
-        for ooentry in qs.all():
-            if ooentry.content_object.is_owner(obj):
-                return True
-        return False
+        return obj.id in self._get_access_index(ct)
 
     def set_role(self, role):
         """Set administrative role for this account
@@ -279,6 +411,7 @@ class User(PermissionsMixin):
         else:
             if self.is_superuser:
                 ObjectAccess.objects.filter(user=self).delete()
+                ObjectAccess.entries_changed()
             self.is_superuser = False
             try:
                 self.groups.add(Group.objects.get(name=role))
@@ -390,6 +523,12 @@ def populate_callback(user, group='SimpleUsers'):
     events.raiseEvent("AccountAutoCreated", user)
 
 
+@receiver(m2m_changed, sender=User.groups.through)
+def user_groups_changed(sender, action, **kwargs):
+    if action.startswith("post_"):
+        User.roles_changed()
+
+
 class ObjectAccess(models.Model):
     user = models.ForeignKey(User)
     content_type = models.ForeignKey(ContentType)
@@ -397,12 +536,26 @@ class ObjectAccess(models.Model):
     content_object = generic.GenericForeignKey('content_type', 'object_id')
     is_owner = models.BooleanField(default=False)
 
+    #: Incremented each time access entries are modified (used to
+    #: invalidate the indexes built by ``User.can_access``)
+    generation = 0
+
     class Meta:
         unique_together = (("user", "content_type", "object_id"),)
 
     def __unicode__(self):
         return "%s => %s (%s)" % (self.user, self.content_object, self.content_type)
 
+    @classmethod
+    def entries_changed(cls):
+        """Invalidate the access indexes of all users.
+
+        Must be called after entries are created, modified or
+        deleted. No signal receiver is used: it would prevent Django
+        from deleting entries using a single query.
+        """
+        cls.generation += 1
+
 
 class Extension(models.Model):
     name = models.CharField(max_length=150)
@@ -463,6 +616,12 @@ class Extension(models.Model):
 reversion.register(Extension)
 
 
+@receiver([post_save, post_delete], sender=Extension)
+def extension_changed(sender, instance, **kwargs):
+    """Forget cached extension states."""
+    exts_pool.invalidate_states()
+
+
 class Log(models.Model):
     date_created = models.DateTimeField(auto_now_add=True)
     message = models.CharField(max_length=255)
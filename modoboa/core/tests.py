@@ -1,5 +1,5 @@
 from django.core.urlresolvers import reverse
-from modoboa.lib.tests import ModoTestCase
+from modoboa.lib.tests import ModoTestCase, ExtTestCase
 from . import factories
 
 
@@ -40,3 +40,49 @@ class ProfileTestCase(ModoTestCase):
         self.assertTrue(
             self.clt.login(username="user@test.com", password="tutu")
         )
+
+
+class ExtensionsTestCase(ExtTestCase):
+    fixtures = ['initial_users.json']
+
+    def test_states(self):
+        from modoboa.core.extensions import exts_pool
+
+        self.assertFalse(exts_pool.get_extension_state("stats"))
+        self.activate_extensions("stats")
+        self.assertTrue(exts_pool.get_extension_state("stats"))
+        self.ajax_post(
+            reverse("modoboa.core.views.admin.saveextensions"), {}
+        )
+        self.assertFalse(exts_pool.get_extension_state("stats"))
+
+    def test_states_shared(self):
+        """Check that changes made by other processes are seen
+        """
+        from modoboa.core.extensions import exts_pool
+        from modoboa.core.models import Extension
+
+        self.activate_extensions("stats")
+        self.assertTrue(exts_pool.get_extension_state("stats"))
+        # Another process disables the extension (no local signal)
+        Extension.objects.filter(name="stats").update(enabled=False)
+        exts_pool.states_version.bump()
+        self.assertTrue(exts_pool.get_extension_state("stats"))
+        # The shared version is read once the check interval is over
+        exts_pool._states[0][2] -= exts_pool.states_version.interval + 1
+        self.assertFalse(exts_pool.get_extension_state("stats"))
+
+        # Without a shared cache backend, states expire anyway
+        Extension.objects.filter(name="stats").update(enabled=True)
+        exts_pool._states[0][1] -= exts_pool.states_version.timeout + 1
+        self.assertTrue(exts_pool.get_extension_state("stats"))
+
+    def test_observe_without_queries(self):
+        from modoboa.lib import events
+
+        self.activate_extensions("postfix_relay_domains")
+        events.raiseQueryEvent("ExtraDomainFilters")
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                events.raiseQueryEvent("ExtraDomainFilters"), ['srvfilter']
+            )
@@ -14,6 +14,7 @@ urlpatterns = patterns(
     (r'^core/extensions/save/$', 'modoboa.core.views.admin.saveextensions'),
     (r'^core/info/$', 'modoboa.core.views.admin.information'),
     (r'^core/logs/$', 'modoboa.core.views.admin.logs'),
+    (r'^core/events/profile/$', 'modoboa.core.views.admin.events_profile'),
 
     (r'^user/$', 'modoboa.core.views.user.index'),
     (r'^user/preferences/$', 'modoboa.core.views.user.preferences'),
@@ -4,12 +4,13 @@ from django.utils.translation import ugettext as _
 from django.contrib.auth.decorators import (
     login_required, user_passes_test
 )
-from modoboa.lib import parameters
+from modoboa.lib import parameters, events
 from modoboa.lib.webutils import (
     _render_to_string, render_to_json_response
 )
 from modoboa.lib.listing import get_sort_order, get_listing_page
 from modoboa.core.models import Extension, Log
+from modoboa.core.extensions import exts_pool
 from modoboa.core.tables import ExtensionsTable
 
 
@@ -50,8 +51,6 @@ def saveparameters(request):
 @login_required
 @user_passes_test(lambda u: u.is_superuser)
 def viewextensions(request, tplname='core/extensions.html'):
-    from modoboa.core.extensions import exts_pool
-
     exts = exts_pool.list_all()
     for ext in exts:
         try:
@@ -86,6 +85,7 @@ def saveextensions(request):
     for ext in actived_exts:
         if not ext in found:
             ext.off()
+    exts_pool.invalidate_states()
 
     return render_to_json_response(_("Modifications applied."))
 
@@ -118,3 +118,19 @@ def logs(request, tplname="core/logs.html"):
         "page": page.number,
         "paginbar": pagination_bar(page),
     })
+
+
+@login_required
+@user_passes_test(lambda u: u.is_superuser)
+def events_profile(request):
+    """Return events dispatching statistics of the current process.
+
+    Add ``reset=1`` to the query string to forget collected
+    statistics.
+    """
+    data = events.get_profiling_data()
+    if request.GET.get("reset", None) == "1":
+        events.reset_profiling()
+    return render_to_json_response({
+        "enabled": data is not None, "events": data or {}
+    })
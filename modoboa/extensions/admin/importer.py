@@ -0,0 +1,674 @@
+# coding: utf-8
+"""
+:mod:`importer` --- CSV import engine
+-------------------------------------
+
+Accounts and aliases are imported by batches: the objects referenced
+by a batch (domains, mailboxes, aliases) are resolved using a few
+``IN`` queries, then new objects are created using ``bulk_create``.
+Other object types are imported one row at a time.
+
+Objects created in bulk are not recorded by ``reversion``. If the
+creation of a batch fails (a limit is reached for example), its rows
+are imported again one by one so errors are reported for each line.
+
+Accounts are imported in bulk only if the *AccountImported* event is
+not observed by another extension than ``admin`` (whose callback is
+replaced by :meth:`CSVImporter._create_accounts`), otherwise they are
+imported one at a time using ``User.from_csv``.
+
+Imports are queued as :class:`ImportJob
+<modoboa.extensions.admin.models.ImportJob>` objects by the web
+interface and processed by the ``process_import_jobs`` management
+command (see :func:`process_job`).
+"""
+import csv
+import datetime
+import logging
+from cStringIO import StringIO
+import reversion
+from django.db import transaction
+from django.utils import timezone
+from django.contrib.auth.models import Group
+from django.utils.encoding import force_text
+from django.utils.html import escape
+from django.utils.translation import ugettext as _
+from modoboa.lib import events
+from modoboa.lib.emailutils import split_mailbox
+from modoboa.lib.exceptions import (
+    ModoboaException, BadRequest, PermDeniedException, Conflict
+)
+from modoboa.lib.permissions import grant_access_to_new_objects
+from modoboa.core.models import User
+from modoboa.extensions.admin.models import (
+    Domain, DomainAlias, Mailbox, Quota, Alias, ImportJob
+)
+from modoboa.extensions.admin.models.base import ObjectDates
+
+
+@transaction.commit_on_success
+def import_domain(user, row, formopts):
+    """Specific code for domains import"""
+    dom = Domain()
+    dom.from_csv(user, row)
+
+
+@transaction.commit_on_success
+def import_domainalias(user, row, formopts):
+    """Specific code for domain aliases import"""
+    domalias = DomainAlias()
+    domalias.from_csv(user, row)
+
+
+@transaction.commit_on_success
+def import_account(user, row, formopts):
+    """Specific code for accounts import"""
+    account = User()
+    account.from_csv(user, row, formopts["crypt_password"])
+
+
+@transaction.commit_on_success
+def _import_alias(user, row, **kwargs):
+    """Specific code for aliases import"""
+    alias = Alias()
+    alias.from_csv(user, row, **kwargs)
+
+
+def import_alias(user, row, formopts):
+    _import_alias(user, row, expected_elements=4)
+
+
+def import_forward(user, row, formopts):
+    _import_alias(user, row, expected_elements=4)
+
+
+def import_dlist(user, row, formopts):
+    _import_alias(user, row)
+
+
+def get_import_handler(typ):
+    """Return the function used to import an object of a given type
+
+    Extensions provide their own functions using the *ImportObject*
+    event.
+
+    :param str typ: the object type
+    :return: a function or None
+    """
+    try:
+        return globals()["import_%s" % typ]
+    except KeyError:
+        fct = events.raiseQueryEvent('ImportObject', typ)
+        return fct[0] if fct else None
+
+
+class CSVImporter(object):
+    """Import objects from a CSV file.
+
+    :param ``User`` user: the user importing objects
+    :param dict formopts: the cleaned data of the import form
+    """
+
+    batch_size = 500
+    bulk_account_callbacks = [
+        "modoboa.extensions.admin.import_account_mailbox"
+    ]
+
+    def __init__(self, user, formopts):
+        self.user = user
+        self.formopts = formopts
+        self.count = 0
+        self.errors = []
+        self._batch = []
+        self._batch_type = None
+        self._domains = {}
+        self._domains_access = {}
+        self._roles = {}
+        self._bulk_accounts = set(
+            events.callbacks.get("AccountImported", {}).keys()
+        ) <= set(self.bulk_account_callbacks)
+
+    def run(self, reader, get_handler=get_import_handler, progress=None):
+        """Import all the rows provided by a CSV reader.
+
+        :param reader: a ``csv.reader`` object
+        :param get_handler: a function returning the function used to
+                            import one row of a given type (or None)
+        :param progress: a function called every ``batch_size`` lines
+                         (and at the end) with the number of lines
+                         processed so far
+        """
+        reported = 0
+        for row in reader:
+            if progress is not None \
+                    and reader.line_num - reported > self.batch_size:
+                self.flush()
+                reported = reader.line_num - 1
+                progress(reported)
+            if not row:
+                continue
+            typ = row[0].strip()
+            if typ == "account" and self._can_bulk_import_account(row):
+                self._add(reader.line_num, row, "accounts")
+            elif typ in ["alias", "forward", "dlist"]:
+                self._add(reader.line_num, row, "aliases")
+            else:
+                handler = get_handler(typ)
+                if handler is None:
+                    continue
+                self.flush()
+                self._import_row(reader.line_num, row, handler)
+        self.flush()
+        if progress is not None:
+            progress(reader.line_num)
+
+    def error(self, lineno, msg):
+        """Record an error for a given line."""
+        self.errors.append(_("Line %d: %s") % (lineno, msg))
+
+    def _handle_exception(self, lineno, row, exc):
+        if isinstance(exc, Conflict):
+            if self.formopts["continue_if_exists"]:
+                return
+            msg = _("Object already exists: %s"
+                    % self.formopts['sepchar'].join(row[:2]))
+        else:
+            msg = str(exc)
+        self.error(lineno, msg)
+
+    def _import_row(self, lineno, row, handler):
+        try:
+            handler(self.user, row, self.formopts)
+        except ModoboaException as e:
+            self._handle_exception(lineno, row, e)
+        else:
+            self.count += 1
+
+    def _can_bulk_import_account(self, row):
+        """Super administrators are imported one at a time.
+
+        So are all accounts when another extension observes the
+        *AccountImported* event.
+        """
+        if not self._bulk_accounts:
+            return False
+        return len(row) < 7 or row[6].strip() != "SuperAdmins"
+
+    def _add(self, lineno, row, typ):
+        try:
+            row = [force_text(field) for field in row]
+        except UnicodeDecodeError:
+            self.error(lineno, _("Invalid line"))
+            return
+        if typ != self._batch_type or len(self._batch) >= self.batch_size:
+            self.flush()
+        elif typ == "aliases":
+            # Recipients must exist before an alias is created
+            addresses = [r.strip() for r in row[3:]]
+            for blineno, brow in self._batch:
+                if brow[1].strip() in addresses:
+                    self.flush()
+                    break
+        self._batch_type = typ
+        self._batch.append((lineno, row))
+
+    def flush(self):
+        """Import the pending batch of rows."""
+        if not self._batch:
+            return
+        batch, typ = self._batch, self._batch_type
+        self._batch, self._batch_type = [], None
+        self._import_batch(batch, typ)
+
+    def _import_batch(self, batch, typ):
+        """Check and create a batch of rows of the same type.
+
+        If the creation fails, the valid rows are imported again one
+        by one.
+        """
+        valid, entries = [], []
+        prepared = getattr(self, "_prepare_%s" % typ)(batch)
+        for (lineno, row), (lineno, entry, exc) in zip(batch, prepared):
+            if exc is not None:
+                self._handle_exception(lineno, row, exc)
+                continue
+            valid.append((lineno, row))
+            entries.append(entry)
+        if not entries:
+            return
+        try:
+            with transaction.commit_on_success():
+                getattr(self, "_create_%s" % typ)(entries)
+        except ModoboaException as e:
+            if len(valid) == 1:
+                self._handle_exception(valid[0][0], valid[0][1], e)
+                return
+            for item in valid:
+                self._import_batch([item], typ)
+        else:
+            self.count += len(entries)
+
+    def _load_domains(self, names):
+        """Fetch the given domains (using one query)."""
+        names = [name for name in set(names)
+                 if name is not None and not name in self._domains]
+        if not names:
+            return
+        for name in names:
+            self._domains[name] = None
+        for dom in Domain.objects.filter(name__in=names):
+            self._domains[dom.name] = dom
+
+    def _get_domain(self, name):
+        """Return a domain the importer can access.
+
+        :raises: ``BadRequest``, ``PermDeniedException``
+        """
+        domain = self._domains.get(name)
+        if domain is None:
+            return None
+        if not domain.pk in self._domains_access:
+            self._domains_access[domain.pk] = self.user.can_access(domain)
+        if not self._domains_access[domain.pk]:
+            raise PermDeniedException
+        return domain
+
+    def _get_role(self, name):
+        """Return the group and the 'is an administrator' flag of a role."""
+        if not name in self._roles:
+            try:
+                group = Group.objects.get(name=name)
+            except Group.DoesNotExist:
+                group = Group.objects.get(name="SimpleUsers")
+            is_admin = group.permissions.filter(
+                content_type__app_label="admin", codename="add_domain"
+            ).exists()
+            self._roles[name] = (group, is_admin)
+        return self._roles[name]
+
+    def _check_limit(self, objtype, counters):
+        """Check if one more object of a given type can be created.
+
+        The *CanCreate* event is raised with the number of objects of
+        this type already accepted in the current batch.
+
+        :param str objtype: the object type (as used by *CanCreate*)
+        :param dict counters: accepted objects (indexed by type)
+        """
+        count = counters.get(objtype, 0) + 1
+        events.raiseEvent("CanCreate", self.user, objtype, count)
+        counters[objtype] = count
+
+    def _create_dates(self, objects):
+        for obj in objects:
+            obj.dates = ObjectDates.objects.create()
+
+    def _prepare_accounts(self, batch):
+        """Check account rows.
+
+        Same checks as ``User.from_csv`` and the *AccountImported*
+        callback, using batched lookups.
+        """
+        usernames = [row[1].strip() for lineno, row in batch if len(row) > 1]
+        existing = set(
+            User.objects.filter(username__in=usernames)
+            .values_list("username", flat=True)
+        )
+        mailboxes = []
+        for lineno, row in batch:
+            if len(row) > 7 and row[7].strip():
+                mailboxes.append(split_mailbox(row[7].strip()))
+        self._load_domains([domname for address, domname in mailboxes])
+        existing_mailboxes = set(
+            Mailbox.objects.filter(
+                domain__name__in=[domname for address, domname in mailboxes],
+                address__in=[address for address, domname in mailboxes]
+            ).values_list("address", "domain__name")
+        )
+        override_rules = self.user.has_perm("admin.change_domain")
+        counters = {}
+        for lineno, row in batch:
+            try:
+                row = self._prepare_account(
+                    row, existing, existing_mailboxes, override_rules,
+                    counters
+                )
+            except ModoboaException as e:
+                yield lineno, row, e
+            else:
+                yield lineno, row, None
+
+    def _prepare_account(self, row, existing, existing_mailboxes,
+                         override_rules, counters):
+        if len(row) < 7:
+            raise BadRequest(_("Invalid line"))
+        role = row[6].strip()
+        if not self.user.is_superuser and \
+                not role in ["SimpleUsers", "DomainAdmins"]:
+            raise PermDeniedException(
+                _("You can't import an account with a role greater than yours")
+            )
+        account = User(username=row[1].strip())
+        if account.username in existing:
+            raise Conflict
+        if role == "SimpleUsers":
+            if (len(row) < 8 or not row[7].strip()):
+                raise BadRequest(
+                    _("The simple user '%s' must have a valid email address"
+                      % account.username)
+                )
+            if account.username != row[7].strip():
+                raise BadRequest(
+                    _("username and email fields must not differ for '%s'"
+                      % account.username)
+                )
+        account.first_name = row[3].strip()
+        account.last_name = row[4].strip()
+        account.is_active = (row[5].strip() == 'True')
+        group, is_admin = self._get_role(role)
+        mailbox = None
+        if len(row) > 7 and row[7].strip():
+            account.email = row[7].strip()
+            address, domname = split_mailbox(account.email)
+            domain = self._get_domain(domname)
+            if domain is None:
+                raise BadRequest(
+                    _("Account import failed (%s): domain does not exist"
+                      % account.username)
+                )
+            if (address, domname) in existing_mailboxes:
+                raise Conflict(_("Mailbox %s already exists" % account.email))
+            if len(row) == 8:
+                quota = None
+            else:
+                try:
+                    quota = int(row[8].strip())
+                except ValueError:
+                    raise BadRequest(
+                        _("Account import failed (%s): wrong quota value"
+                          % account.username)
+                    )
+            mailbox = Mailbox(address=address, domain=domain,
+                              use_domain_quota=not quota)
+            mailbox.set_quota(quota, override_rules=override_rules)
+            self._check_limit("mailboxes", counters)
+            existing_mailboxes.add((address, domname))
+        if self.formopts["crypt_password"]:
+            account.set_password(row[2].strip())
+        else:
+            account.password = row[2].strip()
+        existing.add(account.username)
+        return {
+            "account": account, "role": role, "group": group,
+            "is_admin": is_admin and account.is_active, "mailbox": mailbox,
+            "domains": [name.strip() for name in row[9:]]
+        }
+
+    def _create_accounts(self, entries):
+        """Create accounts and mailboxes in bulk.
+
+        Events are sent in the same order than ``User.from_csv``
+        does.
+        """
+        accounts = [entry["account"] for entry in entries]
+        User.objects.bulk_create(accounts)
+        pks = dict(
+            User.objects.filter(username__in=[a.username for a in accounts])
+            .values_list("username", "pk")
+        )
+        for account in accounts:
+            account.pk = pks[account.username]
+        grant_access_to_new_objects(self.user, accounts, is_owner=True)
+        for account in accounts:
+            events.raiseEvent("AccountCreated", account)
+        for entry in entries:
+            events.raiseEvent("RoleChanged", entry["account"], entry["role"])
+        User.groups.through.objects.bulk_create([
+            User.groups.through(user_id=entry["account"].pk,
+                                group_id=entry["group"].pk)
+            for entry in entries
+        ])
+        User.roles_changed()
+        for entry in entries:
+            if entry["group"].name != "SimpleUsers":
+                grant_access_to_new_objects(entry["account"],
+                                            [entry["account"]])
+
+        entries = [entry for entry in entries if entry["mailbox"] is not None]
+        mailboxes = []
+        for entry in entries:
+            entry["mailbox"].user = entry["account"]
+            mailboxes.append(entry["mailbox"])
+        if not mailboxes:
+            return
+        self._create_dates(mailboxes)
+        Mailbox.objects.bulk_create(mailboxes)
+        pks = dict(
+            Mailbox.objects.filter(user__in=[mb.user.pk for mb in mailboxes])
+            .values_list("user", "pk")
+        )
+        for mb in mailboxes:
+            mb.pk = pks[mb.user.pk]
+        Quota.objects.bulk_create([
+            Quota(mbox=mb, username=mb.full_address) for mb in mailboxes
+        ])
+        grant_access_to_new_objects(self.user, mailboxes, is_owner=True)
+        if self.user.is_superuser:
+            # Domain administrators can access new simple users
+            grants = {}
+            for entry in entries:
+                if entry["is_admin"]:
+                    continue
+                mb = entry["mailbox"]
+                for admin in self._domain_admins(mb.domain):
+                    grants.setdefault(admin.pk, (admin, []))[1].append(mb)
+            for admin, mbs in grants.values():
+                grant_access_to_new_objects(admin, mbs)
+                grant_access_to_new_objects(admin, [mb.user for mb in mbs])
+        for mb in mailboxes:
+            events.raiseEvent("MailboxCreated", self.user, mb)
+        for entry in entries:
+            if entry["group"].name != "DomainAdmins":
+                continue
+            self._load_domains(entry["domains"])
+            for name in entry["domains"]:
+                if self._domains.get(name) is not None:
+                    self._domains[name].add_admin(entry["account"])
+
+    def _domain_admins(self, domain):
+        if not hasattr(domain, "_admins"):
+            domain._admins = domain.admins
+        return domain._admins
+
+    def _prepare_aliases(self, batch):
+        """Check alias rows.
+
+        Same checks as ``Alias.from_csv``, using batched lookups.
+        """
+        addresses = []
+        for lineno, row in batch:
+            addresses += [split_mailbox(addr.strip()) for addr in row[1:2]]
+            addresses += [split_mailbox(rcpt.strip()) for rcpt in row[3:]
+                          if rcpt.strip()]
+        self._load_domains([domname for address, domname in addresses])
+        domnames = [domname for address, domname in addresses
+                    if self._domains.get(domname) is not None]
+        localparts = [address for address, domname in addresses]
+        aliases = dict(
+            ((address, domname), pk) for pk, address, domname in
+            Alias.objects.filter(
+                domain__name__in=domnames, address__in=localparts
+            ).values_list("pk", "address", "domain__name")
+        )
+        mailboxes = dict(
+            ((address, domname), pk) for pk, address, domname in
+            Mailbox.objects.filter(
+                domain__name__in=domnames, address__in=localparts
+            ).values_list("pk", "address", "domain__name")
+        )
+        counters = {}
+        for lineno, row in batch:
+            expected_elements = 5 if row[0].strip() == "dlist" else 4
+            try:
+                row = self._prepare_alias(
+                    row, expected_elements, aliases, mailboxes, counters
+                )
+            except ModoboaException as e:
+                yield lineno, row, e
+            else:
+                yield lineno, row, None
+
+    def _prepare_alias(self, row, expected_elements, aliases, mailboxes,
+                       counters):
+        if len(row) < expected_elements:
+            raise BadRequest(_("Invalid line: %s" % row))
+        localpart, domname = split_mailbox(row[1].strip())
+        domain = self._get_domain(domname)
+        if domain is None:
+            raise BadRequest(_("Domain '%s' does not exist" % domname))
+        if (localpart, domname) in aliases:
+            raise Conflict
+        alias = Alias(address=localpart, domain=domain,
+                      enabled=(row[2].strip() == 'True'))
+        target_aliases = []
+        target_mailboxes = []
+        ext_rcpts = []
+        for rcpt in row[3:]:
+            rcpt = rcpt.strip()
+            if not rcpt:
+                continue
+            key = split_mailbox(rcpt)
+            if self._domains.get(key[1]) is None:
+                ext_rcpts.append(rcpt)
+                continue
+            if aliases.get(key) is not None and key != (localpart, domname):
+                target_aliases.append(aliases[key])
+            elif key in mailboxes:
+                target_mailboxes.append(mailboxes[key])
+            else:
+                raise BadRequest(_("Local recipient %s not found" % rcpt))
+        alias.extmboxes = ",".join(ext_rcpts)
+        if len(target_aliases) + len(target_mailboxes) + len(ext_rcpts) > 1:
+            alias.type = "dlist"
+        elif ext_rcpts:
+            alias.type = "forward"
+        self._check_limit("mailbox_aliases", counters)
+        aliases[(localpart, domname)] = None
+        return {
+            "alias": alias, "aliases": target_aliases,
+            "mailboxes": target_mailboxes
+        }
+
+    def _create_aliases(self, entries):
+        """Create aliases and their recipients in bulk."""
+        aliases = [entry["alias"] for entry in entries]
+        self._create_dates(aliases)
+        Alias.objects.bulk_create(aliases)
+        pks = dict(
+            ((domain, address), pk) for pk, domain, address in
+            Alias.objects.filter(
+                domain__in=set(al.domain.pk for al in aliases),
+                address__in=[al.address for al in aliases]
+            ).values_list("pk", "domain", "address")
+        )
+        for alias in aliases:
+            alias.pk = pks[(alias.domain.pk, alias.address)]
+        Alias.mboxes.through.objects.bulk_create([
+            Alias.mboxes.through(alias_id=entry["alias"].pk, mailbox_id=pk)
+            for entry in entries for pk in entry["mailboxes"]
+        ])
+        Alias.aliases.through.objects.bulk_create([
+            Alias.aliases.through(from_alias_id=entry["alias"].pk,
+                                  to_alias_id=pk)
+            for entry in entries for pk in entry["aliases"]
+        ])
+        grant_access_to_new_objects(self.user, aliases, is_owner=True)
+        if self.user.is_superuser:
+            grants = {}
+            for alias in aliases:
+                for admin in self._domain_admins(alias.domain):
+                    grants.setdefault(admin.pk, (admin, []))[1].append(alias)
+            for admin, objects in grants.values():
+                grant_access_to_new_objects(admin, objects)
+        for alias in aliases:
+            events.raiseEvent("MailboxAliasCreated", self.user, alias)
+
+    def get_message(self):
+        """Return a summary of the import."""
+        msg = _("%d objects imported successfully" % self.count)
+        if not self.errors:
+            return msg
+        return "<br/>".join([escape(error) for error in self.errors] + [msg])
+
+
+def process_job(job):
+    """Process a queued import job.
+
+    The job is first marked as running (unless another worker did it
+    before). Counters are saved after each batch. Unexpected errors
+    mark the job as failed. Once the job is over, its content (which
+    can contain passwords) is removed from the database.
+
+    :param ``ImportJob`` job: the job to process
+    :return: False if the job was already taken, True otherwise
+    """
+    def update_progress(lineno):
+        ImportJob.objects.filter(pk=job.pk).update(
+            processed=lineno, imported=importer.count,
+            nerrors=len(importer.errors)
+        )
+        job.processed = lineno
+
+    job.status = "running"
+    job.started = timezone.now()
+    if not ImportJob.objects.filter(pk=job.pk, status="pending") \
+            .update(status=job.status, started=job.started):
+        return False
+    importer = CSVImporter(job.user, job.get_options())
+    try:
+        reader = csv.reader(StringIO(job.content.encode("utf-8")),
+                            delimiter=str(importer.formopts["sepchar"]))
+        with reversion.create_revision():
+            reversion.set_user(job.user)
+            try:
+                importer.run(reader, progress=update_progress)
+            except csv.Error as inst:
+                importer.errors.append(str(inst))
+    except Exception as e:
+        logging.getLogger("modoboa.admin").exception(
+            "Import job %d failed" % job.pk
+        )
+        job.status = "failed"
+        job.message = escape(str(e))
+    else:
+        job.status = "done"
+        job.message = importer.get_message()
+    job.imported = importer.count
+    job.nerrors = len(importer.errors)
+    job.finished = timezone.now()
+    job.content = ""
+    ImportJob.objects.filter(pk=job.pk).update(
+        status=job.status, message=job.message, processed=job.processed,
+        imported=job.imported, nerrors=job.nerrors, finished=job.finished,
+        content=job.content
+    )
+    return True
+
+
+def fail_stale_jobs(timeout):
+    """Mark jobs running for too long as failed.
+
+    Such jobs were probably left by a worker which crashed. They are
+    not processed again (they could have been partially imported) but
+    their content is removed.
+
+    :param int timeout: maximum duration of a job in seconds
+    :return: the number of modified jobs
+    """
+    limit = timezone.now() - datetime.timedelta(seconds=timeout)
+    return ImportJob.objects.filter(
+        status="running", started__lt=limit
+    ).update(
+        status="failed", content="", finished=timezone.now(),
+        message=_("Import interrupted (the worker has probably stopped)")
+    )
@@ -1,16 +1,18 @@
 # coding: utf-8
 from functools import wraps
-from itertools import chain
+from django.db import connection
 from django.db.models import Q
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.contrib.contenttypes.models import ContentType
+from django.utils.datastructures import SortedDict
 from django.utils.translation import ugettext as _
 from modoboa.core.models import User
 from modoboa.lib import parameters, events
 from modoboa.lib.exceptions import PermDeniedException
+from modoboa.lib.dbutils import QuerySetUnion, sql_concat
 from modoboa.lib.emailutils import split_mailbox
 from modoboa.extensions.admin.models import (
-    Domain, Alias
+    Domain, Mailbox, Alias
 )
 
 
@@ -70,16 +72,82 @@ def get_listing_page(objects, pagenum):
     return page
 
 
+def _accounts_extra_select():
+    """Return the SQL columns used to sort accounts.
+
+    The role is added by ``User.objects.with_role()``.
+
+    :rtype: ``SortedDict``
+    """
+    qn = connection.ops.quote_name
+    table = qn(User._meta.db_table)
+    first_name = "%s.%s" % (table, qn("first_name"))
+    return SortedDict([
+        ("idt_identity", "%s.%s" % (table, qn("username"))),
+        ("idt_name", "CASE WHEN %s <> '' THEN %s ELSE '----' END" % (
+            first_name,
+            sql_concat(first_name, "' '", "%s.%s" % (table, qn("last_name")))
+        )),
+        ("idt_type", "'account'")
+    ])
+
+
+def _aliases_extra_select():
+    """Return the SQL columns used to sort aliases.
+
+    :rtype: ``SortedDict``
+    """
+    qn = connection.ops.quote_name
+    table = qn(Alias._meta.db_table)
+    domain_table = qn(Domain._meta.db_table)
+    identity = sql_concat(
+        "%s.%s" % (table, qn("address")), "'@'",
+        "(SELECT d.%s FROM %s d WHERE d.%s = %s.%s)" % (
+            qn("name"), domain_table, qn("id"), table, qn("domain_id"))
+    )
+    recipients = []
+    for fname, model, ordering in [("aliases", Alias, "d.{name}, o.{address}"),
+                                   ("mboxes", Mailbox, "o.{id}")]:
+        field = Alias._meta.get_field(fname)
+        recipients.append((
+            "(SELECT {rcpt} FROM {table} o "
+            "INNER JOIN {rel} r ON r.{target_id} = o.{id} "
+            "INNER JOIN {domain} d ON d.{id} = o.{domain_id} "
+            "WHERE r.{source_id} = {alias}.{id} ORDER BY %s LIMIT 1)"
+            % ordering
+        ).format(
+            rcpt=sql_concat("o.%s" % qn("address"), "'@'",
+                            "d.%s" % qn("name")),
+            table=qn(model._meta.db_table), rel=qn(field.m2m_db_table()),
+            target_id=qn(field.m2m_reverse_name()), id=qn("id"),
+            domain=domain_table, domain_id=qn("domain_id"),
+            source_id=qn(field.m2m_column_name()), alias=table,
+            name=qn("name"), address=qn("address")
+        ))
+    recipients.append("NULLIF(%s.%s, '')" % (table, qn("extmboxes")))
+    return SortedDict([
+        ("idt_identity", identity),
+        ("idt_name", "COALESCE(%s, '---')" % ", ".join(recipients)),
+        ("idt_type", "%s.%s" % (table, qn("type"))),
+        ("idt_role", "''")
+    ])
+
+
 def get_identities(user, searchquery=None, idtfilter=None, grpfilter=None):
     """Return all the identities owned by a user.
 
+    Accounts and aliases are merged, sorted and paginated by the
+    database. The available sort columns are ``identity``,
+    ``name_or_rcpt``, ``idtype`` (the identity type) and ``role``.
+
     :param user: the desired user
     :param str searchquery: search pattern
     :param list idtfilter: identity type filters
     :param list grpfilter: group names filters
-    :return: a queryset
+    :rtype: ``QuerySetUnion``
+    :return: a union of accounts and aliases
     """
-    accounts = []
+    parts = []
     if idtfilter is None or not idtfilter or idtfilter == "account":
         ids = user.objectaccess_set \
             .filter(content_type=ContentType.objects.get_for_model(user)) \
@@ -93,9 +161,13 @@ def get_identities(user, searchquery=None, idtfilter=None, grpfilter=None):
                 q &= Q(is_superuser=True)
             else:
                 q &= Q(groups__name=grpfilter)
-        accounts = User.objects.select_related().filter(q)
+        accounts = User.objects.with_role().filter(q) \
+            .extra(select=_accounts_extra_select()) \
+            .prefetch_related("mailbox_set__domain")
+        parts.append((
+            "user", accounts, ["idt_identity", "idt_name", "idt_type", "role"]
+        ))
 
-    aliases = []
     if idtfilter is None or not idtfilter \
             or (idtfilter in ["alias", "forward", "dlist"]):
         alct = ContentType.objects.get_for_model(Alias)
@@ -112,28 +184,44 @@ def get_identities(user, searchquery=None, idtfilter=None, grpfilter=None):
             else:
                 q &= Q(address__icontains=searchquery) | \
                     Q(domain__name__icontains=searchquery)
-        aliases = Alias.objects.select_related().filter(q)
+        aliases = Alias.objects.select_related("domain").filter(q) \
+            .extra(select=_aliases_extra_select()) \
+            .prefetch_related("aliases__domain", "mboxes__domain")
         if idtfilter is not None and idtfilter:
-            aliases = [al for al in aliases if al.type == idtfilter]
-    return chain(accounts, aliases)
+            aliases = aliases.filter(type=idtfilter)
+        parts.append((
+            "alias", aliases,
+            ["idt_identity", "idt_name", "idt_type", "idt_role"]
+        ))
+    return QuerySetUnion(
+        parts, ["identity", "name_or_rcpt", "idtype", "role"]
+    )
 
 
 def get_domains(user, domfilter=None, searchquery=None, **extrafilters):
     """Return all the domains the user can access.
 
+    Extensions can add their own entries by listening to the
+    ``ExtraDomainEntries`` event (they must return querysets). The
+    result is sorted by name and can be paginated by the database.
+
     :param ``User`` user: user object
     :param str searchquery: filter
-    :rtype: list
-    :return: a list of domains and/or relay domains
+    :rtype: ``QuerySetUnion``
+    :return: a union of domains and/or relay domains
     """
-    domains = []
+    parts = []
     if domfilter is None or not domfilter or domfilter == 'domain':
-        domains = Domain.objects.get_for_admin(user)
+        domains = Domain.objects.get_for_admin(user) \
+            .prefetch_related("domainalias_set")
         if searchquery is not None:
             q = Q(name__contains=searchquery)
             q |= Q(domainalias__name__contains=searchquery)
             domains = domains.filter(q).distinct()
+        parts.append(("domain", domains, ["name"]))
     extra_domain_entries = events.raiseQueryEvent(
         'ExtraDomainEntries', user, domfilter, searchquery, **extrafilters
     )
-    return chain(domains, extra_domain_entries)
+    for qs in extra_domain_entries:
+        parts.append((qs.model._meta.object_name.lower(), qs, ["name"]))
+    return QuerySetUnion(parts, ["name"])
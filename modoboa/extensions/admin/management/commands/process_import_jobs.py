@@ -0,0 +1,62 @@
+import time
+import logging
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils.importlib import import_module
+from modoboa.extensions.admin.importer import process_job, fail_stale_jobs
+from modoboa.extensions.admin.models import ImportJob
+
+
+class Command(BaseCommand):
+    help = 'Processes the pending CSV import jobs'
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--loop', action='store_true', default=False,
+            help='Do not exit, wait for new jobs instead'
+        ),
+        make_option(
+            '--interval', type='int', default=5,
+            help='Number of seconds between two checks (with --loop)'
+        ),
+        make_option(
+            '--timeout', type='int', default=3600,
+            help='Mark jobs running for more than TIMEOUT seconds as failed'
+        ),
+    )
+
+    def __init__(self, *args, **kwargs):
+        super(Command, self).__init__(*args, **kwargs)
+        self.logger = logging.getLogger('modoboa.admin')
+
+    def load_extensions(self):
+        """Load enabled extensions.
+
+        Extensions are loaded by the url configuration. They must be
+        loaded to import their own object types (*ImportObject*
+        event).
+        """
+        import_module(settings.ROOT_URLCONF)
+
+    def fail_stale_jobs(self, timeout):
+        count = fail_stale_jobs(timeout)
+        if count:
+            self.logger.warning("%d stale import job(s) marked as failed" % count)
+
+    def process_pending_jobs(self):
+        for job in ImportJob.objects.filter(status="pending") \
+                .select_related("user"):
+            if process_job(job):
+                self.logger.info(
+                    "Import job %d (%s): %s" % (job.pk, job.filename, job.status)
+                )
+
+    def handle(self, *args, **options):
+        self.load_extensions()
+        while True:
+            self.fail_stale_jobs(options["timeout"])
+            self.process_pending_jobs()
+            if not options["loop"]:
+                break
+            time.sleep(options["interval"])
@@ -3,8 +3,9 @@ from .domain import Domain
 from .domain_alias import DomainAlias
 from .mailbox import Mailbox, Quota, MailboxOperation
 from .alias import Alias
+from .importjob import ImportJob
 
 __all__ = [
     'Domain', 'DomainAlias', 'Mailbox', 'Quota', 'Alias',
-    'MailboxOperation', 'AdminObject'
+    'MailboxOperation', 'ImportJob', 'AdminObject'
 ]
@@ -1,5 +1,7 @@
 import reversion
 from django.db import models
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
 from django.utils.translation import ugettext as _, ugettext_lazy
 from modoboa.lib.emailutils import split_mailbox
 from modoboa.lib.exceptions import (
@@ -35,6 +37,9 @@ class Alias(AdminObject):
         ugettext_lazy('enabled'),
         help_text=ugettext_lazy("Check to activate this alias")
     )
+    type = models.CharField(
+        ugettext_lazy('type'), max_length=20, default="alias", db_index=True
+    )
     _objectname = 'MailboxAlias'
 
     class Meta:
@@ -66,15 +71,6 @@ class Alias(AdminObject):
             return "%s, ..." % rcpts[0]
         return rcpts[0]
 
-    @property
-    def type(self):
-        cpt = self.get_recipients_count()
-        if cpt > 1:
-            return "dlist"
-        if self.extmboxes != "":
-            return "forward"
-        return "alias"
-
     @property
     def tags(self):
         labels = {
@@ -118,6 +114,23 @@ class Alias(AdminObject):
         for t in curmboxes:
             if not t in int_rcpts:
                 self.mboxes.remove(t)
+        self.update_type()
+
+    def update_type(self):
+        """Update the type of this alias according to its recipients.
+
+        The type is stored to allow filtering aliases in the
+        database. It must be updated each time recipients change.
+        """
+        if self.get_recipients_count() > 1:
+            altype = "dlist"
+        elif self.extmboxes != "":
+            altype = "forward"
+        else:
+            altype = "alias"
+        if altype != self.type:
+            self.type = altype
+            Alias.objects.filter(pk=self.pk).update(type=altype)
 
     def get_recipients(self, with_external=True):
         """Return the recipients list.
@@ -201,3 +214,16 @@ class Alias(AdminObject):
         csvwriter.writerow(row)
 
 reversion.register(Alias)
+
+
+@receiver(pre_delete, sender=Alias)
+def alias_deleted_handler(sender, **kwargs):
+    """``Alias`` pre_delete signal receiver
+
+    The alias is removed from the aliases it is a recipient of and
+    their type is updated.
+    """
+    alias = kwargs['instance']
+    for other in alias.alias_set.all():
+        other.aliases.remove(alias)
+        other.update_type()
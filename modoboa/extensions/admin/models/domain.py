@@ -19,7 +19,9 @@ class DomainManager(Manager):
         """
         if admin.is_superuser:
             return self.get_query_set()
-        return self.get_query_set().filter(owners__user=admin)
+        return self.get_query_set().filter(
+            admin.get_administered_filter(self.model)
+        )
 
 
 class Domain(AdminObject):
@@ -66,26 +68,41 @@ class Domain(AdminObject):
 
         :return: a list of User objects
         """
-        return [oa.user for oa in self.owners.filter(user__is_superuser=False)]
+        return list(User.objects.with_role().filter(
+            pk__in=self.owners.filter(user__is_superuser=False).values("user")
+        ))
 
     @property
     def aliases(self):
         return self.domainalias_set
 
+    def _get_simple_accounts(self):
+        """Return the mailboxes and accounts of this domain that are
+        not administrators.
+
+        :return: a tuple of two ``QuerySet`` objects
+        """
+        from modoboa.lib.permissions import get_administrators
+
+        admins = get_administrators().values_list("pk", flat=True)
+        return (
+            self.mailbox_set.exclude(user__in=admins),
+            User.objects.filter(mailbox__domain=self).exclude(pk__in=admins)
+        )
+
     def add_admin(self, account):
         """Add a new administrator for this domain
 
         :param User account: the administrotor to add
         """
-        from modoboa.lib.permissions import grant_access_to_object
+        from modoboa.lib.permissions import \
+            grant_access_to_object, grant_access_to_objects
+
         grant_access_to_object(account, self)
-        for mb in self.mailbox_set.all():
-            if mb.user.has_perm("admin.add_domain"):
-                continue
-            grant_access_to_object(account, mb)
-            grant_access_to_object(account, mb.user)
-        for al in self.alias_set.all():
-            grant_access_to_object(account, al)
+        mailboxes, accounts = self._get_simple_accounts()
+        grant_access_to_objects(account, mailboxes)
+        grant_access_to_objects(account, accounts)
+        grant_access_to_objects(account, self.alias_set.all())
 
     def remove_admin(self, account):
         """Remove an administrator of this domain.
@@ -93,18 +110,16 @@ class Domain(AdminObject):
         :param User account: administrator to remove
         """
         from modoboa.lib.permissions import \
-            ungrant_access_to_object, get_object_owner
+            ungrant_access_to_object, ungrant_access_to_objects, \
+            get_object_owner
 
         if get_object_owner(self) == account:
             events.raiseEvent('DomainOwnershipRemoved', account, self)
         ungrant_access_to_object(self, account)
-        for mb in self.mailbox_set.all():
-            if mb.user.has_perm("admin.add_domain"):
-                continue
-            ungrant_access_to_object(mb, account)
-            ungrant_access_to_object(mb.user, account)
-        for al in self.alias_set.all():
-             ungrant_access_to_object(al, account)
+        mailboxes, accounts = self._get_simple_accounts()
+        ungrant_access_to_objects(mailboxes, account)
+        ungrant_access_to_objects(accounts, account)
+        ungrant_access_to_objects(self.alias_set.all(), account)
 
     def delete(self, fromuser, keepdir=False):
         """Custom delete method.
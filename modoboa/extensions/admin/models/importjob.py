@@ -0,0 +1,70 @@
+import json
+from django.db import models
+from django.utils import timezone
+from django.utils.translation import ugettext_lazy
+from modoboa.core.models import User
+
+
+class ImportJob(models.Model):
+    """A CSV import waiting to be processed (or being processed)
+
+    Jobs are created by the import views and processed by the
+    ``process_import_jobs`` management command. Progress counters are
+    updated after each batch so they can be polled by the web
+    interface.
+    """
+    STATUSES = (
+        ("pending", ugettext_lazy("Pending")),
+        ("running", ugettext_lazy("Running")),
+        ("done", ugettext_lazy("Done")),
+        ("failed", ugettext_lazy("Failed")),
+    )
+
+    user = models.ForeignKey(User)
+    filename = models.CharField(max_length=255)
+    content = models.TextField()
+    options = models.TextField()
+    status = models.CharField(
+        max_length=10, choices=STATUSES, default="pending", db_index=True
+    )
+    total = models.IntegerField(default=0)
+    processed = models.IntegerField(default=0)
+    imported = models.IntegerField(default=0)
+    nerrors = models.IntegerField(default=0)
+    message = models.TextField(blank=True)
+    creation = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        app_label = 'admin'
+        ordering = ["creation", "id"]
+
+    def __str__(self):
+        return "Import %s (%s)" % (self.filename, self.status)
+
+    def get_options(self):
+        return json.loads(self.options)
+
+    def set_options(self, options):
+        self.options = json.dumps(options)
+
+    @property
+    def throughput(self):
+        """Number of lines processed per second."""
+        if self.started is None:
+            return 0
+        end = self.finished or timezone.now()
+        elapsed = (end - self.started).total_seconds()
+        if elapsed <= 0:
+            return 0
+        return round(self.processed / elapsed, 1)
+
+    def to_dict(self):
+        """Return the state of this job (used by the status view)."""
+        return {
+            "id": self.pk, "status": self.status, "total": self.total,
+            "processed": self.processed, "imported": self.imported,
+            "errors": self.nerrors, "throughput": self.throughput,
+            "message": self.message
+        }
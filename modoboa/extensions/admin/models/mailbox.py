@@ -4,7 +4,6 @@ import reversion
 from django.db import models
 from django.db.models import Q
 from django.db.models.manager import Manager
-from django.contrib.contenttypes.models import ContentType
 from django.utils.translation import ugettext as _, ugettext_lazy
 from django.db.models.signals import pre_delete
 from django.dispatch import receiver
@@ -36,14 +35,15 @@ class MailboxManager(Manager):
                 qf = Q(address__contains=addrfilter) & Q(domain__name__contains=domfilter)
             else:
                 qf = Q(address__contains=squery) | Q(domain__name__contains=squery)
-        ids = admin.objectaccess_set \
-            .filter(content_type=ContentType.objects.get_for_model(Mailbox)) \
-            .values_list('object_id', flat=True)
-        if qf is not None:
-            qf = Q(pk__in=ids) & qf
+        if admin.is_superuser:
+            qset = self.get_query_set()
         else:
-            qf = Q(pk__in=ids)
-        return self.get_query_set().filter(qf)
+            qset = self.get_query_set().filter(
+                admin.get_administered_filter(self.model)
+            )
+        if qf is not None:
+            qset = qset.filter(qf)
+        return qset
 
 
 class Mailbox(AdminObject):
@@ -244,7 +244,8 @@ def mailbox_deleted_handler(sender, **kwargs):
     orphan records into the db), we define this custom receiver.
 
     It manually removes the mailbox from the aliases it is linked to
-    and then remove all empty aliases.
+    and then remove all empty aliases. The type of other aliases is
+    updated.
     """
     from modoboa.lib.permissions import ungrant_access_to_object
 
@@ -255,6 +256,8 @@ def mailbox_deleted_handler(sender, **kwargs):
         alias.mboxes.remove(mb)
         if alias.mboxes.count() == 0:
             alias.delete()
+        else:
+            alias.update_type()
 
 
 class Quota(models.Model):
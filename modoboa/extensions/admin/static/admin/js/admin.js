@@ -122,7 +122,12 @@ Admin.prototype = {
     },
 
     importdone: function(status, msg) {
+        if (status == "queued") {
+            this.import_poll(msg);
+            return;
+        }
         $("#import_status").css("display", "none");
+        $("#import_progress").html("");
         if (status == "ok") {
             $("#modalbox").modal('hide');
             this.reload_listing(msg);
@@ -133,6 +138,35 @@ Admin.prototype = {
         }
     },
 
+    /*
+     * Follow the progress of a queued import job until it is finished.
+     */
+    import_poll: function(url) {
+        var instance = this;
+
+        $.ajax({
+            url: url,
+            dataType: "json",
+            cache: false
+        }).done(function(data) {
+            if (data.status == "pending" || data.status == "running") {
+                if (data.status == "running") {
+                    $("#import_progress").html(interpolate(
+                        gettext("%s/%s lines, %s errors (%s lines/s)"),
+                        [data.processed, data.total, data.errors,
+                         data.throughput]
+                    ));
+                }
+                setTimeout(function() { instance.import_poll(url); }, 2000);
+                return;
+            }
+            instance.importdone(
+                (data.status == "done" && !data.errors) ? "ok" : "ko",
+                data.message
+            );
+        });
+    },
+
     exportform_cb: function() {
         $(".submit").one('click', function(e) {
             e.preventDefault();
@@ -2,13 +2,16 @@ from .domain import DomainTestCase
 from .domain_alias import DomainAliasTestCase
 from .account import AccountTestCase, PermissionsTestCase
 from .alias import AliasTestCase
-from .import_ import ImportTestCase
+from .import_ import ImportTestCase, BatchFailureTestCase
 from .export import ExportTestCase
 from .password_schemes import PasswordSchemesTestCase
 from .user import ForwardTestCase
+from .identity import IdentitiesTestCase
 
 __all__ = [
     'DomainTestCase', 'DomainAliasTestCase', 'AccountTestCase',
     'PermissionsTestCase', 'AliasTestCase', 'ImportTestCase',
-    'ExportTestCase', 'PasswordSchemesTestCase', 'ForwardTestCase'
+    'BatchFailureTestCase',
+    'ExportTestCase', 'PasswordSchemesTestCase', 'ForwardTestCase',
+    'IdentitiesTestCase'
 ]
@@ -1,6 +1,9 @@
 from django.core.urlresolvers import reverse
 from modoboa.core.models import User
-from modoboa.lib.tests import ModoTestCase
+from modoboa.lib.permissions import (
+    grant_access_to_object, ungrant_access_to_object
+)
+from modoboa.lib.tests import ModoTestCase, QueriesCounter
 from modoboa.extensions.admin.models import (
     Domain, Mailbox
 )
@@ -152,6 +155,56 @@ class PermissionsTestCase(ModoTestCase):
         admin = User.objects.get(username="admin@test.com")
         self.assertEqual(admin.group, "DomainAdmins")
 
+    def test_access_index(self):
+        """Check that access checks are memoised until access entries
+        change
+        """
+        admin = User.objects.get(username="admin@test.com")
+        domain = Domain.objects.get(name="test2.com")
+        mb = Mailbox.objects.get(address="user", domain__name="test.com")
+        self.assertTrue(admin.can_access(mb))
+        self.assertFalse(admin.can_access(domain))
+        self.assertFalse(admin.is_owner(mb))
+        with QueriesCounter() as counter:
+            for cpt in range(10):
+                admin.can_access(mb)
+                admin.can_access(domain)
+                admin.is_owner(mb)
+        self.assertEqual(counter.count, 0)
+
+        grant_access_to_object(admin, domain)
+        self.assertTrue(admin.can_access(domain))
+        ungrant_access_to_object(mb, admin)
+        self.assertFalse(admin.can_access(mb))
+
+    def test_role_cache(self):
+        """Check that roles are resolved once per instance
+        """
+        account = User.objects.get(username="admin@test.com")
+        self.assertEqual(account.group, "DomainAdmins")
+        with QueriesCounter() as counter:
+            account.group
+        self.assertEqual(counter.count, 0)
+
+        with QueriesCounter() as counter:
+            roles = dict(
+                (u.username, u.group)
+                for u in User.objects.with_role().all()
+            )
+        self.assertEqual(counter.count, 1)
+        self.assertEqual(roles["admin"], "SuperAdmins")
+        self.assertEqual(roles["user@test.com"], "SimpleUsers")
+        with QueriesCounter() as counter:
+            roles = dict(
+                (u.username, u.group)
+                for u in User.objects.prefetch_related("groups")
+            )
+        self.assertEqual(counter.count, 2)
+        self.assertEqual(roles["admin@test.com"], "DomainAdmins")
+
+        User.objects.get(username="admin@test.com").set_role("SimpleUsers")
+        self.assertEqual(account.group, "SimpleUsers")
+
     def test_domadmin_access(self):
         self.clt.logout()
         self.assertEqual(self.clt.login(username="admin@test.com", password="toto"),
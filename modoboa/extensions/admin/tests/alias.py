@@ -2,7 +2,7 @@ from django.core.urlresolvers import reverse
 from modoboa.core.models import User
 from modoboa.lib.tests import ModoTestCase
 from modoboa.extensions.admin.models import (
-    Alias
+    Alias, Domain, Mailbox
 )
 from modoboa.extensions.admin import factories
 
@@ -52,6 +52,7 @@ class AliasTestCase(ModoTestCase):
 
         dlist = Alias.objects.get(address="all", domain__name="test.com")
         self.assertEqual(len(dlist.get_recipients()), 3)
+        self.assertEqual(dlist.type, "dlist")
         del values["recipients_1"]
         self.ajax_post(
             reverse("modoboa.extensions.admin.views.alias.editalias",
@@ -60,6 +61,14 @@ class AliasTestCase(ModoTestCase):
         )
         self.assertEqual(dlist.get_recipients_count(), 2)
 
+        del values["recipients_2"]
+        self.ajax_post(
+            reverse("modoboa.extensions.admin.views.alias.editalias",
+                    args=[dlist.id]),
+            values
+        )
+        self.assertEqual(Alias.objects.get(pk=dlist.id).type, "alias")
+
         self.ajax_post(
             reverse("modoboa.extensions.admin.views.alias.delalias") + "?selection=%d" \
                 % dlist.id, {}
@@ -67,6 +76,28 @@ class AliasTestCase(ModoTestCase):
         self.assertRaises(Alias.DoesNotExist, Alias.objects.get,
                           address="all", domain__name="test.com")
 
+    def test_type_after_mailbox_removal(self):
+        dom = Domain.objects.get(name="test.com")
+        dlist = factories.AliasFactory.create(address="all", domain=dom)
+        dlist.save(int_rcpts=list(Mailbox.objects.filter(domain=dom)))
+        self.assertEqual(Alias.objects.get(pk=dlist.id).type, "dlist")
+        Mailbox.objects.get(address="admin", domain=dom).delete()
+        self.assertEqual(Alias.objects.get(pk=dlist.id).type, "alias")
+
+    def test_type_after_alias_removal(self):
+        dom = Domain.objects.get(name="test.com")
+        alias = factories.AliasFactory.create(address="user.alias", domain=dom)
+        alias.save(int_rcpts=[Mailbox.objects.get(address="user", domain=dom)])
+        dlist = factories.AliasFactory.create(address="all", domain=dom)
+        dlist.save(int_rcpts=[
+            alias, Mailbox.objects.get(address="admin", domain=dom)
+        ])
+        self.assertEqual(Alias.objects.get(pk=dlist.id).type, "dlist")
+        alias.delete()
+        dlist = Alias.objects.get(pk=dlist.id)
+        self.assertEqual(dlist.type, "alias")
+        self.assertEqual(dlist.get_recipients(), ["admin@test.com"])
+
     def test_forward(self):
         values = dict(email="forward2@test.com", recipients="rcpt@dest.com")
         self.ajax_post(
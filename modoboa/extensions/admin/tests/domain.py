@@ -1,9 +1,10 @@
 from django.core.urlresolvers import reverse
 from modoboa.core.models import User
 from modoboa.lib import parameters
-from modoboa.lib.tests import ModoTestCase
+from modoboa.lib.permissions import grant_access_to_object
+from modoboa.lib.tests import ModoTestCase, QueriesCounter
 from modoboa.extensions.admin.models import (
-    Domain, Alias
+    Domain, Alias, Mailbox
 )
 from modoboa.extensions.admin import factories
 
@@ -112,3 +113,84 @@ class DomainTestCase(ModoTestCase):
         )
         with self.assertRaises(Domain.DoesNotExist):
             Domain.objects.get(pk=1)
+
+    def test_add_remove_admin(self):
+        """Check that the number of queries does not depend on the
+        number of mailboxes
+        """
+        dom = Domain.objects.get(name="test.com")
+        for cpt in range(20):
+            account = factories.UserFactory.create(
+                username="user%d@test.com" % cpt, groups=("SimpleUsers",)
+            )
+            factories.MailboxFactory.create(
+                address="user%d" % cpt, domain=dom, user=account
+            )
+        newadmin = factories.UserFactory.create(
+            username="newadmin@test.com", groups=("DomainAdmins",)
+        )
+        with QueriesCounter() as counter:
+            dom.add_admin(newadmin)
+        self.assertLess(counter.count, 20)
+        self.assertIn(newadmin, dom.admins)
+        account = User.objects.get(username="user19@test.com")
+        self.assertTrue(newadmin.can_access(account))
+        self.assertTrue(newadmin.can_access(account.mailbox_set.all()[0]))
+        self.assertTrue(newadmin.can_access(
+            Alias.objects.get(address="forward", domain=dom)
+        ))
+        self.assertFalse(newadmin.can_access(
+            User.objects.get(username="admin")
+        ))
+
+        with QueriesCounter() as counter:
+            dom.remove_admin(newadmin)
+        self.assertLess(counter.count, 20)
+        self.assertNotIn(newadmin, dom.admins)
+        self.assertFalse(newadmin.can_access(account))
+        self.assertFalse(newadmin.can_access(account.mailbox_set.all()[0]))
+        domadmin = User.objects.get(username="admin@test.com")
+        self.assertTrue(domadmin.can_access(account))
+
+    def test_get_for_admin(self):
+        """Check the objects returned by get_for_admin
+
+        Domains are selected using the membership index of the admin
+        (loaded once until access entries change) and a mailbox an
+        admin has been given access to is returned even if it does not
+        belong to one of its domains.
+        """
+        admin = User.objects.get(username="admin@test.com")
+        self.assertEqual(
+            [dom.name for dom in Domain.objects.get_for_admin(admin)],
+            ["test.com"]
+        )
+        with QueriesCounter() as counter:
+            list(Domain.objects.get_for_admin(admin))
+        self.assertEqual(counter.count, 1)
+        # Large indexes are used through a subquery
+        max_inline_ids = User.MAX_INLINE_IDS
+        User.MAX_INLINE_IDS = 0
+        try:
+            self.assertEqual(
+                [dom.name for dom in Domain.objects.get_for_admin(admin)],
+                ["test.com"]
+            )
+        finally:
+            User.MAX_INLINE_IDS = max_inline_ids
+        mb = Mailbox.objects.get(address="user", domain__name="test2.com")
+        grant_access_to_object(admin, mb)
+        self.assertEqual(
+            list(Mailbox.objects.get_for_admin(admin)
+                 .filter(domain__name="test2.com")),
+            [mb]
+        )
+        Domain.objects.get(name="test2.com").add_admin(admin)
+        self.assertEqual(
+            [dom.name for dom in Domain.objects.get_for_admin(admin)],
+            ["test.com", "test2.com"]
+        )
+        self.assertTrue(
+            Mailbox.objects.get_for_admin(admin)
+            .filter(domain__name="test2.com").exists()
+        )
@@ -1,6 +1,7 @@
 from django.core.urlresolvers import reverse
-from modoboa.lib.tests import ModoTestCase
+from modoboa.lib.tests import ModoTestCase, QueriesCounter
 from modoboa.extensions.admin import factories
+from modoboa.extensions.admin.models import Domain, Mailbox
 
 
 class ExportTestCase(ModoTestCase):
@@ -15,10 +16,11 @@ class ExportTestCase(ModoTestCase):
             reverse("modoboa.extensions.admin.views.identity._identities") \
                 + "?grpfilter=%s&idtfilter=%s" % (grpfilter, idtfilter)
         )
-        return self.clt.post(
+        response = self.clt.post(
             reverse("modoboa.extensions.admin.views.export.export_identities"),
             {"filename": "test.csv"}
         )
+        return "".join(response.streaming_content)
 
     def assertListEqual(self, list1, list2):
         list2 = list2.split('\r\n')
@@ -28,56 +30,87 @@ class ExportTestCase(ModoTestCase):
             self.assertIn(entry, list2)
 
     def test_export_identities(self):
-        response = self.__export_identities()
+        content = self.__export_identities()
         self.assertListEqual(
             "account;admin;{CRYPT}dTTsGDkA5ZHKg;;;True;SuperAdmins;;\r\naccount;admin@test.com;{PLAIN}toto;;;True;DomainAdmins;admin@test.com;10;test.com\r\naccount;admin@test2.com;{PLAIN}toto;;;True;DomainAdmins;admin@test2.com;10;test2.com\r\naccount;user@test.com;{PLAIN}toto;;;True;SimpleUsers;user@test.com;10\r\naccount;user@test2.com;{PLAIN}toto;;;True;SimpleUsers;user@test2.com;10\r\nalias;alias@test.com;True;user@test.com\r\nforward;forward@test.com;True;user@external.com\r\ndlist;postmaster@test.com;True;toto@titi.com;test@truc.fr\r\n",
-            response.content.strip()
+            content.strip()
         )
 
     def test_export_simpleusers(self):
-        response = self.__export_identities(
+        content = self.__export_identities(
             idtfilter="account", grpfilter="SimpleUsers"
         )
         self.assertListEqual(
             "account;user@test.com;{PLAIN}toto;;;True;SimpleUsers;user@test.com;10\r\naccount;user@test2.com;{PLAIN}toto;;;True;SimpleUsers;user@test2.com;10", 
-            response.content.strip()
+            content.strip()
         )
 
     def test_export_superadmins(self):
-        response = self.__export_identities(
+        content = self.__export_identities(
             idtfilter="account", grpfilter="SuperAdmins"
         )
         self.assertEqual(
-            response.content.strip(),
+            content.strip(),
             "account;admin;{CRYPT}dTTsGDkA5ZHKg;;;True;SuperAdmins;;"
         )
 
     def test_export_domainadmins(self):
-        response = self.__export_identities(
+        content = self.__export_identities(
             idtfilter="account", grpfilter="DomainAdmins"
         )
         self.assertListEqual(
             "account;admin@test.com;{PLAIN}toto;;;True;DomainAdmins;admin@test.com;10;test.com\r\naccount;admin@test2.com;{PLAIN}toto;;;True;DomainAdmins;admin@test2.com;10;test2.com",
-            response.content.strip()
+            content.strip()
         )
 
     def test_export_aliases(self):
-        response = self.__export_identities(idtfilter="alias")
+        content = self.__export_identities(idtfilter="alias")
         self.assertEqual(
-            response.content.strip(),
+            content.strip(),
             "alias;alias@test.com;True;user@test.com"
         )
 
     def test_export_forwards(self):
-        response = self.__export_identities(idtfilter="forward")
+        content = self.__export_identities(idtfilter="forward")
         self.assertEqual(
-            response.content.strip(),
+            content.strip(),
             "forward;forward@test.com;True;user@external.com"
         )
 
     def test_export_dlists(self):
-        response = self.__export_identities(idtfilter="dlist")
+        content = self.__export_identities(idtfilter="dlist")
         self.assertEqual(
-            response.content.strip(),
+            content.strip(),
             "dlist;postmaster@test.com;True;toto@titi.com;test@truc.fr"
         )
+
+    def test_export_domains(self):
+        self.clt.get(reverse("modoboa.extensions.admin.views.domain._domains"))
+        response = self.clt.post(
+            reverse("modoboa.extensions.admin.views.export.export_domains"),
+            {"filename": "test.csv"}
+        )
+        self.assertListEqual(
+            "domain;test.com;10;True\r\ndomain;test2.com;0;True\r\n",
+            "".join(response.streaming_content).strip()
+        )
+
+    def test_export_constant_queries(self):
+        """Check that the number of queries does not depend on the
+        number of identities
+        """
+        with QueriesCounter() as counter:
+            self.__export_identities(idtfilter="dlist")
+        first = counter.count
+        dom = Domain.objects.get(name="test.com")
+        mb = Mailbox.objects.get(address="user", domain=dom)
+        for cpt in range(10):
+            alias = factories.AliasFactory.create(
+                address="list%d" % cpt, domain=dom
+            )
+            alias.save(int_rcpts=[mb], ext_rcpts=["ext@titi.com"])
+        with QueriesCounter() as counter:
+            content = self.__export_identities(idtfilter="dlist")
+        self.assertIn("dlist;list9@test.com;True;user@test.com;ext@titi.com",
+                      content)
+        self.assertEqual(counter.count, first)
@@ -0,0 +1,84 @@
+from django.core.urlresolvers import reverse
+from modoboa.core.models import User
+from modoboa.lib import parameters
+from modoboa.lib.tests import ModoTestCase, QueriesCounter
+from modoboa.extensions.admin import factories
+from modoboa.extensions.admin.lib import get_identities
+from modoboa.extensions.admin.models import Domain
+
+
+class IdentitiesTestCase(ModoTestCase):
+    fixtures = ["initial_users.json"]
+
+    def setUp(self):
+        super(IdentitiesTestCase, self).setUp()
+        factories.populate_database()
+        self.user = User.objects.get(username="admin")
+
+    def test_sort(self):
+        identities = get_identities(self.user)
+        self.assertEqual(identities.count(), 8)
+        self.assertEqual(
+            [ident.identity for ident in identities],
+            ["admin", "admin@test.com", "admin@test2.com", "alias@test.com",
+             "forward@test.com", "postmaster@test.com", "user@test.com",
+             "user@test2.com"]
+        )
+        self.assertEqual(
+            [ident.name_or_rcpt
+             for ident in identities.order_by("-name_or_rcpt")[:3]],
+            ["user@test.com", "user@external.com", "toto@titi.com, ..."]
+        )
+        self.assertEqual(
+            [ident.identity for ident in identities.order_by(
+                "idtype", "role", "identity")][:5],
+            ["admin@test.com", "admin@test2.com", "user@test.com",
+             "user@test2.com", "admin"]
+        )
+
+    def test_filters(self):
+        identities = get_identities(self.user, idtfilter="forward")
+        self.assertEqual(
+            [ident.identity for ident in identities], ["forward@test.com"]
+        )
+        identities = get_identities(self.user, idtfilter="dlist")
+        self.assertEqual(
+            [ident.identity for ident in identities], ["postmaster@test.com"]
+        )
+        identities = get_identities(
+            self.user, idtfilter="account", grpfilter="SimpleUsers"
+        )
+        self.assertEqual(
+            [ident.identity for ident in identities],
+            ["user@test.com", "user@test2.com"]
+        )
+
+    def _count_listing_queries(self):
+        with QueriesCounter() as counter:
+            response = self.ajax_get(
+                reverse("modoboa.extensions.admin.views.identity._identities"),
+                {}
+            )
+        return counter.count, response
+
+    def test_constant_queries(self):
+        """Check that the cost of a page does not depend on its size
+        """
+        parameters.save_admin("ITEMS_PER_PAGE", 50, app="core")
+        self._count_listing_queries()
+        first, response = self._count_listing_queries()
+        dom = Domain.objects.get(name="test.com")
+        for cpt in range(10):
+            account = factories.UserFactory.create(
+                username="user%d@test.com" % cpt, groups=("SimpleUsers",)
+            )
+            mb = factories.MailboxFactory.create(
+                address="user%d" % cpt, domain=dom, user=account
+            )
+            alias = factories.AliasFactory.create(
+                address="alias%d" % cpt, domain=dom
+            )
+            alias.mboxes.add(mb)
+        second, response = self._count_listing_queries()
+        self.assertIn("alias9@test.com", response["table"])
+        self.assertEqual(first, second)
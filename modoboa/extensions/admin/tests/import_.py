@@ -1,12 +1,22 @@
 # coding: utf-8
+import csv
+import datetime
+import json
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
 from django.core.files.base import ContentFile
+from django.test import TransactionTestCase
+from django.utils import timezone
+from modoboa.core.extensions import exts_pool
 from modoboa.core.models import User
-from modoboa.lib.tests import ModoTestCase
+from modoboa.lib import events
+from modoboa.lib.exceptions import BadRequest
+from modoboa.lib.tests import ModoTestCase, QueriesCounter
 from modoboa.extensions.admin.models import (
-    Domain, Alias, DomainAlias
+    Domain, Alias, DomainAlias, ImportJob
 )
 from modoboa.extensions.admin import factories
+from modoboa.extensions.admin.importer import CSVImporter
 
 
 class ImportTestCase(ModoTestCase):
@@ -16,12 +26,26 @@ class ImportTestCase(ModoTestCase):
         super(ImportTestCase, self).setUp()
         factories.populate_database()
 
+    def _import(self, url, data):
+        """Queue an import job, process it and return its final state.
+        """
+        response = self.clt.post(url, data)
+        self.assertIn('importdone("queued"', response.content)
+        call_command("process_import_jobs")
+        job = ImportJob.objects.latest("id")
+        response = self.clt.get(
+            reverse("modoboa.extensions.admin.views.import.import_status",
+                    args=[job.pk])
+        )
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
     def test_domains_import(self):
         f = ContentFile(b"""domain; domain1.com; 100; True
 domain; domain2.com; 200; False
 domainalias; domalias1.com; domain1.com; True
 """, name="domains.csv")
-        self.clt.post(
+        self._import(
             reverse("modoboa.extensions.admin.views.import.import_domains"), {
                 "sourcefile": f
             }
@@ -44,12 +68,12 @@ domainalias; domalias1.com; domain1.com; True
         f = ContentFile(b"""domain;test.alias;10;True
 domainalias;test.alias;test.com;True
 """, name="domains.csv")
-        resp = self.clt.post(
+        state = self._import(
             reverse("modoboa.extensions.admin.views.import.import_domains"), {
                 "sourcefile": f
             }
         )
-        self.assertIn('Object already exists: domainalias', resp.content)
+        self.assertIn('Object already exists: domainalias', state["message"])
 
     def test_identities_import(self):
         f = ContentFile(b"""
@@ -59,7 +83,7 @@ alias; alias1@test.com; True; user1@test.com
 forward; fwd1@test.com; True; user@extdomain.com
 dlist; dlist@test.com; True; user1@test.com; user@extdomain.com
 """, name="identities.csv")
-        self.clt.post(
+        self._import(
             reverse("modoboa.extensions.admin.views.import.import_identities"),
             {"sourcefile": f, "crypt_password": True}
         )
@@ -107,11 +131,11 @@ dlist; dlist@test.com; True; user1@test.com; user@extdomain.com
         f = ContentFile(b"""
 account; user1@test.com; toto; User; One; True; SimpleUsers; user1@test.com; ; test.com
 """, name="identities.csv")
-        resp = self.clt.post(
+        state = self._import(
             reverse("modoboa.extensions.admin.views.import.import_identities"),
             {"sourcefile": f, "crypt_password": True}
         )
-        self.assertIn('wrong quota value', resp.content)
+        self.assertIn('wrong quota value', state["message"])
 
     def test_import_quota_too_big(self):
         self.clt.logout()
@@ -119,17 +143,17 @@ account; user1@test.com; toto; User; One; True; SimpleUsers; user1@test.com; ; t
         f = ContentFile(b"""
 account; user1@test.com; toto; User; One; True; SimpleUsers; user1@test.com; 20
 """, name="identities.csv")
-        resp = self.clt.post(
+        state = self._import(
             reverse("modoboa.extensions.admin.views.import.import_identities"),
             {"sourcefile": f, "crypt_password": True}
         )
-        self.assertIn('Quota is greater than the allowed', resp.content)
+        self.assertIn('Quota is greater than the allowed', state["message"])
 
     def test_import_missing_quota(self):
         f = ContentFile(b"""
 account; user1@test.com; toto; User; One; True; SimpleUsers; user1@test.com
 """, name="identities.csv")
-        resp = self.clt.post(
+        state = self._import(
             reverse("modoboa.extensions.admin.views.import.import_identities"),
             {"sourcefile": f, "crypt_password": True}
         )
@@ -144,7 +168,7 @@ account; user1@test.com; toto; User; One; True; SimpleUsers; user1@test.com
 account; admin@test.com; toto; Admin; ; True; DomainAdmins; admin@test.com; 0; test.com
 account; truc@test.com; toto; René; Truc; True; DomainAdmins; truc@test.com; 0; test.com
 """, name="identities.csv")
-        self.clt.post(
+        self._import(
             reverse("modoboa.extensions.admin.views.import.import_identities"),
             {"sourcefile": f, "crypt_password": True,
              "continue_if_exists": True}
@@ -163,7 +187,7 @@ account; truc@test.com; toto; René; Truc; True; DomainAdmins; truc@test.com; 0;
         f = ContentFile(b"""
 account; sa@test.com; toto; Super; Admin; True; SuperAdmins; superadmin@test.com; 50
 """, name="identities.csv")
-        self.clt.post(
+        self._import(
             reverse("modoboa.extensions.admin.views.import.import_identities"),
             {"sourcefile": f, "crypt_password": True,
              "continue_if_exists": True}
@@ -175,7 +199,7 @@ account; sa@test.com; toto; Super; Admin; True; SuperAdmins; superadmin@test.com
         f = ContentFile(b"""
 alias;user.alias@test.com;True;user@test.com;;;;;;;;;;;;;;;;
 """, name="identities.csv")
-        self.clt.post(
+        self._import(
             reverse("modoboa.extensions.admin.views.import.import_identities"),
             {"sourcefile": f, "crypt_password": True,
              "continue_if_exists": True}
@@ -184,3 +208,187 @@ alias;user.alias@test.com;True;user@test.com;;;;;;;;;;;;;;;;
             domain__name="test.com", address="user.alias"
         )
         self.assertEqual(alias.type, "alias")
+
+    def test_import_job(self):
+        """Check that imports are queued and that their progress can
+        be followed
+        """
+        f = ContentFile(b"""domain; domain1.com; 100; True
+domain; domain2.com; 200; False
+domain; test.com; 10; True
+""", name="domains.csv")
+        self.clt.post(
+            reverse("modoboa.extensions.admin.views.import.import_domains"),
+            {"sourcefile": f, "continue_if_exists": True}
+        )
+        job = ImportJob.objects.get(filename="domains.csv")
+        self.assertEqual(job.status, "pending")
+        self.assertEqual(job.total, 3)
+        self.assertTrue(job.get_options()["continue_if_exists"])
+        self.assertFalse(Domain.objects.filter(name="domain1.com").exists())
+
+        call_command("process_import_jobs")
+        job = ImportJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, "done")
+        self.assertEqual(job.processed, 3)
+        self.assertEqual(job.imported, 2)
+        self.assertEqual(job.nerrors, 0)
+        self.assertIsNotNone(job.finished)
+        self.assertEqual(job.content, "")
+        self.assertTrue(Domain.objects.filter(name="domain1.com").exists())
+
+        url = reverse("modoboa.extensions.admin.views.import.import_status",
+                      args=[job.pk])
+        self.clt.logout()
+        self.clt.login(username="admin@test.com", password="toto")
+        response = self.clt.get(url)
+        self.assertEqual(response.status_code, 404)
+
+    def test_stale_job(self):
+        """Check that jobs left by a crashed worker are marked as failed
+        """
+        user = User.objects.get(username="admin")
+        job = ImportJob.objects.create(
+            user=user, filename="accounts.csv", options="{}",
+            content="account; user1@test.com; secret; User; One; True",
+            status="running",
+            started=timezone.now() - datetime.timedelta(hours=2)
+        )
+        recent = ImportJob.objects.create(
+            user=user, filename="recent.csv", options="{}",
+            content="account; user2@test.com; secret; User; Two; True",
+            status="running", started=timezone.now()
+        )
+        call_command("process_import_jobs", timeout=3600)
+        job = ImportJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, "failed")
+        self.assertEqual(job.content, "")
+        self.assertIsNotNone(job.finished)
+        recent = ImportJob.objects.get(pk=recent.pk)
+        self.assertEqual(recent.status, "running")
+        self.assertNotEqual(recent.content, "")
+
+    def test_import_errors(self):
+        f = ContentFile(b"""
+account; user1@test.com; toto; User; One; True; SimpleUsers; user1@test.com; 0
+account; user2@test.com; toto; User; Two; True; SimpleUsers; user2@unknown.com; 0
+alias; alias1@test.com; True; unknown@test.com
+alias; alias2@test.com; True; user1@test.com
+""", name="identities.csv")
+        state = self._import(
+            reverse("modoboa.extensions.admin.views.import.import_identities"),
+            {"sourcefile": f, "crypt_password": True}
+        )
+        self.assertIn("Line 3: username and email fields must not differ",
+                      state["message"])
+        self.assertIn("Line 4: Local recipient unknown@test.com not found",
+                      state["message"])
+        self.assertIn("2 objects imported successfully", state["message"])
+        User.objects.get(username="user1@test.com")
+        al = Alias.objects.get(address="alias2", domain__name="test.com")
+        self.assertEqual(
+            al.get_recipients(), ["user1@test.com"]
+        )
+
+    def test_bulk_import(self):
+        """Check that the number of queries does not depend on the
+        number of accounts (except for the creation dates)
+        """
+        nb = 50
+        content = "".join(
+            "account; user%d@test.com; toto; User; %d; True; SimpleUsers; "
+            "user%d@test.com; 10\n" % (cpt, cpt, cpt) for cpt in range(nb)
+        )
+        content += "".join(
+            "dlist; list%d@test.com; True; user%d@test.com; user@test.com\n"
+            % (cpt, cpt) for cpt in range(nb)
+        )
+        f = ContentFile(content, name="identities.csv")
+        with QueriesCounter() as counter:
+            state = self._import(
+                reverse("modoboa.extensions.admin.views.import.import_identities"),
+                {"sourcefile": f}
+            )
+        self.assertIn("%d objects imported successfully" % (nb * 2),
+                      state["message"])
+        self.assertLess(counter.count, nb * 3)
+        admin = User.objects.get(username="admin")
+        domadmin = User.objects.get(username="admin@test.com")
+        account = User.objects.get(username="user%d@test.com" % (nb - 1))
+        self.assertEqual(account.group, "SimpleUsers")
+        self.assertTrue(admin.is_owner(account))
+        self.assertTrue(domadmin.can_access(account))
+        mb = account.mailbox_set.all()[0]
+        self.assertEqual(mb.quota, 10)
+        self.assertEqual(mb.quota_value.username, "user%d@test.com" % (nb - 1))
+        self.assertTrue(admin.is_owner(mb))
+        self.assertTrue(domadmin.can_access(mb))
+        dlist = Alias.objects.get(address="list0", domain__name="test.com")
+        self.assertEqual(dlist.type, "dlist")
+        self.assertEqual(dlist.get_recipients_count(), 2)
+        self.assertTrue(admin.is_owner(dlist))
+        self.assertTrue(domadmin.can_access(dlist))
+
+    def test_account_imported_event(self):
+        """Check that accounts are imported one at a time when another
+        extension observes the AccountImported event
+        """
+        calls = []
+
+        def account_imported(user, account, row):
+            calls.append((account.username, row[0].strip()))
+
+        events.register("AccountImported", account_imported)
+        try:
+            f = ContentFile(b"""
+account; user1@test.com; toto; User; One; True; SimpleUsers; user1@test.com; 0
+account; user2@test.com; toto; User; Two; True; SimpleUsers; user2@test.com; 0
+""", name="identities.csv")
+            state = self._import(
+                reverse("modoboa.extensions.admin.views.import.import_identities"),
+                {"sourcefile": f, "crypt_password": True}
+            )
+        finally:
+            events.unregister("AccountImported", account_imported)
+        self.assertIn("2 objects imported successfully", state["message"])
+        self.assertEqual(calls, [("user1@test.com", "user1@test.com"),
+                                 ("user2@test.com", "user2@test.com")])
+        account = User.objects.get(username="user2@test.com")
+        self.assertEqual(account.mailbox_set.count(), 1)
+
+
+class BatchFailureTestCase(TransactionTestCase):
+    fixtures = ["initial_users.json"]
+
+    def setUp(self):
+        exts_pool.get_extension("admin").load()
+        factories.populate_database()
+
+    def test_batch_failure(self):
+        """Check that the rows of a batch whose creation fails are
+        imported again one by one
+        """
+        def mailbox_created(user, mailbox):
+            if mailbox.address == "user2":
+                raise BadRequest("Rejected")
+
+        content = "".join(
+            "account; user%d@test.com; toto; User; %d; True; SimpleUsers; "
+            "user%d@test.com; 10\n" % (cpt, cpt, cpt) for cpt in range(1, 4)
+        )
+        importer = CSVImporter(
+            User.objects.get(username="admin"),
+            {"sepchar": ";", "crypt_password": False,
+             "continue_if_exists": False}
+        )
+        events.register("MailboxCreated", mailbox_created)
+        try:
+            importer.run(csv.reader(content.splitlines(True), delimiter=";"))
+        finally:
+            events.unregister("MailboxCreated", mailbox_created)
+        self.assertEqual(importer.count, 2)
+        self.assertEqual(importer.errors, ["Line 2: Rejected"])
+        User.objects.get(username="user3@test.com")
+        self.assertFalse(
+            User.objects.filter(username="user2@test.com").exists()
+        )
@@ -40,6 +40,7 @@ urlpatterns += patterns(
     'modoboa.extensions.admin.views.import',
     (r'^domains/import/$', 'import_domains'),
     (r'^identities/import/$', 'import_identities'),
+    (r'^imports/(?P<pk>\d+)/$', 'import_status'),
 )
 
 urlpatterns += patterns(
@@ -46,13 +46,9 @@ def _domains(request):
         request.user, **filters
     )
     if sort_order == 'name':
-        domainlist = sorted(
-            domainlist,
-            key=lambda d: getattr(d, sort_order), reverse=sort_dir == '-'
-        )
+        domainlist = domainlist.order_by("%sname" % sort_dir)
     else:
-        domainlist = sorted(domainlist, key=lambda d: d.tags[0],
-                            reverse=sort_dir == '-')
+        domainlist = domainlist.order_by("%stype" % sort_dir, "name")
     page = get_listing_page(domainlist, request.GET.get("page", 1))
     return render_to_json_response({
         "table": _render_to_string(request, 'admin/domains_table.html', {
@@ -1,7 +1,7 @@
 import csv
 import cStringIO
 from rfc6266 import build_header
-from django.http import HttpResponse
+from django.http import StreamingHttpResponse
 from django.shortcuts import render
 from django.core.urlresolvers import reverse
 from django.utils.translation import ugettext as _
@@ -14,17 +14,43 @@ from modoboa.extensions.admin.forms import (
 )
 
 
-def _export(content, filename):
-    """Export a csv file's content
+def _generate_csv(objects, sepchar, bufsize=65536):
+    """Generate CSV content from a list of objects
 
-    :param content: the content to export (string)
-    :param filename: the name that will appear into the response
-    :return: an ``HttpResponse`` object
+    Rows are produced by the ``to_csv`` method of each object and
+    returned by blocks of ``bufsize`` bytes (at least).
+
+    :param objects: an iterable of objects to export
+    :param str sepchar: the CSV separator
+    :param int bufsize: the minimum size of each block
+    """
+    fp = cStringIO.StringIO()
+    csvwriter = csv.writer(fp, delimiter=sepchar)
+    for obj in objects:
+        obj.to_csv(csvwriter)
+        if fp.tell() >= bufsize:
+            yield fp.getvalue()
+            fp.seek(0)
+            fp.truncate()
+    yield fp.getvalue()
+    fp.close()
+
+
+def _export(objects, form):
+    """Export a list of objects using the CSV format
+
+    The content is streamed: rows are sent as soon as they are
+    produced.
+
+    :param objects: the objects to export (a ``QuerySetUnion``)
+    :param form: a valid export form
+    :return: a ``StreamingHttpResponse`` object
     """
-    resp = HttpResponse(content)
-    resp["Content-Type"] = "text/csv"
-    resp["Content-Length"] = len(content)
-    resp["Content-Disposition"] = build_header(filename)
+    resp = StreamingHttpResponse(
+        _generate_csv(objects.iterator(), form.cleaned_data["sepchar"]),
+        content_type="text/csv"
+    )
+    resp["Content-Disposition"] = build_header(form.cleaned_data["filename"])
     return resp
 
 
@@ -44,13 +70,11 @@ def export_identities(request):
     if request.method == "POST":
         form = ExportIdentitiesForm(request.POST)
         form.is_valid()
-        fp = cStringIO.StringIO()
-        csvwriter = csv.writer(fp, delimiter=form.cleaned_data["sepchar"])
-        for ident in get_identities(request.user, **request.session['identities_filters']):
-            ident.to_csv(csvwriter)
-        content = fp.getvalue()
-        fp.close()
-        return _export(content, form.cleaned_data["filename"])
+        return _export(
+            get_identities(request.user,
+                           **request.session['identities_filters']),
+            form
+        )
 
     ctx["form"] = ExportIdentitiesForm()
     return render(request, "common/generic_modal_form.html", ctx)
@@ -70,14 +94,10 @@ def export_domains(request):
     if request.method == "POST":
         form = ExportDomainsForm(request.POST)
         form.is_valid()
-        fp = cStringIO.StringIO()
-        csvwriter = csv.writer(fp, delimiter=form.cleaned_data["sepchar"])
-        for dom in get_domains(request.user,
-                               **request.session['domains_filters']):
-            dom.to_csv(csvwriter)
-        content = fp.getvalue()
-        fp.close()
-        return _export(content, form.cleaned_data["filename"])
+        return _export(
+            get_domains(request.user, **request.session['domains_filters']),
+            form
+        )
 
     ctx["form"] = ExportDomainsForm()
     return render(request, "common/generic_modal_form.html", ctx)
@@ -38,11 +38,11 @@ def _identities(request):
     sort_order, sort_dir = get_sort_order(request.GET, "identity",
                                           ["identity", "name_or_rcpt", "tags"])
     if sort_order in ["identity", "name_or_rcpt"]:
-        objects = sorted(idents_list, key=lambda o: getattr(o, sort_order),
-                         reverse=sort_dir == '-')
+        objects = idents_list.order_by("%s%s" % (sort_dir, sort_order))
     else:
-        objects = sorted(idents_list, key=lambda o: o.tags[0],
-                         reverse=sort_dir == '-')
+        objects = idents_list.order_by(
+            "%sidtype" % sort_dir, "%srole" % sort_dir, "identity"
+        )
     page = get_listing_page(objects, request.GET.get("page", 1))
     return render_to_json_response({
         "table": _render_to_string(request, "admin/identities_table.html", {
@@ -1,35 +1,16 @@
-import csv
-import reversion
 from django.utils.translation import ugettext as _
-from django.shortcuts import render
+from django.shortcuts import render, get_object_or_404
 from django.core.urlresolvers import reverse
 from django.db import transaction
 from django.contrib.auth.decorators import (
     login_required, permission_required, user_passes_test
 )
 from modoboa.lib import events
-from modoboa.lib.exceptions import ModoboaException, Conflict
-from modoboa.core.models import User
-from modoboa.extensions.admin.models import (
-    Domain, DomainAlias, Alias
-)
+from modoboa.lib.webutils import render_to_json_response
+from modoboa.extensions.admin.models import ImportJob
 from modoboa.extensions.admin.forms import ImportIdentitiesForm, ImportDataForm
 
 
-@transaction.commit_on_success
-def import_domain(user, row, formopts):
-    """Specific code for domains import"""
-    dom = Domain()
-    dom.from_csv(user, row)
-
-
-@transaction.commit_on_success
-def import_domainalias(user, row, formopts):
-    """Specific code for domain aliases import"""
-    domalias = DomainAlias()
-    domalias.from_csv(user, row)
-
-
 @login_required
 @permission_required("admin.add_domain")
 @transaction.commit_on_success
@@ -61,89 +42,53 @@ def import_domains(request):
     return render(request, "admin/importform.html", ctx)
 
 
-@transaction.commit_on_success
-def import_account(user, row, formopts):
-    """Specific code for accounts import"""
-    account = User()
-    account.from_csv(user, row, formopts["crypt_password"])
-
-
-@transaction.commit_on_success
-def _import_alias(user, row, **kwargs):
-    """Specific code for aliases import"""
-    alias = Alias()
-    alias.from_csv(user, row, **kwargs)
-
-
-def import_alias(user, row, formopts):
-    _import_alias(user, row, expected_elements=4)
-
-
-def import_forward(user, row, formopts):
-    _import_alias(user, row, expected_elements=4)
-
-
-def import_dlist(user, row, formopts):
-    _import_alias(user, row)
-
-
-@reversion.create_revision()
 def importdata(request, formclass=ImportDataForm):
     """Generic import function
 
     As the process of importing data from a CSV file is the same
     whatever the type, we do a maximum of the work here.
 
+    The file is not imported here: an :class:`ImportJob` is queued
+    and processed later by the ``process_import_jobs`` command. The
+    returned page gives the url the client can poll to follow the
+    progress of the job.
+
     :param request: a ``Request`` instance
-    :param typ: a string indicating the object type being imported
+    :param formclass: the form used to validate the request
     :return: a ``Response`` instance
     """
     error = None
     form = formclass(request.POST, request.FILES)
     if form.is_valid():
+        sourcefile = request.FILES['sourcefile']
         try:
-            reader = csv.reader(request.FILES['sourcefile'],
-                                delimiter=form.cleaned_data['sepchar'])
-        except csv.Error as inst:
-            error = str(inst)
-
-        if error is None:
-            try:
-                cpt = 0
-                for row in reader:
-                    if not row:
-                        continue
-                    try:
-                        fct = globals()["import_%s" % row[0].strip()]
-                    except KeyError:
-                        fct = events.raiseQueryEvent(
-                            'ImportObject', row[0].strip()
-                        )
-                        if not fct:
-                            continue
-                        fct = fct[0]
-                    try:
-                        fct(request.user, row, form.cleaned_data)
-                    except Conflict:
-                        if form.cleaned_data["continue_if_exists"]:
-                            continue
-                        raise Conflict(
-                            _("Object already exists: %s"
-                              % form.cleaned_data['sepchar'].join(row[:2]))
-                        )
-                    cpt += 1
-                msg = _("%d objects imported successfully" % cpt)
-                return render(request, "admin/import_done.html", {
-                    "status": "ok", "msg": msg
-                })
-            except (ModoboaException), e:
-                error = str(e)
+            content = sourcefile.read().decode("utf-8")
+        except UnicodeDecodeError:
+            error = _("The file must be encoded using UTF-8")
+        else:
+            options = dict(form.cleaned_data)
+            del options["sourcefile"]
+            job = ImportJob(user=request.user, filename=sourcefile.name,
+                            content=content, total=len(content.splitlines()))
+            job.set_options(options)
+            job.save()
+            return render(request, "admin/import_done.html", {
+                "status": "queued",
+                "msg": reverse(import_status, args=[job.pk])
+            })
 
     return render(request, "admin/import_done.html", {
         "status": "ko", "msg": error
     })
 
 
+@login_required
+def import_status(request, pk):
+    """Return the state of an import job (JSON)."""
+    job = get_object_or_404(ImportJob, pk=pk, user=request.user)
+    return render_to_json_response(job.to_dict())
+
+
 @login_required
 @user_passes_test(
     lambda u: u.has_perm("core.add_user") or u.has_perm("admin.add_alias")
@@ -3,7 +3,10 @@ import socket
 import re
 import struct
 import string
+import threading
+import time
 from functools import wraps
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.utils.translation import ugettext as _
 from modoboa.lib import parameters
@@ -38,46 +41,266 @@ def selfservice(ssfunc=None):
     return decorator
 
 
-class AMrelease(object):
-    def __init__(self):
-        mode = parameters.get_admin("AM_PDP_MODE")
+REQUESTS_CACHE_PREFIX = "modoboa.amavis.requests"
+
+
+def _get_requests_cache_version():
+    key = "%s.version" % REQUESTS_CACHE_PREFIX
+    version = cache.get(key)
+    if version is None:
+        version = int(time.time() * 1000)
+        cache.add(key, version)
+    return version
+
+
+def get_pending_requests_count(user):
+    """Return the number of release requests visible by a user.
+
+    Counters are kept into the cache during
+    ``CHECK_REQUESTS_INTERVAL`` seconds (or until
+    :func:`reset_pending_requests_counters` is called) so polling
+    admins don't count requests again and again.
+
+    :param user: a ``User`` instance
+    :return: an integer
+    """
+    from .sql_listing import get_wrapper
+
+    key = "%s.%s.%d" % (
+        REQUESTS_CACHE_PREFIX, _get_requests_cache_version(), user.pk
+    )
+    count = cache.get(key)
+    if count is None:
+        count = get_wrapper().get_pending_requests(user)
+        cache.set(
+            key, count, int(parameters.get_admin("CHECK_REQUESTS_INTERVAL"))
+        )
+    return count
+
+
+def reset_pending_requests_counters():
+    """Invalidate the counters of every user."""
+    key = "%s.version" % REQUESTS_CACHE_PREFIX
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, int(time.time() * 1000))
+
+
+SEARCH_TERM_MAX_LENGTH = 64
+SEARCH_WEIGHTS = {"subject": 4, "from": 3, "to": 3, "alert": 2}
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def get_search_terms(value):
+    """Split a string into search terms.
+
+    Words are lowered and words of one character are ignored. Full
+    e-mail addresses (and their domain) are also returned so they can
+    be searched as is.
+
+    :param value: a string (or a buffer, for PostgreSQL bytea columns)
+    :return: a set of unicode strings
+    """
+    if not value:
+        return set()
+    if not isinstance(value, unicode):
+        value = str(value).decode("utf-8", "replace")
+    value = value.lower()
+    terms = set(word for word in WORD_RE.findall(value) if len(word) > 1)
+    for word in value.split():
+        word = word.strip("<>\"'(),;:")
+        if "@" in word:
+            terms.update([word, word.split("@", 1)[1]])
+    terms.discard("")
+    return set(term[:SEARCH_TERM_MAX_LENGTH] for term in terms)
+
+
+def get_query_terms(value):
+    """Return the terms to look for to find messages matching a
+    search pattern.
+
+    Full addresses and domains are indexed as is, so the words they
+    contain (frequent ones like "com" for example) are dropped: they
+    would select many more index rows without restricting the result.
+
+    :param value: a string
+    :return: a set of unicode strings
+    """
+    terms = get_search_terms(value)
+    for term in [term for term in terms if "@" in term]:
+        terms.difference_update(WORD_RE.findall(term))
+        terms.discard(term.split("@", 1)[1])
+    return terms
+
+
+class AMPDPConnection(object):
+    """A connection to amavisd (AM.PDP protocol).
+
+    Answers are read from an internal buffer so they are correctly
+    split whatever the size of the received packets is.
+    """
+
+    def __init__(self, address, timeout=None):
+        family = socket.AF_UNIX if isinstance(address, basestring) \
+            else socket.AF_INET
+        self.address = address
+        self.buffer = ""
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        if timeout is not None:
+            self.sock.settimeout(timeout)
         try:
-            if mode == "inet":
-                host = parameters.get_admin('AM_PDP_HOST')
-                port = parameters.get_admin('AM_PDP_PORT')
-                self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.sock.connect((host, int(port)))
+            self.sock.connect(address)
+        except socket.error:
+            self.sock.close()
+            raise
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def read_answer(self):
+        """Read one answer (attributes are terminated by an empty line).
+
+        :return: the answer (a string)
+        """
+        while "\n\n" not in self.buffer:
+            data = self.sock.recv(4096)
+            if not data:
+                raise socket.error("connection closed by amavisd")
+            self.buffer += data
+        answer, self.buffer = self.buffer.split("\n\n", 1)
+        return answer
+
+    def close(self):
+        self.sock.close()
+
+
+class AMrelease(object):
+    """Release messages using the AM.PDP protocol.
+
+    Connections to amavisd are kept open (and shared by all the
+    instances of a process) so they can be reused by the next
+    requests. Requests are pipelined: they are sent by batches of
+    ``batch_size`` and answers are read afterwards.
+
+    :param address: a (host, port) tuple or the path of a UNIX socket
+                    (read from the parameters by default)
+    """
+    batch_size = 100
+    max_idle = 4
+    timeout = 30
+
+    _idle = {}
+    _lock = threading.Lock()
+
+    def __init__(self, address=None):
+        if address is None:
+            if parameters.get_admin("AM_PDP_MODE") == "inet":
+                address = (parameters.get_admin('AM_PDP_HOST'),
+                           int(parameters.get_admin('AM_PDP_PORT')))
             else:
-                path = parameters.get_admin('AM_PDP_SOCKET')
-                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-                self.sock.connect(path)
+                address = parameters.get_admin('AM_PDP_SOCKET')
+        self.address = address
+
+    @classmethod
+    def close_connections(cls):
+        """Close all idle connections."""
+        with cls._lock:
+            for connections in cls._idle.values():
+                for conn in connections:
+                    conn.close()
+            cls._idle = {}
+
+    def _connect(self):
+        try:
+            return AMPDPConnection(self.address, self.timeout)
         except socket.error, err:
             raise InternalError(
                 _("Connection to amavis failed: %s" % str(err))
             )
 
+    def _get_connection(self):
+        """Return an idle connection or a new one.
+
+        :return: a tuple (connection, reused)
+        """
+        with self._lock:
+            connections = self._idle.get(self.address)
+            if connections:
+                return connections.pop(), True
+        return self._connect(), False
+
+    def _release_connection(self, conn):
+        with self._lock:
+            connections = self._idle.setdefault(self.address, [])
+            if len(connections) < self.max_idle and not conn.buffer:
+                connections.append(conn)
+                return
+        conn.close()
+
     def decode(self, answer):
         def repl(match):
             return struct.pack("B", string.atoi(match.group(0)[1:], 16))
 
         return re.sub(r"%([0-9a-fA-F]{2})", repl, answer)
 
-    def __del__(self):
-        self.sock.close()
+    def encode(self, value):
+        """Encode an attribute value (special characters are sent as %XX)."""
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        return re.sub(
+            r"[^\x21-\x7e]|%",
+            lambda match: "%%%02X" % ord(match.group(0)), value
+        )
+
+    def _exchange(self, conn, batch, results):
+        conn.send("".join([
+            "request=release\nmail_id=%s\nsecret_id=%s\nquar_type=Q\n"
+            "recipient=%s\n\n" % tuple(self.encode(v) for v in req[:3])
+            for req in batch
+        ]))
+        for req in batch:
+            answer = self.decode(conn.read_answer())
+            results.append(
+                re.search(r"250 [\d\.]+ Ok", answer) is not None
+            )
+
+    def _send_batch(self, batch):
+        conn, reused = self._get_connection()
+        results = []
+        try:
+            self._exchange(conn, batch, results)
+        except socket.error:
+            conn.close()
+            if not reused or results:
+                # Requests may have been processed: don't send them
+                # again
+                return results + [False] * (len(batch) - len(results))
+            # The idle connection has probably been closed by amavisd
+            conn = self._connect()
+            try:
+                self._exchange(conn, batch, results)
+            except socket.error:
+                conn.close()
+                return results + [False] * (len(batch) - len(results))
+        self._release_connection(conn)
+        return results
+
+    def release_many(self, requests):
+        """Release several messages.
+
+        :param requests: a list of (mail_id, secret_id, recipient) tuples
+        :return: a list of booleans (True if the corresponding message
+                 has been released)
+        """
+        results = []
+        for pos in range(0, len(requests), self.batch_size):
+            results += self._send_batch(requests[pos:pos + self.batch_size])
+        return results
 
     def sendreq(self, mailid, secretid, recipient, *others):
-        self.sock.send("""request=release
-mail_id=%s
-secret_id=%s
-quar_type=Q
-recipient=%s
-
-""" % (mailid, secretid, recipient))
-        answer = self.sock.recv(1024)
-        answer = self.decode(answer)
-        if re.search("250 [\d\.]+ Ok", answer):
-            return True
-        return False
+        return self.release_many([(mailid, secretid, recipient)])[0]
+
 
 
 class QuarantineNavigationParameters(NavigationParameters):
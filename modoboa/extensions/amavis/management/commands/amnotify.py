@@ -1,20 +1,25 @@
 #!/usr/bin/env python
 # coding: utf-8
+import smtplib
+import socket
+from email.mime.text import MIMEText
 from optparse import make_option
 from django import db
+from django.contrib.contenttypes.models import ContentType
 from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
 from django.template.loader import render_to_string
 from django.core.urlresolvers import reverse
 from django.utils.translation import ugettext as _
-from modoboa.core.models import User
+from modoboa.core.models import User, ObjectAccess
 from modoboa.lib import parameters
-from modoboa.lib.emailutils import sendmail_simple
-from modoboa.extensions.admin.models import Domain
+from modoboa.lib.emailutils import set_email_headers
+from modoboa.extensions.admin.models import Domain, Mailbox
 from modoboa.extensions.amavis import Amavis
 from modoboa.extensions.amavis.models import (
     Msgrcpt
 )
-from modoboa.extensions.amavis.sql_listing import get_wrapper
+from modoboa.extensions.amavis.sql_listing import reverse_domain_names
 
 
 class Command(BaseCommand):
@@ -23,6 +28,7 @@ class Command(BaseCommand):
     sender = None
     baseurl = None
     listingurl = None
+    sketch_size = 10
 
     option_list = BaseCommand.option_list + (
         make_option("--baseurl", type="string", default=None,
@@ -39,29 +45,119 @@ class Command(BaseCommand):
         if options["baseurl"] is None:
             raise CommandError("You must provide the --baseurl option")
         self.options = options
+        self.connection = None
         Amavis().load()
-        self.notify_admins_pending_requests()
+        try:
+            self.notify_admins_pending_requests()
+        finally:
+            self.disconnect()
 
-    def send_pr_notification(self, rcpt, reqs):
+    def connect(self):
+        return smtplib.SMTP(
+            self.options["smtp_host"], self.options["smtp_port"]
+        )
+
+    def disconnect(self):
+        if self.connection is None:
+            return
+        try:
+            self.connection.quit()
+        except (smtplib.SMTPException, socket.error):
+            pass
+        self.connection = None
+
+    def sendmail(self, rcpt, subject, content):
+        """Send a message using the current SMTP connection.
+
+        The connection is opened the first time and reopened once if
+        the server closed it.
+
+        :return: None on success, an error message otherwise
+        """
+        msg = MIMEText(content, _charset="utf-8")
+        set_email_headers(msg, subject, self.sender, rcpt)
+        for attempt in range(2):
+            try:
+                if self.connection is None:
+                    self.connection = self.connect()
+                self.connection.sendmail(self.sender, [rcpt], msg.as_string())
+            except smtplib.SMTPServerDisconnected, e:
+                self.disconnect()
+                error = "SMTP error: %s" % str(e)
+                continue
+            except socket.error, e:
+                self.disconnect()
+                return "Connection error: %s" % str(e)
+            except smtplib.SMTPException, e:
+                return "SMTP error: %s" % str(e)
+            return None
+        return error
+
+    def send_pr_notification(self, rcpt, total, reqs):
+        """Send a notification to an administrator.
+
+        :param str rcpt: recipient address
+        :param int total: number of pending requests
+        :param list reqs: the most recent requests
+        """
         if self.options["verbose"]:
             print "Sending notification to %s" % rcpt
-        total = reqs.count()
-        reqs = reqs.all()[:10]
         content = render_to_string(
             "amavis/notifications/pending_requests.html", dict(
                 total=total, requests=reqs,
                 baseurl=self.baseurl, listingurl=self.listingurl
             )
         )
-        status, msg = sendmail_simple(
-            self.sender, rcpt,
-            subject=_("[modoboa] Pending release requests"),
-            content=content,
-            server=self.options["smtp_host"],
-            port=self.options["smtp_port"]
+        error = self.sendmail(
+            rcpt, _("[modoboa] Pending release requests"), content
+        )
+        if error is not None:
+            print error
+
+    def get_pending_requests(self):
+        """Load pending requests grouped by domain.
+
+        Requests are counted by the database and only the most recent
+        requests of each domain are loaded (they are displayed by
+        notifications).
+
+        :return: a dictionary (reversed domain name => [total, requests])
+        """
+        result = {}
+        reqs = Msgrcpt.objects.filter(rs='p')
+        totals = reqs.values("rid__domain").annotate(total=Count("mail"))
+        for row in totals:
+            sketch = reqs.filter(rid__domain=row["rid__domain"]) \
+                .select_related("mail__sid", "rid") \
+                .order_by("-mail__time_num")[:self.sketch_size]
+            result[row["rid__domain"]] = [row["total"], list(sketch)]
+        return result
+
+    def get_recipients(self, users):
+        """Return the notification address of each user.
+
+        :param users: a ``User`` queryset
+        :return: a dictionary (user id => address)
+        """
+        result = {}
+        mailboxes = Mailbox.objects.filter(user__in=users) \
+            .values_list("user", "address", "domain__name").order_by("id")
+        for user_id, address, domain in mailboxes:
+            result.setdefault(user_id, "%s@%s" % (address, domain))
+        return result
+
+    def merge_requests(self, entries):
+        """Merge the pending requests of several domains.
+
+        :param entries: a list of [total, requests] lists
+        :return: a tuple (total, most recent requests)
+        """
+        total = sum(entry[0] for entry in entries)
+        reqs = sorted(
+            [req for entry in entries for req in entry[1]],
+            key=lambda req: req.mail.time_num, reverse=True
         )
-        if not status:
-            print msg
+        return total, reqs[:self.sketch_size]
 
     def notify_admins_pending_requests(self):
         self.sender = parameters.get_admin("NOTIFICATIONS_SENDER",
@@ -71,24 +167,36 @@ class Command(BaseCommand):
             + reverse("modoboa.extensions.amavis.views._listing") \
             + "?viewrequests=1"
 
-        for da in User.objects.filter(groups__name="DomainAdmins"):
-            if not da.mailbox_set.count():
-                continue
-            rcpt = da.mailbox_set.all()[0].full_address
-            reqs = get_wrapper().get_domains_pending_requests(
-                Domain.objects.get_for_admin(da)
-            )
-            if reqs.count():
-                self.send_pr_notification(rcpt, reqs)
-
-        reqs = Msgrcpt.objects.filter(rs='p')
-        if not reqs.count():
+        pending = self.get_pending_requests()
+        if not pending:
             if self.options["verbose"]:
                 print "No release request currently pending"
             return
-        for su in User.objects.filter(is_superuser=True):
-            if not su.mailbox_set.count():
+
+        domains = dict(
+            (dom.pk, reverse_domain_names([dom])[0])
+            for dom in Domain.objects.only("name")
+        )
+        admins = User.objects.filter(groups__name="DomainAdmins")
+        admin_domains = {}
+        for user_id, domain_id in ObjectAccess.objects.filter(
+                user__in=admins,
+                content_type=ContentType.objects.get_for_model(Domain)
+        ).values_list("user", "object_id"):
+            name = domains.get(domain_id)
+            if name in pending:
+                admin_domains.setdefault(user_id, []).append(pending[name])
+        rcpts = self.get_recipients(admins)
+        for user_id, entries in admin_domains.iteritems():
+            if not user_id in rcpts:
                 continue
-            rcpt = su.mailbox_set.all()[0].full_address
-            self.send_pr_notification(rcpt, reqs)
+            total, reqs = self.merge_requests(entries)
+            self.send_pr_notification(rcpts[user_id], total, reqs)
+
+        total, reqs = self.merge_requests(pending.values())
+        superadmins = self.get_recipients(
+            User.objects.filter(is_superuser=True)
+        )
+        for rcpt in superadmins.values():
+            self.send_pr_notification(rcpt, total, reqs)
         db.close_connection()
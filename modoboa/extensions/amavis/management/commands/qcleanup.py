@@ -4,11 +4,12 @@
 import time
 from optparse import make_option
 from django import db
+from django.db import router, transaction
 from django.core.management.base import BaseCommand
 from modoboa.lib import parameters
 from modoboa.extensions.amavis import Amavis
 from modoboa.extensions.amavis.models import (
-    Msgrcpt, Msgs, Maddr
+    Msgrcpt, Msgs, Maddr, Quarantine, Msgsearch
 )
 
 
@@ -24,7 +25,15 @@ class Command(BaseCommand):
         make_option('--verbose',
                     action='store_true',
                     default=False,
-                    help='Display informational messages')
+                    help='Display informational messages'),
+        make_option('--chunk-size',
+                    type='int',
+                    default=1000,
+                    help='Number of rows deleted by each transaction'),
+        make_option('--sleep',
+                    type='float',
+                    default=0,
+                    help='Number of seconds to wait between two chunks')
     )
 
     def __vprint(self, msg):
@@ -32,6 +41,65 @@ class Command(BaseCommand):
             return
         print msg
 
+    def __pause(self):
+        if self.sleep:
+            time.sleep(self.sleep)
+
+    def delete_messages(self, qset):
+        """Delete messages (and related rows) by chunks.
+
+        Each chunk is selected using one query and deleted by its own
+        transaction so locks are not held for too long. Search index
+        entries are deleted too.
+
+        :param qset: a ``Msgs`` queryset
+        :return: the number of deleted messages
+        """
+        total = 0
+        while True:
+            ids = list(
+                qset.values_list("mail_id", flat=True)[:self.chunk_size]
+            )
+            if not ids:
+                break
+            with transaction.commit_on_success(using=self.dbalias):
+                for model in [Quarantine, Msgrcpt]:
+                    model.objects.filter(mail__in=ids) \
+                        ._raw_delete(self.dbalias)
+                Msgs.objects.filter(mail_id__in=ids)._raw_delete(self.dbalias)
+                Msgsearch.objects.filter(mail_id__in=ids) \
+                    ._raw_delete(self.dbalias)
+            total += len(ids)
+            self.__vprint("  %d messages deleted" % total)
+            self.__pause()
+        return total
+
+    def delete_orphan_addresses(self):
+        """Delete addresses not referenced by any message.
+
+        Orphans are found using one anti-join and deleted by
+        chunks. The condition is checked again by the ``DELETE``
+        statement in case a new message references an address
+        meanwhile.
+
+        :return: the number of deleted addresses
+        """
+        orphans = Maddr.objects.extra(where=[
+            "NOT EXISTS (SELECT 1 FROM msgs WHERE msgs.sid = maddr.id)",
+            "NOT EXISTS (SELECT 1 FROM msgrcpt WHERE msgrcpt.rid = maddr.id)"
+        ])
+        total = 0
+        while True:
+            ids = list(orphans.values_list("id", flat=True)[:self.chunk_size])
+            if not ids:
+                break
+            with transaction.commit_on_success(using=self.dbalias):
+                orphans.filter(id__in=ids)._raw_delete(self.dbalias)
+            total += len(ids)
+            self.__vprint("  %d addresses deleted" % total)
+            self.__pause()
+        return total
+
     def handle(self, *args, **options):
         if options["debug"]:
             import logging
@@ -39,6 +107,9 @@ class Command(BaseCommand):
             l.setLevel(logging.DEBUG)
             l.addHandler(logging.StreamHandler())
         self.verbose = options["verbose"]
+        self.chunk_size = max(options["chunk_size"], 1)
+        self.sleep = options["sleep"]
+        self.dbalias = router.db_for_write(Msgs)
 
         Amavis().load()
 
@@ -49,21 +120,34 @@ class Command(BaseCommand):
         if parameters.get_admin("RELEASED_MSGS_CLEANUP",
                                 app="amavis") == "yes":
             flags += ['R']
+        placeholders = ", ".join(["%s"] * len(flags))
 
+        start = time.time()
         self.__vprint("Deleting marked messages...")
-        ids = Msgrcpt.objects.filter(rs__in=flags).values("mail_id").distinct()
-        for msg in Msgs.objects.filter(mail_id__in=ids):
-            if not msg.msgrcpt_set.exclude(rs__in=flags).count():
-                msg.delete()
+        marked = Msgs.objects.extra(
+            where=[
+                "EXISTS (SELECT 1 FROM msgrcpt WHERE "
+                "msgrcpt.mail_id = msgs.mail_id AND msgrcpt.rs IN (%s))"
+                % placeholders,
+                "NOT EXISTS (SELECT 1 FROM msgrcpt WHERE "
+                "msgrcpt.mail_id = msgs.mail_id AND msgrcpt.rs NOT IN (%s))"
+                % placeholders
+            ],
+            params=flags + flags
+        )
+        nb = self.delete_messages(marked)
+        self.__vprint("%d messages deleted in %.2fs" % (nb, time.time() - start))
 
+        step = time.time()
         self.__vprint("Deleting messages older than %d days..." % max_messages_age)
         limit = int(time.time()) - (max_messages_age * 24 * 3600)
-        Msgs.objects.filter(time_num__lt=limit).delete()
+        nb = self.delete_messages(Msgs.objects.filter(time_num__lt=limit))
+        self.__vprint("%d messages deleted in %.2fs" % (nb, time.time() - step))
 
+        step = time.time()
         self.__vprint("Deleting unreferenced e-mail addresses...")
-        for maddr in Maddr.objects.all():
-            if not maddr.msgs_set.count() and not maddr.msgrcpt_set.count():
-                maddr.delete()
+        nb = self.delete_orphan_addresses()
+        self.__vprint("%d addresses deleted in %.2fs" % (nb, time.time() - step))
         db.close_connection()
 
-        self.__vprint("Done.")
+        self.__vprint("Done in %.2fs." % (time.time() - start))
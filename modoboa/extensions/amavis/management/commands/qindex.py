@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import time
+from email.parser import HeaderParser
+from optparse import make_option
+from django import db
+from django.db import router, transaction
+from django.db.models import Max, Q
+from django.core.management.base import BaseCommand
+from modoboa.extensions.amavis.lib import SEARCH_WEIGHTS, get_search_terms
+from modoboa.extensions.amavis.models import (
+    Msgrcpt, Msgs, Quarantine, Msgsearch
+)
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Update the quarantine search index'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--verbose',
+                    action='store_true',
+                    default=False,
+                    help='Display informational messages'),
+        make_option('--batch-size',
+                    type='int',
+                    default=500,
+                    help='Number of messages indexed by each transaction'),
+        make_option('--delay',
+                    type='int',
+                    default=300,
+                    help='Do not index messages received during the last '
+                    'DELAY seconds (amavis may still be storing them)'),
+        make_option('--rebuild',
+                    action='store_true',
+                    default=False,
+                    help='Drop the current index and rebuild it')
+    )
+
+    def __vprint(self, msg):
+        if not self.verbose:
+            return
+        print msg
+
+    def get_alerts(self, ids):
+        """Return the X-Amavis-Alert header of each message.
+
+        Only the first chunk of each message is parsed.
+
+        :param list ids: message identifiers
+        :return: a dictionary (mail_id => header value)
+        """
+        result = {}
+        chunks = Quarantine.objects.filter(mail__in=ids, chunk_ind=1) \
+            .order_by().values_list("mail", "mail_text")
+        for mail_id, text in chunks:
+            if isinstance(text, unicode):
+                text = text.encode("utf-8")
+            headers = HeaderParser().parsestr(str(text), headersonly=True)
+            result[mail_id] = headers.get("X-Amavis-Alert", "")
+        return result
+
+    def index_messages(self, messages):
+        """Index a list of messages using one transaction.
+
+        :param list messages: (mail_id, time_num, subject, from_addr) tuples
+        :return: the number of created index entries
+        """
+        ids = [msg[0] for msg in messages]
+        recipients = {}
+        for mail_id, email in Msgrcpt.objects.filter(mail__in=ids) \
+                .order_by().values_list("mail", "rid__email"):
+            recipients.setdefault(mail_id, []).append(email)
+        alerts = self.get_alerts(ids)
+
+        entries = []
+        for mail_id, time_num, subject, from_addr in messages:
+            weights = {}
+            fields = [("subject", subject), ("from", from_addr),
+                      ("alert", alerts.get(mail_id))] \
+                + [("to", email) for email in recipients.get(mail_id, [])]
+            for field, value in fields:
+                for term in get_search_terms(value):
+                    weights[term] = weights.get(term, 0) \
+                        + SEARCH_WEIGHTS[field]
+            entries += [
+                Msgsearch(term=term, mail_id=mail_id, time_num=time_num,
+                          weight=weight)
+                for term, weight in weights.iteritems()
+            ]
+        with transaction.commit_on_success(using=self.dbalias):
+            Msgsearch.objects.bulk_create(entries)
+        return len(entries)
+
+    def update_index(self, batch_size, delay):
+        """Index messages received since the last run.
+
+        ``msgs`` is read by increasing (time_num, mail_id) order. The
+        most recent indexed time is the starting point of the next
+        run: messages of this second which are already indexed are
+        skipped.
+
+        :return: the number of indexed messages
+        """
+        last = Msgsearch.objects.aggregate(last=Max("time_num"))["last"]
+        qset = Msgs.objects.filter(time_num__lte=int(time.time()) - delay)
+        done = set()
+        if last is not None:
+            qset = qset.filter(time_num__gte=last)
+            done = set(
+                Msgsearch.objects.filter(time_num=last)
+                .values_list("mail_id", flat=True).distinct()
+            )
+        total = 0
+        key = None
+        while True:
+            batch = qset
+            if key is not None:
+                batch = batch.filter(
+                    Q(time_num__gt=key[0])
+                    | Q(time_num=key[0], mail_id__gt=key[1])
+                )
+            messages = list(
+                batch.order_by("time_num", "mail_id").values_list(
+                    "mail_id", "time_num", "subject", "from_addr"
+                )[:batch_size]
+            )
+            if not messages:
+                break
+            key = (messages[-1][1], messages[-1][0])
+            messages = [msg for msg in messages if not msg[0] in done]
+            if messages:
+                self.index_messages(messages)
+            total += len(messages)
+            self.__vprint("  %d messages indexed" % total)
+        return total
+
+    def handle(self, *args, **options):
+        self.verbose = options["verbose"]
+        self.dbalias = router.db_for_write(Msgsearch)
+
+        start = time.time()
+        if options["rebuild"]:
+            self.__vprint("Dropping the current index...")
+            with transaction.commit_on_success(using=self.dbalias):
+                Msgsearch.objects.all()._raw_delete(self.dbalias)
+
+        self.__vprint("Indexing new messages...")
+        nb = self.update_index(
+            max(options["batch_size"], 1), max(options["delay"], 0)
+        )
+        db.close_connection()
+        self.__vprint("%d messages indexed in %.2fs" % (nb, time.time() - start))
@@ -17,7 +17,7 @@ class Maddr(models.Model):
     partition_tag = models.IntegerField(unique=True, null=True, blank=True)
     id = models.BigIntegerField(primary_key=True)
     email = models.CharField(unique=True, max_length=255)
-    domain = models.CharField(max_length=765)
+    domain = models.CharField(max_length=765, db_index=True)
 
     class Meta:
         db_table = u'maddr'
@@ -191,3 +191,19 @@ class Wblist(models.Model):
     class Meta:
         db_table = u'wblist'
         managed = False
+
+
+class Msgsearch(models.Model):
+    """Quarantine search index.
+
+    This table is not part of the amavis schema: it is filled by the
+    ``qindex`` command and contains one row per (term, message).
+    """
+    term = models.CharField(max_length=64)
+    mail_id = models.CharField(max_length=12)
+    time_num = models.IntegerField(db_index=True)
+    weight = models.IntegerField()
+
+    class Meta:
+        db_table = u'msgsearch'
+        unique_together = ("term", "mail_id")
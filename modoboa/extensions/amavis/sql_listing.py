@@ -1,5 +1,7 @@
 # coding: utf-8
+import hashlib
 import re
+import time
 from datetime import datetime
 from django.template.loader import render_to_string
 from django.utils.translation import ugettext_lazy
@@ -12,6 +14,8 @@ from modoboa.lib.dbutils import db_type
 from modoboa.extensions.admin.models import Domain
 from .models import Quarantine, Msgrcpt
 
+HEADERS_END = re.compile(r"\r?\n\r?\n")
+
 
 class Qtable(tables.Table):
     tableid = "emails"
@@ -61,20 +65,113 @@ class Qtable(tables.Table):
 
 
 class SQLconnector(MBconnector):
+    """Quarantine connector.
+
+    Pages are fetched using keyset pagination: the sort key of the
+    last row of each page is recorded into ``state`` so the next page
+    can be fetched by a ``WHERE key > last_key`` condition instead of
+    an ``OFFSET`` scan. When no key is known for the requested page
+    (direct access to the last page for example), the connector falls
+    back to ``OFFSET``.
+
+    The total number of messages is also recorded into ``state`` and
+    reused during ``COUNT_TIMEOUT`` seconds.
+
+    When a list of search terms is given, only messages containing
+    all the terms (see the ``qindex`` command) are listed and they can
+    be sorted by relevance (``rank`` order, pages are then fetched
+    using ``OFFSET``).
+
+    :param dict state: a dictionary kept between requests (the
+                       session for example)
+    :param list search: a list of search terms
+    """
     order_translation_table = {
         "type": "mail__msgrcpt__content",
         "score": "mail__msgrcpt__bspam_level",
         "date": "mail__time_num",
         "subject": "mail__subject",
         "from": "mail__from_addr",
-        "to": "mail__msgrcpt__rid__email"
+        "to": "mail__msgrcpt__rid__email",
+        "rank": "rank"
     }
+    key_fields = ["mail__mail_id", "mail__msgrcpt__rseqnum"]
+    nullable_fields = ["mail__msgrcpt__bspam_level"]
+    default_order = "-date"
+    COUNT_TIMEOUT = 60
+    MAX_CURSORS = 50
 
-    def __init__(self, mail_ids=None, filter=None):
+    def __init__(self, mail_ids=None, filter=None, state=None, search=None):
         self.count = None
         self.messages = None
         self.mail_ids = mail_ids
         self.filter = filter
+        self.state = state if state is not None else {}
+        self.search = search
+
+    def _keyset_filter(self, key):
+        """Return a condition selecting the rows following ``key``.
+
+        Rows with a NULL sort value are not matched by comparisons so
+        they are selected explicitly, depending on the side where the
+        backend sorts them (last in ascending order for PostgreSQL, last
+        in descending order for MySQL and SQLite).
+
+        :param tuple key: the sort key of the last row of the
+                          previous page
+        :return: a ``Q`` object
+        """
+        op = "lt" if self.sign else "gt"
+        q = None
+        for field, value in reversed(zip(self.key_fields, key[1:])):
+            cond = Q(**{"%s__%s" % (field, op): value})
+            if q is not None:
+                cond |= Q(**{field: value}) & q
+            q = cond
+        field, value = self.order_field, key[0]
+        isnull = "%s__isnull" % field
+        nulls_last = (db_type("amavis") == "postgres") != bool(self.sign)
+        if value is None:
+            cond = Q(**{isnull: True}) & q
+            if not nulls_last:
+                cond |= Q(**{isnull: False})
+            return cond
+        cond = Q(**{"%s__%s" % (field, op): value}) | \
+            (Q(**{field: value}) & q)
+        if field in self.nullable_fields and nulls_last:
+            cond |= Q(**{isnull: True})
+        return cond
+
+    def _get_messages(self, extra_filter=None):
+        # Conditions must be applied by the same filter() call,
+        # otherwise the msgrcpt table would be joined twice.
+        filter = self.base_filter
+        if extra_filter is not None:
+            filter &= extra_filter
+        qset = Quarantine.objects.filter(filter)
+        if self.search:
+            qset = search_messages(qset, self.search)
+        fields = [
+            "mail__from_addr",
+            "mail__msgrcpt__rid__email",
+            "mail__subject",
+            "mail__mail_id",
+            "mail__time_num",
+            "mail__msgrcpt__content",
+            "mail__msgrcpt__bspam_level",
+            "mail__msgrcpt__rs",
+            "mail__msgrcpt__rseqnum"
+        ]
+        if self.order_field == "rank":
+            placeholders = ", ".join(["%s"] * len(self.search))
+            qset = qset.extra(
+                select={"rank": RANK_QUERY % placeholders},
+                select_params=self.search
+            )
+            fields.append("rank")
+        return qset.values(*fields).order_by(*[
+            self.sign + field for field in [self.order_field] + self.key_fields
+        ])
 
     def messages_count(self, **kwargs):
         if self.count is None:
@@ -83,31 +180,55 @@ class SQLconnector(MBconnector):
                 filter &= Q(mail__in=self.mail_ids)
             if self.filter:
                 filter &= self.filter
-            self.messages = Quarantine.objects.filter(filter).values(
-                "mail__from_addr",
-                "mail__msgrcpt__rid__email",
-                "mail__subject",
-                "mail__mail_id",
-                "mail__time_num",
-                "mail__msgrcpt__content",
-                "mail__msgrcpt__bspam_level",
-                "mail__msgrcpt__rs"
-            )
-            if "order" in kwargs:
-                order = kwargs["order"]
-                sign = ""
-                if order[0] == "-":
-                    sign = "-"
-                    order = order[1:]
-                order = self.order_translation_table[order]
-                self.messages = self.messages.order_by(sign + order)
-
-            self.count = self.messages.count()
+            if self.search is not None and not self.search:
+                self.count = 0
+                return self.count
+            self.base_filter = filter
+            order = kwargs.get("order") or self.default_order
+            if not self.search and order.lstrip("-") == "rank":
+                order = self.default_order
+            self.sign = ""
+            if order[0] == "-":
+                self.sign = "-"
+                order = order[1:]
+            self.order_field = self.order_translation_table[order]
+            self.messages = self._get_messages()
+
+            signature = hashlib.md5(
+                unicode(self.messages.query).encode("utf-8")
+            ).hexdigest()
+            if self.state.get("signature") != signature:
+                self.state.clear()
+                self.state.update(signature=signature, cursors={})
+            if time.time() - self.state.get("counted", 0) \
+                    > self.COUNT_TIMEOUT:
+                self.state.update(
+                    count=self.messages.count(), counted=time.time()
+                )
+            self.count = self.state["count"]
         return self.count
 
     def fetch(self, start=None, stop=None, **kwargs):
+        cursors = self.state["cursors"]
+        key = cursors.get(start - 1)
+        if key is not None:
+            rows = list(
+                self._get_messages(self._keyset_filter(key))[:stop - start + 1]
+            )
+        else:
+            rows = list(self.messages[start - 1:stop])
+        # The rank is not a real column so the relevance order is
+        # always paginated using OFFSET.
+        if rows and self.order_field != "rank":
+            if len(cursors) >= self.MAX_CURSORS:
+                cursors.clear()
+            last = rows[-1]
+            cursors[start - 1 + len(rows)] = tuple(
+                last[field] for field in [self.order_field] + self.key_fields
+            )
+
         emails = []
-        for qm in self.messages[start - 1:stop]:
+        for qm in rows:
             m = {"from": qm["mail__from_addr"],
                  "to": qm["mail__msgrcpt__rid__email"],
                  "subject": qm["mail__subject"],
@@ -128,6 +249,58 @@ class SQLconnector(MBconnector):
         return emails
 
 
+RANK_QUERY = (
+    "SELECT SUM(msgsearch.weight) FROM msgsearch "
+    "WHERE msgsearch.mail_id = quarantine.mail_id "
+    "AND msgsearch.term IN (%s)"
+)
+
+
+SEARCH_QUERY = (
+    "quarantine.mail_id IN (SELECT msgsearch.mail_id FROM msgsearch "
+    "WHERE msgsearch.term IN (%s) GROUP BY msgsearch.mail_id "
+    "HAVING COUNT(*) = %%s)"
+)
+
+
+def search_messages(qset, terms):
+    """Restrict a list of messages to the ones containing all the
+    given terms.
+
+    The search uses the *msgsearch* table (filled by the ``qindex``
+    command) through a subquery, so the number of matching messages
+    does not change the size of the final statement.
+
+    :param qset: a ``Quarantine`` queryset
+    :param list terms: search terms (see :func:`get_query_terms`)
+    :return: a new queryset
+    """
+    placeholders = ", ".join(["%s"] * len(terms))
+    return qset.extra(
+        where=[SEARCH_QUERY % placeholders], params=list(terms) + [len(terms)]
+    )
+
+
+#: Maximum number of domain names used as parameters by one query
+#: (SQLite refuses queries using more than 999 parameters).
+DOMAIN_NAMES_CHUNK_SIZE = 500
+
+
+def reverse_domain_names(domains):
+    """Return domain names as stored into the *maddr.domain* column.
+
+    Amavis stores the domain part of addresses in reverse order
+    (example.com => com.example), so messages can be filtered on this
+    (indexed) column.
+
+    :param domains: a list of ``Domain`` objects
+    :return: a list of strings
+    """
+    return [
+        ".".join(reversed(dom.name.lower().split("."))) for dom in domains
+    ]
+
+
 class SQLWrapper(object):
     """A simple SQL wrapper.
 
@@ -146,18 +319,25 @@ class SQLWrapper(object):
 
         :param string query: query to execute
         :param list args: a list of arguments to replace in :kw:`query`
+        :return: the number of affected rows
         """
         from django.db import connections, transaction
 
         cursor = connections['amavis'].cursor()
         cursor.execute(query, args)
         transaction.commit_unless_managed(using='amavis')
+        return cursor.rowcount
 
     def get_mails(self, request, rcptfilter=None):
         """Retrieve all messages visible by a user.
 
         Simple users can only see the messages 
 
+        Messages of domain administrators are filtered using one
+        parameter per administered domain, in a single query: with
+        SQLite, the listing fails for administrators of more than
+        999 domains.
+
         :rtype: QuerySet
         """
         q = Q(rs='p') \
@@ -168,9 +348,7 @@ class SQLWrapper(object):
             q &= Q(rid__email__in=rcpts)
         elif not request.user.is_superuser:
             doms = Domain.objects.get_for_admin(request.user)
-            regexp = "(%s)" % '|'.join([dom.name for dom in doms])
-            doms_q = Q(rid__email__regex=regexp)
-            q &= doms_q
+            q &= Q(rid__domain__in=reverse_domain_names(doms))
         if rcptfilter is not None:
             q &= Q(rid__email__contains=rcptfilter)
         return Msgrcpt.objects.filter(q).values("mail_id")
@@ -182,39 +360,115 @@ class SQLWrapper(object):
         """Change the status (rs field) of a message recipient.
 
         :param string status: status
+        :return: True if the message was or is now a pending request
         """
         from modoboa.extensions.amavis.models import Maddr
 
         addr = Maddr.objects.get(email=address)
-        self._exec(
-            "UPDATE msgrcpt SET rs=%s WHERE mail_id=%s AND rid=%s",
-            [status, mailid, addr.id]
+        query = "UPDATE msgrcpt SET rs=%s WHERE mail_id=%s AND rid=%s"
+        args = [status, mailid, addr.id]
+        if status == 'p':
+            return self._exec(query + " AND rs<>'p'", args) > 0
+        if self._exec(query + " AND rs='p'", args):
+            return True
+        self._exec(query, args)
+        return False
+
+    def set_msgrcpts_status(self, msgrcpts, status):
+        """Change the status of several message recipients.
+
+        Pending requests counters are invalidated (once) only if
+        pending requests have been modified.
+
+        :param list msgrcpts: a list of (address, mailid) tuples
+        :param string status: status
+        """
+        from modoboa.extensions.amavis.lib import (
+            reset_pending_requests_counters
         )
 
+        changed = False
+        for address, mailid in msgrcpts:
+            if self.set_msgrcpt_status(address, mailid, status):
+                changed = True
+        if changed:
+            reset_pending_requests_counters()
+
     def get_recipient_messages(self, address, mailids):
         return Msgrcpt.objects.filter(mail__in=mailids, rid__email=address)
 
     def get_domains_pending_requests(self, domains):
-        regexp = "(%s)" % '|'.join([dom.name for dom in domains])
-        return Msgrcpt.objects.filter(rs='p', rid__email__regex=regexp)
+        """Return the pending requests of the given domains.
+
+        One parameter is used per domain, see
+        ``DOMAIN_NAMES_CHUNK_SIZE``.
+
+        :param domains: a list of ``Domain`` objects
+        :rtype: QuerySet
+        """
+        return Msgrcpt.objects.filter(
+            rs='p', rid__domain__in=reverse_domain_names(domains)
+        )
 
     def get_pending_requests(self, user):
         """Return the number of current pending requests
 
+        Administered domains are processed by chunks of
+        ``DOMAIN_NAMES_CHUNK_SIZE`` domains (one query per chunk).
+
         :param user: a ``User`` instance
         """
-        rq = Q(rs='p')
-        if not user.is_superuser:
-            doms = Domain.objects.get_for_admin(user)
-            if not doms.count():
-                return 0
-            regexp = "(%s)" % '|'.join([dom.name for dom in doms])
-            doms_q = Q(rid__email__regex=regexp)
-            rq &= doms_q
-        return Msgrcpt.objects.filter(rq).count()
+        if user.is_superuser:
+            return Msgrcpt.objects.filter(rs='p').count()
+        doms = list(Domain.objects.get_for_admin(user))
+        count = 0
+        for pos in range(0, len(doms), DOMAIN_NAMES_CHUNK_SIZE):
+            count += self.get_domains_pending_requests(
+                doms[pos:pos + DOMAIN_NAMES_CHUNK_SIZE]
+            ).count()
+        return count
+
+    def iter_mail_chunks(self, mailid, batch_size=64):
+        """Iterate over the chunks of a quarantined message.
+
+        Chunks are loaded by small batches (ordered by *chunk_ind*) so
+        the whole message is never fetched at once.
+
+        :param str mailid: message's unique identifier
+        :param int batch_size: number of chunks loaded by each query
+        :return: an iterator over raw strings
+        """
+        last = -1
+        while True:
+            chunks = list(
+                Quarantine.objects.filter(mail=mailid, chunk_ind__gt=last)
+                .order_by("chunk_ind")
+                .values_list("chunk_ind", "mail_text")[:batch_size]
+            )
+            for last, text in chunks:
+                if isinstance(text, unicode):
+                    text = text.encode("utf-8")
+                yield str(text)
+            if len(chunks) < batch_size:
+                break
 
-    def get_mail_content(self, mailid):
-        return Quarantine.objects.filter(mail=mailid)
+    def get_mail_headers(self, mailid):
+        """Parse the headers of a quarantined message.
+
+        Chunks are loaded until the end of the header section is
+        reached, the body is not retrieved.
+
+        :param str mailid: message's unique identifier
+        :return: an ``email.message.Message`` instance
+        """
+        from email.parser import HeaderParser
+
+        content = ""
+        for chunk in self.iter_mail_chunks(mailid, batch_size=4):
+            content += chunk
+            if HEADERS_END.search(content):
+                break
+        return HeaderParser().parsestr(content, headersonly=True)
 
 
 class PgWrapper(SQLWrapper):
@@ -222,63 +476,53 @@ class PgWrapper(SQLWrapper):
 
     Make use of ``QuerySet.extra`` and postgres ``convert_from``
     function to let the quarantine manager work as expected !
+
+    (*maddr.domain* is not a bytea field so it can be filtered
+    directly)
+
+    psycopg2 interpolates query parameters itself, so the number of
+    administered domains is not limited by ``get_mails``.
     """
 
     def get_mails(self, request, rcptfilter=None):
         q = Q(rs='p') \
             if request.GET.get("viewrequests", None) == "1" else ~Q(rs='D')
         where = ["U0.rid=maddr.id"]
+        params = []
         if request.user.group == 'SimpleUsers':
             rcpts = [request.user.email] \
                 + request.user.mailbox_set.all()[0].alias_addresses
-            where.append("convert_from(maddr.email, 'UTF8') IN (%s)" \
-                             % (','.join(["'%s'" % rcpt for rcpt in rcpts])))
+            where.append("convert_from(maddr.email, 'UTF8') IN (%s)"
+                         % ",".join(["%s"] * len(rcpts)))
+            params += rcpts
         elif not request.user.is_superuser:
-            doms = Domain.objects.get_for_admin(request.user)
-            regexp = "(%s)" % '|'.join([dom.name for dom in doms])
-            where.append("convert_from(maddr.email, 'UTF8') ~ '%s'" % regexp)
+            names = reverse_domain_names(
+                Domain.objects.get_for_admin(request.user)
+            )
+            if not names:
+                return Msgrcpt.objects.none().values("mail_id")
+            where.append("maddr.domain IN (%s)" % ",".join(["%s"] * len(names)))
+            params += names
         if rcptfilter is not None:
-            where.append("convert_from(maddr.email, 'UTF8') LIKE '%%%s%%'"
-                         % rcptfilter)
+            where.append("convert_from(maddr.email, 'UTF8') LIKE %s")
+            params.append("%%%s%%" % rcptfilter)
         return Msgrcpt.objects.filter(q)\
-            .extra(where=where, tables=['maddr']).values("mail_id")
+            .extra(where=where, params=params, tables=['maddr'])\
+            .values("mail_id")
 
     def get_recipient_message(self, address, mailid):
         qset = Msgrcpt.objects.filter(mail=mailid).extra(
-            where=["msgrcpt.rid=maddr.id", "convert_from(maddr.email, 'UTF8') = '%s'" % address],
-            tables=['maddr']
+            where=["msgrcpt.rid=maddr.id",
+                   "convert_from(maddr.email, 'UTF8') = %s"],
+            params=[address], tables=['maddr']
         )
         return qset.all()[0]
 
     def get_recipient_messages(self, address, mailids):
         return Msgrcpt.objects.filter(mail__in=mailids).extra(
-            where=["U0.rid=maddr.id", "convert_from(maddr.email, 'UTF8') = '%s'" % address],
-            tables=['maddr']
-        )
-
-    def get_domains_pending_requests(self, domains):
-        regexp = "(%s)" % '|'.join([dom.name for dom in domains])
-        return Msgrcpt.objects.filter(rs='p').extra(
-            where=["msgrcpt.rid=maddr.id", "convert_from(maddr.email, 'UTF8') ~ '%s'" % regexp],
-            tables=['maddr']
-        )
-
-    def get_pending_requests(self, user):
-        rq = Q(rs='p')
-        if not user.is_superuser:
-            doms = Domain.objects.get_for_admin(user)
-            if not doms.count():
-                return 0
-            regexp = "(%s)" % '|'.join([dom.name for dom in doms])
-            return Msgrcpt.objects.filter(rq).extra(
-                where=["msgrcpt.rid=maddr.id", "convert_from(maddr.email, 'UTF8') ~ '%s'" % (regexp,)],
-                tables=['maddr']
-            ).count()
-        return Msgrcpt.objects.filter(rq).count()
-
-    def get_mail_content(self, mailid):
-        return Quarantine.objects.filter(mail=mailid).extra(
-            select={'mail_text': "convert_from(mail_text, 'UTF8')"}
+            where=["U0.rid=maddr.id",
+                   "convert_from(maddr.email, 'UTF8') = %s"],
+            params=[address], tables=['maddr']
         )
 
 
@@ -299,8 +543,9 @@ class SQLlisting(EmailListing):
     defcallback = "updatelisting"
     reset_wm_url = True
 
-    def __init__(self, user, msgs, filter, **kwargs):
-        self.mbc = SQLconnector(msgs, filter)
+    def __init__(self, user, msgs, filter, state=None, search=None,
+                 **kwargs):
+        self.mbc = SQLconnector(msgs, filter, state, search)
         super(SQLlisting, self).__init__(**kwargs)
         self.show_listing_headers = True
 
@@ -330,13 +575,13 @@ class SQLemail(Email):
     def msg(self):
         """
         """
-        import email
+        from email.feedparser import FeedParser
 
         if self._msg is None:
-            qmails = get_wrapper().get_mail_content(self.mailid)
-            self._msg = email.message_from_string(
-                "".join([qm.mail_text for qm in qmails])
-            )
+            parser = FeedParser()
+            for chunk in get_wrapper().iter_mail_chunks(self.mailid):
+                parser.feed(chunk)
+            self._msg = parser.close()
             self._parse(self._msg)
         return self._msg
 
@@ -26,6 +26,10 @@ def viewm_menu(mail_id, rcpt):
         {"name": "headers",
          "url": reverse('modoboa.extensions.amavis.views.viewheaders', args=[mail_id]),
          "label": _("View full headers")},
+        {"name": "download",
+         "img": "icon-download-alt",
+         "url": reverse('modoboa.extensions.amavis.views.getrawmail', args=[mail_id]),
+         "label": _("Download")},
     ]
 
     menu = render_to_string('common/buttons_list.html',
@@ -72,7 +76,8 @@ def quar_menu():
     :rtype: str
     :return: resulting HTML
     """
-    extraopts = [{"name": "to", "label": _("To")}]
+    extraopts = [{"name": "to", "label": _("To")},
+                 {"name": "fulltext", "label": _("Full text")}]
     return render_to_string('amavis/main_action_bar.html', {
         'extraopts': extraopts
     })
@@ -0,0 +1,489 @@
+import smtplib
+import socket
+import threading
+import time
+from django.core.management.color import no_style
+from django.db import connections, transaction
+from django.http import Http404
+from django.test import SimpleTestCase, TestCase
+from django.test.client import RequestFactory
+from modoboa.core.models import User
+from modoboa.core.factories import UserFactory
+from modoboa.extensions.admin.factories import DomainFactory, populate_database
+from .management.commands import amnotify, qindex
+from .lib import (
+    AMrelease, get_search_terms, get_query_terms,
+    _get_requests_cache_version
+)
+from .models import Maddr, Msgs, Msgrcpt, Quarantine, Msgsearch
+from . import sql_listing
+from .sql_listing import SQLconnector, SQLWrapper, search_messages
+from .views import getrawmail
+
+
+class FakeAmavisd(object):
+    """A local server speaking (a tiny part of) the AM.PDP protocol.
+
+    Answers are sent by small pieces to check that the client
+    correctly splits them.
+    """
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(5)
+        self.address = self.sock.getsockname()
+        self.connections = []
+        self.opened = []
+        self.requests = []
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.error:
+                return
+            self.connections.append(conn)
+            self.opened.append(conn)
+            thread = threading.Thread(target=self.handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def answer(self, request):
+        attrs = dict(
+            line.split("=", 1) for line in request.split("\n") if line
+        )
+        self.requests.append(attrs)
+        if attrs["mail_id"] == "bad":
+            return "setreply=450 4.5.0 Failure: not found\n\n"
+        return "setreply=250 2.0.0 Ok,%20id=" + attrs["mail_id"] \
+            + ",%20from%20MTA: 250 2.0.0 Ok: queued\n\n"
+
+    def handle(self, conn):
+        buf = ""
+        while True:
+            try:
+                data = conn.recv(1024)
+            except socket.error:
+                return
+            if not data:
+                return
+            buf += data
+            while "\n\n" in buf:
+                request, buf = buf.split("\n\n", 1)
+                answer = self.answer(request)
+                for pos in range(0, len(answer), 7):
+                    conn.sendall(answer[pos:pos + 7])
+
+    def drop_connections(self):
+        for conn in self.opened:
+            conn.shutdown(socket.SHUT_RDWR)
+            conn.close()
+        self.opened = []
+
+    def stop(self):
+        self.drop_connections()
+        self.sock.close()
+
+
+class AMreleaseTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.server = FakeAmavisd()
+        AMrelease.close_connections()
+
+    def tearDown(self):
+        AMrelease.close_connections()
+        self.server.stop()
+
+    def test_release_many(self):
+        requests = [
+            ("id%d" % cpt, "secret", "user%d@test.com" % cpt)
+            for cpt in range(500)
+        ]
+        requests[42] = ("bad", "secret", "user@test.com")
+        results = AMrelease(self.server.address).release_many(requests)
+        self.assertEqual(len(results), 500)
+        self.assertFalse(results[42])
+        self.assertEqual(results.count(True), 499)
+        self.assertEqual(len(self.server.connections), 1)
+        self.assertEqual(self.server.requests[1]["recipient"], "user1@test.com")
+
+    def test_connection_reuse(self):
+        self.assertTrue(
+            AMrelease(self.server.address).sendreq("id1", "s", "u@test.com")
+        )
+        self.assertTrue(
+            AMrelease(self.server.address).sendreq("id2", "s", "u@test.com")
+        )
+        self.assertEqual(len(self.server.connections), 1)
+
+        # Idle connections closed by amavisd are replaced
+        self.server.drop_connections()
+        self.assertTrue(
+            AMrelease(self.server.address).sendreq("id3", "s", "u@test.com")
+        )
+        self.assertEqual(len(self.server.connections), 2)
+
+    def test_encoding(self):
+        AMrelease(self.server.address).sendreq(
+            "id1", "s", "user name%@test.com"
+        )
+        self.assertEqual(
+            self.server.requests[0]["recipient"], "user%20name%25@test.com"
+        )
+
+
+class SearchTermsTestCase(SimpleTestCase):
+
+    def test_get_search_terms(self):
+        self.assertEqual(
+            get_search_terms(u"Cheap Viagra: 100% off!"),
+            set([u"cheap", u"viagra", u"100", u"off"])
+        )
+        self.assertEqual(
+            get_search_terms("John Doe <john.doe@Example.com>"),
+            set([u"john", u"doe", u"example", u"com",
+                 u"john.doe@example.com", u"example.com"])
+        )
+        self.assertEqual(get_search_terms(None), set())
+        self.assertEqual(get_search_terms(buffer("\xc3\xa9t\xc3\xa9")),
+                         set([u"\xe9t\xe9"]))
+
+    def test_get_query_terms(self):
+        self.assertEqual(
+            get_query_terms("Invoice from John.Doe@Example.com"),
+            set([u"invoice", u"from", u"john.doe@example.com"])
+        )
+        self.assertEqual(
+            get_query_terms("example.com"), set([u"example", u"com"])
+        )
+
+
+class QuarantineTestCase(TestCase):
+    """Base class for tests using the quarantine.
+
+    Amavis tables are not managed by Django so the missing ones are
+    created (and removed) by the test case itself.
+    """
+    multi_db = True
+    amavis_models = [Maddr, Msgs, Msgrcpt, Quarantine, Msgsearch]
+
+    @classmethod
+    def setUpClass(cls):
+        connection = connections["amavis"]
+        cursor = connection.cursor()
+        tables = connection.introspection.table_names(cursor)
+        cls.created_models = []
+        for model in cls.amavis_models:
+            if model._meta.db_table in tables:
+                continue
+            cls.created_models.append(model)
+            managed = model._meta.managed
+            model._meta.managed = True
+            try:
+                statements, pending = connection.creation.sql_create_model(
+                    model, no_style()
+                )
+            finally:
+                model._meta.managed = managed
+            for statement in statements:
+                cursor.execute(statement)
+        transaction.commit_unless_managed(using="amavis")
+
+    @classmethod
+    def tearDownClass(cls):
+        cursor = connections["amavis"].cursor()
+        for model in reversed(cls.created_models):
+            cursor.execute("DROP TABLE %s" % model._meta.db_table)
+        transaction.commit_unless_managed(using="amavis")
+
+    def add_message(self, mail_id, rcpt, time_num=0, subject="",
+                    score=None, rs=" ", from_addr="sender@test.com"):
+        """Put a message into the quarantine."""
+        localpart, domain = rcpt.split("@")
+        addr, created = Maddr.objects.get_or_create(
+            email=rcpt, defaults={
+                "id": Maddr.objects.count() + 1,
+                "domain": ".".join(reversed(domain.split(".")))
+            }
+        )
+        msg = Msgs.objects.create(
+            mail_id=mail_id, secret_id="s" + mail_id, time_num=time_num,
+            sid=addr, size=1, subject=subject, from_addr=from_addr
+        )
+        Msgrcpt.objects.create(
+            mail=msg, rid=addr, rseqnum=1, content="S", rs=rs,
+            bspam_level=score
+        )
+        Quarantine.objects.create(
+            mail=msg, chunk_ind=1,
+            mail_text="Subject: %s\r\n\r\nbody" % subject
+        )
+        return msg
+
+    def update_index(self, delay=0):
+        """Index new messages (see the ``qindex`` command)."""
+        cmd = qindex.Command()
+        cmd.verbose = False
+        cmd.dbalias = "amavis"
+        return cmd.update_index(100, delay)
+
+
+class SQLconnectorTestCase(QuarantineTestCase):
+
+    def _fetch_all(self, connector, order, pagesize=2):
+        count = connector.messages_count(order=order)
+        result = []
+        for start in range(1, count + 1, pagesize):
+            result += [
+                m["mailid"] for m in connector.fetch(start, start + pagesize - 1)
+            ]
+        return result
+
+    def test_keyset_pagination_with_null_scores(self):
+        """Check that messages without score are listed by every page
+        """
+        scores = [3.0, None, 1.0, None, 2.0, 1.0, None]
+        for cpt, score in enumerate(scores):
+            self.add_message("m%d" % cpt, "user@test.com", cpt, score=score)
+        for order in ["score", "-score"]:
+            state = {}
+            pages = self._fetch_all(SQLconnector(state=state), order)
+            self.assertTrue(state["cursors"])
+            self.assertEqual(len(state["signature"]), 32)
+            self.assertEqual(
+                pages,
+                self._fetch_all(SQLconnector(), order, pagesize=len(scores))
+            )
+            self.assertEqual(sorted(pages), ["m%d" % cpt for cpt in range(7)])
+
+
+class SQLWrapperTestCase(QuarantineTestCase):
+    fixtures = ["initial_users.json"]
+
+    def test_set_msgrcpts_status(self):
+        """Check that counters are only reset when pending requests change
+        """
+        self.add_message("m1", "user@test.com")
+        self.add_message("m2", "user@test.com", rs="p")
+        wrapper = SQLWrapper()
+        version = _get_requests_cache_version()
+        wrapper.set_msgrcpts_status([("user@test.com", "m1")], "V")
+        self.assertEqual(_get_requests_cache_version(), version)
+        wrapper.set_msgrcpts_status(
+            [("user@test.com", "m1"), ("user@test.com", "m2")], "D"
+        )
+        self.assertEqual(_get_requests_cache_version(), version + 1)
+        self.assertEqual(
+            list(Msgrcpt.objects.values_list("rs", flat=True)), ["D", "D"]
+        )
+        wrapper.set_msgrcpts_status([("user@test.com", "m1")], "p")
+        self.assertEqual(_get_requests_cache_version(), version + 2)
+
+    def test_get_pending_requests_chunks(self):
+        """Check that administered domains are processed by chunks
+        """
+        admin = UserFactory(username="admin@test.com", groups=("DomainAdmins",))
+        for name in ["test.com", "test2.com", "test3.com"]:
+            DomainFactory(name=name).add_admin(admin)
+        DomainFactory(name="other.org")
+        self.add_message("m1", "user@test.com", rs="p")
+        self.add_message("m2", "user@test3.com", rs="p")
+        self.add_message("m3", "user@test3.com")
+        self.add_message("m4", "user@other.org", rs="p")
+        chunks = []
+
+        class Wrapper(SQLWrapper):
+            def get_domains_pending_requests(self, domains):
+                chunks.append(len(domains))
+                return super(Wrapper, self).get_domains_pending_requests(
+                    domains
+                )
+
+        old_size = sql_listing.DOMAIN_NAMES_CHUNK_SIZE
+        sql_listing.DOMAIN_NAMES_CHUNK_SIZE = 2
+        try:
+            self.assertEqual(Wrapper().get_pending_requests(admin), 2)
+        finally:
+            sql_listing.DOMAIN_NAMES_CHUNK_SIZE = old_size
+        self.assertEqual(chunks, [2, 1])
+
+
+class FakeSMTP(object):
+    """An SMTP connection recording sent messages."""
+
+    def __init__(self):
+        self.disconnected = False
+        self.closed = False
+        self.rcpts = []
+
+    def sendmail(self, sender, rcpts, msg):
+        if self.disconnected:
+            raise smtplib.SMTPServerDisconnected("Connection closed")
+        if rcpts[0].startswith("bad"):
+            raise smtplib.SMTPRecipientsRefused({rcpts[0]: (550, "Unknown")})
+        self.rcpts += rcpts
+
+    def quit(self):
+        self.closed = True
+
+
+class AmnotifyTestCase(QuarantineTestCase):
+
+    def test_get_pending_requests(self):
+        for cpt in range(12):
+            self.add_message("t%d" % cpt, "user@test.com", cpt, rs="p")
+        self.add_message("o1", "user@other.org", 5, rs="p")
+        self.add_message("o2", "user@other.org", 6)
+        pending = amnotify.Command().get_pending_requests()
+        self.assertEqual(sorted(pending.keys()), ["com.test", "org.other"])
+        total, reqs = pending["com.test"]
+        self.assertEqual(total, 12)
+        self.assertEqual(
+            [req.mail.mail_id for req in reqs],
+            ["t%d" % cpt for cpt in range(11, 1, -1)]
+        )
+        total, reqs = pending["org.other"]
+        self.assertEqual(total, 1)
+        self.assertEqual([req.mail.mail_id for req in reqs], ["o1"])
+
+    def test_sendmail(self):
+        """Check that notifications are sent despite SMTP failures
+        """
+        smtp1, smtp2, smtp3 = FakeSMTP(), FakeSMTP(), FakeSMTP()
+        smtp1.disconnected = True
+        connections = [smtp1, smtp2, socket.error(111, "Refused"), smtp3]
+
+        def connect():
+            connection = connections.pop(0)
+            if isinstance(connection, Exception):
+                raise connection
+            return connection
+
+        cmd = amnotify.Command()
+        cmd.sender = "notifications@test.com"
+        cmd.connection = None
+        cmd.connect = connect
+        # The server closed the connection: a new one is opened
+        self.assertIsNone(cmd.sendmail("admin1@test.com", "Subject", "Body"))
+        self.assertTrue(smtp1.closed)
+        # Recipient refused: the connection is kept
+        self.assertIsNotNone(cmd.sendmail("bad@test.com", "Subject", "Body"))
+        self.assertIsNone(cmd.sendmail("admin2@test.com", "Subject", "Body"))
+        self.assertEqual(smtp2.rcpts, ["admin1@test.com", "admin2@test.com"])
+        # The server can't be reached: only this recipient is skipped
+        smtp2.disconnected = True
+        self.assertIsNotNone(
+            cmd.sendmail("admin3@test.com", "Subject", "Body")
+        )
+        self.assertIsNone(cmd.connection)
+        self.assertIsNone(cmd.sendmail("admin4@test.com", "Subject", "Body"))
+        self.assertEqual(smtp3.rcpts, ["admin4@test.com"])
+
+
+class GetRawMailTestCase(QuarantineTestCase):
+    fixtures = ["initial_users.json"]
+
+    def setUp(self):
+        populate_database()
+        self.add_message("m1", "user@test.com", subject="Test")
+        self.add_message("m2", "user@test2.com", subject="Test")
+
+    def _getrawmail(self, username, mail_id):
+        request = RequestFactory().get("/")
+        request.user = User.objects.get(username=username)
+        return getrawmail(request, mail_id)
+
+    def test_access(self):
+        """Check that only visible messages can be downloaded
+        """
+        for username in ["admin", "admin@test.com", "user@test.com"]:
+            response = self._getrawmail(username, "m1")
+            self.assertEqual(response.status_code, 200)
+            self.assertIn("Subject: Test", "".join(response.streaming_content))
+        for username in ["admin@test.com", "user@test.com"]:
+            self.assertRaises(Http404, self._getrawmail, username, "m2")
+        self.assertRaises(Http404, self._getrawmail, "admin", "unknown")
+
+
+class SearchTestCase(QuarantineTestCase):
+
+    def setUp(self):
+        self.add_message("m1", "user@test.com", 1, subject="Invoice offer")
+        self.add_message("m2", "user@test.com", 2, subject="Offer",
+                         from_addr="offer@shop.com")
+        self.add_message("m3", "user@test2.com", 3, subject="Invoice")
+        self.update_index()
+
+    def _search(self, terms, order="-rank", mail_ids=None):
+        connector = SQLconnector(mail_ids, search=terms)
+        connector.messages_count(order=order)
+        return [m["mailid"] for m in connector.fetch(1, 10)]
+
+    def test_all_terms(self):
+        """Check that messages must contain all the terms
+        """
+        self.assertEqual(
+            [msg.mail_id for msg in search_messages(
+                Quarantine.objects.all(), ["invoice", "offer"]
+            )],
+            ["m1"]
+        )
+        self.assertEqual(
+            self._search(["invoice"], order="date"), ["m1", "m3"]
+        )
+        self.assertEqual(self._search(["invoice", "nothing"]), [])
+        self.assertEqual(SQLconnector(search=[]).messages_count(), 0)
+
+    def test_ranking(self):
+        """Check that the most relevant messages are listed first
+        """
+        self.assertEqual(self._search(["offer"]), ["m2", "m1"])
+        self.assertEqual(self._search(["offer"], order="rank"), ["m1", "m2"])
+        self.assertEqual(
+            self._search(sorted(get_query_terms("offer@shop.com"))), ["m2"]
+        )
+
+    def test_visibility(self):
+        """Check that search results are restricted to visible messages
+        """
+        mail_ids = Msgrcpt.objects.filter(rid__domain="com.test2") \
+            .values("mail_id")
+        self.assertEqual(self._search(["invoice"], mail_ids=mail_ids), ["m3"])
+        self.assertEqual(self._search(["offer"], mail_ids=mail_ids), [])
+
+
+class QindexTestCase(QuarantineTestCase):
+
+    def test_incremental_update(self):
+        """Check that only new messages are indexed
+        """
+        self.add_message("m1", "user@test.com", 10, subject="First")
+        self.add_message("m2", "user@test.com", 20, subject="Second")
+        self.assertEqual(self.update_index(), 2)
+        self.assertEqual(self.update_index(), 0)
+        # m3 is received during the last indexed second
+        self.add_message("m3", "user@test.com", 20, subject="Third")
+        self.add_message("m4", "user@test.com", 30, subject="Fourth")
+        self.assertEqual(self.update_index(), 2)
+        self.assertEqual(
+            sorted(Msgsearch.objects.filter(term="second")
+                   .values_list("mail_id", flat=True)),
+            ["m2"]
+        )
+        self.assertEqual(
+            sorted(Msgsearch.objects.values_list("mail_id", flat=True)
+                   .distinct()),
+            ["m1", "m2", "m3", "m4"]
+        )
+
+    def test_delay(self):
+        """Check that messages being stored are not indexed yet
+        """
+        self.add_message("m1", "user@test.com", int(time.time()))
+        self.assertEqual(self.update_index(delay=300), 0)
+        self.assertEqual(self.update_index(), 1)
@@ -11,4 +11,5 @@ urlpatterns = patterns(
     (r'^release/(?P<mail_id>[\w\-\+]+)/$', 'release'),
     (r'^(?P<mail_id>[\w\-\+]+)/$', 'viewmail'),
     (r'^(?P<mail_id>[\w\-\+]+)/headers/$', 'viewheaders'),
+    (r'^(?P<mail_id>[\w\-\+]+)/raw/$', 'getrawmail'),
     )
@@ -1,13 +1,17 @@
 # coding: utf-8
-import email
+import re
 from django.shortcuts import render
-from django.http import HttpResponseRedirect, Http404
+from django.http import (
+    HttpResponseRedirect, Http404, StreamingHttpResponse
+)
 from django.template import Template, Context
 from django.utils.translation import ugettext as _, ungettext
 from django.core.urlresolvers import reverse
 from django.contrib.auth.decorators \
     import login_required, user_passes_test
 from django.db.models import Q
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import etag
 from modoboa.lib import parameters
 from modoboa.lib.exceptions import BadRequest
 from modoboa.lib.webutils import (
@@ -18,9 +22,19 @@ from modoboa.extensions.admin.models import Mailbox, Domain
 from modoboa.extensions.amavis.templatetags.amavis_tags import (
     quar_menu, viewm_menu
 )
-from .lib import selfservice, AMrelease, QuarantineNavigationParameters
+from .lib import (
+    selfservice, AMrelease, QuarantineNavigationParameters,
+    get_pending_requests_count, get_query_terms
+)
 from .sql_listing import SQLlisting, SQLemail, get_wrapper
-from .models import Msgrcpt
+from .models import Msgrcpt, Msgs
+
+
+def reset_messages_count(request):
+    """Make the next listing count messages again."""
+    if "quarantine_listing" in request.session:
+        request.session["quarantine_listing"].pop("counted", None)
+        request.session.modified = True
 
 
 def empty_quarantine(request):
@@ -34,6 +48,7 @@ def _listing(request):
     flt = None
     rcptfilter = None
     msgs = None
+    search = None
 
     if not request.user.is_superuser and request.user.group != 'SimpleUsers':
         if not Domain.objects.get_for_admin(request.user).count():
@@ -41,6 +56,7 @@ def _listing(request):
 
     navparams = QuarantineNavigationParameters(request)
     navparams.store()
+    order = navparams.get('order')
     pattern = navparams.get('pattern', '')
     if pattern:
         criteria = navparams.get('criteria')
@@ -54,6 +70,14 @@ def _listing(request):
             elif c == "to":
                 rcptfilter = pattern
                 continue
+            elif c == "fulltext":
+                # The pattern is escaped by navigation parameters
+                search = sorted(
+                    get_query_terms(re.sub(r"\\(.)", r"\1", pattern))
+                )
+                if not "sort_order" in request.GET:
+                    order = "-rank"
+                continue
             else:
                 raise BadRequest("unsupported search criteria %s" % c)
             flt = nfilter if flt is None else flt | nfilter
@@ -66,6 +90,8 @@ def _listing(request):
     page = navparams.get('page')
     lst = SQLlisting(
         request.user, msgs, flt,
+        state=request.session.setdefault("quarantine_listing", {}),
+        search=search, order=order,
         navparams=request.session["quarantine_navparams"],
         elems_per_page=int(parameters.get_user(request.user, "MESSAGES_PER_PAGE"))
     )
@@ -74,6 +100,7 @@ def _listing(request):
         return empty_quarantine(request)
 
     content = lst.fetch(request, page.id_start, page.id_stop)
+    request.session.modified = True
     ctx = getctx(
         "ok", listing=content, paginbar=pagination_bar(page), page=page.number
     )
@@ -129,7 +156,7 @@ def viewmail(request, mail_id):
     if request.user.mailbox_set.count():
         mb = Mailbox.objects.get(user=request.user)
         if rcpt == mb.full_address or rcpt in mb.alias_addresses:
-            get_wrapper().set_msgrcpt_status(rcpt, mail_id, 'V')
+            get_wrapper().set_msgrcpts_status([(rcpt, mail_id)], 'V')
 
     content = Template("""
 <iframe src="{{ url }}" id="mailcontent"></iframe>
@@ -142,15 +169,34 @@ def viewmail(request, mail_id):
 
 @login_required
 def viewheaders(request, mail_id):
-    content = ""
-    for qm in get_wrapper().get_mail_content(mail_id):
-        content += qm.mail_text
-    msg = email.message_from_string(content)
+    msg = get_wrapper().get_mail_headers(mail_id)
     return render(request, 'amavis/viewheader.html', {
         "headers": msg.items()
     })
 
 
+@login_required
+def getrawmail(request, mail_id):
+    """Download the original content of a quarantined message.
+
+    Only messages visible by the current user (see
+    ``SQLWrapper.get_mails``) can be downloaded. The message is
+    streamed chunk by chunk.
+    """
+    wrapper = get_wrapper()
+    if not Msgs.objects.filter(
+            mail_id=mail_id, mail_id__in=wrapper.get_mails(request)
+    ).exists():
+        raise Http404
+    response = StreamingHttpResponse(
+        wrapper.iter_mail_chunks(mail_id),
+        content_type="message/rfc822"
+    )
+    response["Content-Disposition"] = \
+        'attachment; filename="%s.eml"' % mail_id
+    return response
+
+
 def check_mail_id(request, mail_id):
     if type(mail_id) in [str, unicode]:
         if "rcpt" in request.POST:
@@ -165,7 +211,7 @@ def delete_selfservice(request, mail_id):
     if rcpt is None:
         raise BadRequest(_("Invalid request"))
     try:
-        get_wrapper().set_msgrcpt_status(rcpt, mail_id, 'D')
+        get_wrapper().set_msgrcpts_status([(rcpt, mail_id)], 'D')
     except Msgrcpt.DoesNotExist:
         raise BadRequest(_("Invalid request"))
     return render_to_json_response(_("Message deleted"))
@@ -178,15 +224,17 @@ def delete(request, mail_id):
     :param str mail_id: message unique identifier
     """
     mail_id = check_mail_id(request, mail_id)
-    wrapper = get_wrapper()
     mb = Mailbox.objects.get(user=request.user) \
         if request.user.group == 'SimpleUsers' else None
+    msgrcpts = []
     for mid in mail_id:
         r, i = mid.split()
         if mb is not None and r != mb.full_address \
                 and not r in mb.alias_addresses:
             continue
-        wrapper.set_msgrcpt_status(r, i, 'D')
+        msgrcpts.append((r, i))
+    get_wrapper().set_msgrcpts_status(msgrcpts, 'D')
+    reset_messages_count(request)
     message = ungettext("%(count)d message deleted successfully",
                         "%(count)d messages deleted successfully",
                         len(mail_id)) % {"count": len(mail_id)}
@@ -209,13 +257,13 @@ def release_selfservice(request, mail_id):
     if secret_id != msgrcpt.mail.secret_id:
         raise BadRequest(_("Invalid request"))
     if parameters.get_admin("USER_CAN_RELEASE") == "no":
-        wrapper.set_msgrcpt_status(rcpt, mail_id, 'p')
+        wrapper.set_msgrcpts_status([(rcpt, mail_id)], 'p')
         msg = _("Request sent")
     else:
         amr = AMrelease()
         result = amr.sendreq(mail_id, secret_id, rcpt)
         if result:
-            wrapper.set_msgrcpt_status(rcpt, mail_id, 'R')
+            wrapper.set_msgrcpts_status([(rcpt, mail_id)], 'R')
             msg = _("Message released")
         else:
             raise BadRequest(result)
@@ -240,10 +288,10 @@ def release(request, mail_id):
             continue
         msgrcpts += [wrapper.get_recipient_message(r, i)]
     if mb is not None and parameters.get_admin("USER_CAN_RELEASE") == "no":
-        for msgrcpt in msgrcpts:
-            wrapper.set_msgrcpt_status(
-                msgrcpt.rid.email, msgrcpt.mail.mail_id, 'p'
-            )
+        wrapper.set_msgrcpts_status([
+            (msgrcpt.rid.email, msgrcpt.mail.mail_id)
+            for msgrcpt in msgrcpts
+        ], 'p')
         message = ungettext("%(count)d request sent",
                             "%(count)d requests sent",
                             len(mail_id)) % {"count": len(mail_id)}
@@ -252,17 +300,19 @@ def release(request, mail_id):
             url=QuarantineNavigationParameters(request).back_to_listing()
         )
 
-    amr = AMrelease()
+    reset_messages_count(request)
+    results = AMrelease().release_many([
+        (rcpt.mail.mail_id, rcpt.mail.secret_id, rcpt.rid.email)
+        for rcpt in msgrcpts
+    ])
     error = None
-    for rcpt in msgrcpts:
-        result = amr.sendreq(
-            rcpt.mail.mail_id, rcpt.mail.secret_id, rcpt.rid.email
-        )
+    released = []
+    for rcpt, result in zip(msgrcpts, results):
         if result:
-            wrapper.set_msgrcpt_status(rcpt.rid.email, rcpt.mail.mail_id, 'R')
-        else:
-            error = result
-            break
+            released.append((rcpt.rid.email, rcpt.mail.mail_id))
+        elif error is None:
+            error = _("Failed to release message %s") % rcpt.mail.mail_id
+    wrapper.set_msgrcpts_status(released, 'R')
 
     if not error:
         message = ungettext("%(count)d message released successfully",
@@ -290,8 +340,19 @@ def process(request):
         return delete(request, ids)
 
 
+def nbrequests_etag(request):
+    return str(get_pending_requests_count(request.user))
+
+
 @login_required
 @user_passes_test(lambda u: u.group != 'SimpleUsers')
+@cache_control(private=True, max_age=0, must_revalidate=True)
+@etag(nbrequests_etag)
 def nbrequests(request):
-    result = get_wrapper().get_pending_requests(request.user)
+    """Return the number of pending release requests.
+
+    The response carries an ETag so pollers receive a *304 Not
+    Modified* response while the counter does not change.
+    """
+    result = get_pending_requests_count(request.user)
     return render_to_json_response({'requests': result})
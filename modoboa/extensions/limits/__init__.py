@@ -52,16 +52,21 @@ class Limits(ModoExtension):
     def load(self):
         from modoboa.extensions.limits.app_settings import ParametersForm
         from modoboa.extensions.limits import controls
+        from modoboa.extensions.limits.models import LimitTemplates
 
         parameters.register(ParametersForm, ugettext_lazy("Limits"))
         events.declare(levents)
         from modoboa.extensions.limits import general_callbacks
         if 'modoboa.extensions.limits.general_callbacks' in sys.modules:
             reload(general_callbacks)
+        LimitTemplates().invalidate()
 
     def destroy(self):
+        from modoboa.extensions.limits.models import LimitTemplates
+
         events.unregister_extension()
         parameters.unregister()
+        LimitTemplates().invalidate()
         Group.objects.get(name="Resellers").delete()
 
 exts_pool.register_extension(Limits)
@@ -7,7 +7,7 @@
 from modoboa.lib import events
 from modoboa.lib.permissions import get_object_owner
 from .lib import LimitReached, inc_limit_usage, dec_limit_usage
-from .models import LimitTemplates, LimitsPool
+from .models import LimitsPool
 
 
 def check_limit(user, lname, count=1):
@@ -38,16 +38,12 @@ def move_pool_resource(owner, user):
     except LimitsPool.DoesNotExist:
         return
     if not owner.is_superuser:
-        for ltpl in LimitTemplates().templates:
-            l = user.limitspool.get_limit(ltpl[0])
+        for l in pool.get_limits().values():
             if l.maxvalue < 0:
                 continue
-            ol = owner.limitspool.get_limit(ltpl[0])
-            ol.curvalue += l.curvalue
-            ol.maxvalue += l.maxvalue
-            ol.save()
+            owner.limitspool.move_limit(l.name, l.curvalue, l.maxvalue)
 
-    user.limitspool.delete()
+    pool.delete()
 
 
 @events.observe('DomainCreated')
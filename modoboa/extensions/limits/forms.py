@@ -2,7 +2,7 @@
 from django import forms
 from django.utils.translation import ugettext as _, ugettext_lazy
 from modoboa.lib import parameters
-from .models import LimitTemplates
+from .models import LimitTemplates, Limit
 from .lib import BadLimitValue, UnsufficientResource
 
 
@@ -65,11 +65,8 @@ class ResourcePoolForm(forms.Form):
             newvalue -= limit.maxvalue
             if newvalue == 0:
                 return
-        remain = ol.maxvalue - ol.curvalue
-        if newvalue > remain:
+        if not pool.allocate(limit.name, newvalue):
             raise UnsufficientResource(ol)
-        ol.maxvalue -= newvalue
-        ol.save()
 
     def save(self):
         from modoboa.lib.permissions import get_object_owner
@@ -78,8 +75,10 @@ class ResourcePoolForm(forms.Form):
         for ltpl in LimitTemplates().templates:
             if not ltpl[0] in self.cleaned_data:
                 continue
-            l = self.account.limitspool.limit_set.get(name=ltpl[0])
+            pool = self.account.limitspool
+            l = pool.get_limit(ltpl[0])
+            if l is None:
+                raise Limit.DoesNotExist
             if not owner.is_superuser:
                 self.allocate_from_pool(l, owner.limitspool)
-            l.maxvalue = self.cleaned_data[ltpl[0]]
-            l.save()
+            pool.set_maxvalue(ltpl[0], self.cleaned_data[ltpl[0]])
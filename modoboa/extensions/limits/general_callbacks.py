@@ -29,7 +29,11 @@ def display_pool_usage(user, target, currentpage):
             and (len(tpl) == 3 or tpl[3] == user.group)
         ]
 
-    limits = user.limitspool.limit_set.filter(name__in=names, maxvalue__gt=0)
+    limits = [
+        l for l in sorted(user.limitspool.get_limits().values(),
+                          key=lambda l: l.pk)
+        if l.name in names and l.maxvalue > 0
+    ]
     if len(limits) == 0:
         return []
     return [render_to_string("limits/poolusage.html", dict(limits=limits))]
@@ -4,9 +4,13 @@
 -------------------------------
 
 """
+import csv
+import cStringIO
+import json
+from django.db.models import Q
 from django.utils.translation import ugettext as _
 from modoboa.lib.exceptions import ModoboaException
-from modoboa.extensions.limits.models import LimitsPool
+from modoboa.extensions.limits.models import LimitsPool, Limit
 
 
 class LimitReached(ModoboaException):
@@ -36,11 +40,17 @@ class BadLimitValue(ModoboaException):
 def inc_limit_usage(user, lname):
     """Increase a given limit usage.
 
+    The limit is checked again by the same query so concurrent
+    creations can't exceed it.
+
+    :raises: ``LimitReached``
     """
     try:
-        user.limitspool.inc_curvalue(lname)
+        pool = user.limitspool
     except LimitsPool.DoesNotExist:
-        pass
+        return
+    if not pool.inc_curvalue(lname):
+        raise LimitReached(pool.get_limit(lname))
 
 
 def dec_limit_usage(user, lname):
@@ -50,3 +60,91 @@ def dec_limit_usage(user, lname):
         user.limitspool.dec_curvalue(lname)
     except LimitsPool.DoesNotExist:
         pass
+
+
+REPORT_COLUMNS = ["username", "limit", "curvalue", "maxvalue", "usage"]
+
+
+def get_usage_report(groups=None, threshold=None, chunksize=1000):
+    """Return the usage of every pool.
+
+    Rows (limits joined with their pool and user) are fetched by
+    chunks of ``chunksize`` rows, each chunk starting after the last
+    row of the previous one, so only one chunk is kept in memory
+    whatever the number of pools is.
+
+    :param list groups: only include users belonging to these groups
+    :param int threshold: only include limits used at this
+                          percentage or more
+    :param int chunksize: number of rows fetched by each query
+    :return: a generator of tuples (see ``REPORT_COLUMNS``)
+    """
+    from django.db import connection
+    from modoboa.core.models import User
+
+    qset = Limit.objects.all()
+    if groups:
+        qset = qset.filter(
+            pool__user__in=User.objects.filter(groups__name__in=groups)
+        )
+    if threshold is not None:
+        qn = connection.ops.quote_name
+        table = qn(Limit._meta.db_table)
+        qset = qset.filter(maxvalue__gt=0).extra(
+            where=["%s.%s * 100 >= %s.%s * %%s" % (
+                table, qn(Limit._meta.get_field("curvalue").column),
+                table, qn(Limit._meta.get_field("maxvalue").column)
+            )],
+            params=[threshold]
+        )
+    qset = qset.order_by("pool__user__username", "name")
+    last = None
+    while True:
+        chunk = qset
+        if last is not None:
+            chunk = chunk.filter(
+                Q(pool__user__username__gt=last[0]) |
+                Q(pool__user__username=last[0], name__gt=last[1])
+            )
+        rows = list(chunk.values_list(
+            "pool__user__username", "name", "curvalue", "maxvalue"
+        )[:chunksize])
+        for username, name, curvalue, maxvalue in rows:
+            usage = Limit(curvalue=curvalue, maxvalue=maxvalue).usage
+            yield (username, name, curvalue, maxvalue, usage)
+        if len(rows) < chunksize:
+            break
+        last = rows[-1]
+
+
+def generate_usage_report(rows, fmt="csv", bufsize=65536):
+    """Generate the content of a usage report.
+
+    Content is returned by blocks of ``bufsize`` bytes (at least).
+
+    :param rows: rows returned by ``get_usage_report``
+    :param str fmt: output format (csv or json)
+    """
+    fp = cStringIO.StringIO()
+    if fmt == "json":
+        fp.write("[")
+        for cpt, row in enumerate(rows):
+            if cpt:
+                fp.write(", ")
+            fp.write(json.dumps(dict(zip(REPORT_COLUMNS, row))))
+            if fp.tell() >= bufsize:
+                yield fp.getvalue()
+                fp.seek(0)
+                fp.truncate()
+        fp.write("]")
+    else:
+        csvwriter = csv.writer(fp)
+        csvwriter.writerow(REPORT_COLUMNS)
+        for row in rows:
+            csvwriter.writerow([unicode(value).encode("utf-8") for value in row])
+            if fp.tell() >= bufsize:
+                yield fp.getvalue()
+                fp.seek(0)
+                fp.truncate()
+    yield fp.getvalue()
+    fp.close()
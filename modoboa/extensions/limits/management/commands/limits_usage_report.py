@@ -0,0 +1,31 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from modoboa.extensions.limits.lib import (
+    get_usage_report, generate_usage_report
+)
+
+
+class Command(BaseCommand):
+    help = 'Prints the resources usage of every administrator'
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--format', default='csv', choices=['csv', 'json'],
+            help='Output format (csv or json)'
+        ),
+        make_option(
+            '--group', action='append', dest='groups',
+            help='Only include members of this group (can be repeated)'
+        ),
+        make_option(
+            '--threshold', type='int', default=None,
+            help='Only include limits used at this percentage or more'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        if options["threshold"] is not None and options["threshold"] < 0:
+            raise CommandError("threshold must be a positive integer")
+        rows = get_usage_report(options["groups"], options["threshold"])
+        for chunk in generate_usage_report(rows, options["format"]):
+            self.stdout.write(chunk, ending="")
@@ -1,15 +1,28 @@
 # coding: utf-8
 from django.db import models
+from django.db.models import F, Q
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.utils.translation import ugettext as _, ugettext_lazy
 from modoboa.lib import parameters
 from modoboa.lib.singleton import Singleton
 from django.conf import settings
 from modoboa.lib import events
+from modoboa.core.extensions import exts_pool
 
 
 class LimitTemplates(Singleton):
+    """The registry of limit templates.
+
+    Templates provided by extensions (*GetExtraLimitTemplates* event)
+    are collected the first time they are needed and kept until
+    :meth:`invalidate` is called (ie. when an extension is loaded or
+    destroyed) or until extension states change (possibly in another
+    process).
+    """
 
     def __init__(self):
+        self.__cache = None
         self.__templates = [
             ("domain_admins_limit", ugettext_lazy("Domain admins"),
              ugettext_lazy("Maximum number of domain administrators this user can create"),
@@ -25,15 +38,58 @@ class LimitTemplates(Singleton):
             ("mailbox_aliases_limit", ugettext_lazy("Mailbox aliases"),
              ugettext_lazy("Maximum number of mailbox aliases this user can create"))
         ]
-    
+
+    def __load(self):
+        version = exts_pool.states_version
+        cached = self.__cache
+        if cached is None or not version.is_valid(cached[0]):
+            stamp = version.stamp()
+            templates = self.__templates \
+                + events.raiseQueryEvent('GetExtraLimitTemplates')
+            cached = (
+                stamp, templates, dict((tpl[0], tpl) for tpl in templates)
+            )
+            self.__cache = cached
+        return cached
+
+    def invalidate(self):
+        """Forget collected templates.
+
+        They will be collected again on next access.
+        """
+        self.__cache = None
+
     @property
     def templates(self):
-        return self.__templates + events.raiseQueryEvent('GetExtraLimitTemplates')
+        return self.__load()[1]
+
+    def get(self, name):
+        """Return the template corresponding to the given limit name.
+
+        :param str name: limit name
+        :return: a template (tuple) or None
+        """
+        return self.__load()[2].get(name)
 
 
 class LimitsPool(models.Model):
+    """The resources of an account.
+
+    Limits are loaded using one query the first time they are needed
+    and kept with the pool (ie. during the current request) until a
+    limit is modified. Usage counters are modified using atomic
+    ``UPDATE`` statements.
+    """
     user = models.OneToOneField(settings.AUTH_USER_MODEL)
 
+    #: Incremented each time a limit is modified (used to invalidate
+    #: the limits loaded by pools)
+    generation = 0
+
+    @classmethod
+    def limits_changed(cls):
+        cls.generation += 1
+
     def create_limits(self, creator):
         """Create limits for this pool.
 
@@ -43,57 +99,112 @@ class LimitsPool(models.Model):
 
         :param ``User`` creator: user creating this pool
         """
+        existing = set(self.limit_set.values_list("name", flat=True))
+        limits = []
         for ltpl in LimitTemplates().templates:
-            try:
-                Limit.objects.get(name=ltpl[0], pool=self)
-            except Limit.DoesNotExist:
-                maxvalue = int(parameters.get_admin("DEFLT_%s" % ltpl[0].upper())) \
-                    if creator.is_superuser else 0
-                Limit.objects.create(
-                    name=ltpl[0], pool=self, maxvalue=maxvalue
-                )
+            if ltpl[0] in existing:
+                continue
+            maxvalue = int(parameters.get_admin("DEFLT_%s" % ltpl[0].upper())) \
+                if creator.is_superuser else 0
+            limits.append(Limit(name=ltpl[0], pool=self, maxvalue=maxvalue))
+        if limits:
+            Limit.objects.bulk_create(limits)
+            LimitsPool.limits_changed()
+
+    def get_limits(self):
+        """Return the limits of this pool.
+
+        :return: a dictionary (name => ``Limit`` object)
+        """
+        cache = getattr(self, "_limits", None)
+        if cache is None or cache[0] != LimitsPool.generation:
+            cache = self._limits = (
+                LimitsPool.generation,
+                dict((l.name, l) for l in self.limit_set.all())
+            )
+        return cache[1]
+
+    def _get(self, lname):
+        try:
+            return self.get_limits()[lname]
+        except KeyError:
+            raise Limit.DoesNotExist
+
+    def _update(self, lname, condition=None, **values):
+        """Update a limit using one query.
+
+        :param str lname: limit name
+        :param condition: an optional ``Q`` object
+        :return: True if the limit has been updated
+        """
+        qset = self.limit_set.filter(name=lname)
+        if condition is not None:
+            qset = qset.filter(condition)
+        updated = qset.update(**values)
+        LimitsPool.limits_changed()
+        return updated > 0
 
     def getcurvalue(self, lname):
-        l = self.limit_set.get(name=lname)
-        return l.curvalue
+        return self._get(lname).curvalue
 
     def getmaxvalue(self, lname):
-        l = self.limit_set.get(name=lname)
-        return l.maxvalue
+        return self._get(lname).maxvalue
 
     def set_maxvalue(self, lname, value):
-        l = self.limit_set.get(name=lname)
-        l.maxvalue = value
-        l.save()
+        self._update(lname, maxvalue=value)
 
     def inc_curvalue(self, lname, nb=1):
-        l = self.limit_set.get(name=lname)
-        l.curvalue += nb
-        l.save()
+        """Reserve resource.
+
+        The check and the increment are done using the same query so
+        concurrent requests can't exceed the limit.
+
+        :return: False if the limit is reached, True otherwise
+        """
+        if self._update(
+            lname,
+            Q(maxvalue__lte=-1) | Q(curvalue__lte=F("maxvalue") - nb),
+            curvalue=F("curvalue") + nb
+        ):
+            return True
+        return self.get_limit(lname) is None
 
     def dec_curvalue(self, lname, nb=1):
-        l = self.limit_set.get(name=lname)
-        if not l.curvalue:
-            return
-        l.curvalue -= nb
-        l.save()
+        """Release resource.
+
+        The current value never goes below 0: if less than ``nb`` items
+        are in use, it is reset.
+        """
+        if not self._update(
+            lname, Q(curvalue__gte=nb), curvalue=F("curvalue") - nb
+        ):
+            self._update(lname, Q(curvalue__gt=0), curvalue=0)
 
     def dec_limit(self, lname, nb=1):
-        l = self.limit_set.get(name=lname)
-        l.curvalue -= nb
-        if l.maxvalue > -1:
-            l.maxvalue -= nb
-        l.save()
+        self._update(lname, Q(maxvalue__gt=-1), maxvalue=F("maxvalue") - nb)
+        self._update(lname, curvalue=F("curvalue") - nb)
 
     def inc_limit(self, lname, nb=1):
-        l = self.limit_set.get(name=lname)
-        l.curvalue += nb
-        if l.maxvalue > -1:
-            l.maxvalue += nb
-        l.save()
+        self._update(lname, Q(maxvalue__gt=-1), maxvalue=F("maxvalue") + nb)
+        self._update(lname, curvalue=F("curvalue") + nb)
+
+    def move_limit(self, lname, curvalue, maxvalue):
+        """Add resource coming from another pool."""
+        self._update(lname, curvalue=F("curvalue") + curvalue,
+                     maxvalue=F("maxvalue") + maxvalue)
+
+    def allocate(self, lname, nb):
+        """Give resource to another pool.
+
+        :return: False if there is not enough resource, True otherwise
+        """
+        return self._update(
+            lname, Q(maxvalue__gte=F("curvalue") + nb),
+            maxvalue=F("maxvalue") - nb
+        )
 
     def will_be_reached(self, lname, nb=1):
-        l = self.limit_set.get(name=lname)
+        l = self._get(lname)
         if l.maxvalue <= -1:
             return False
         if l.curvalue + nb > l.maxvalue:
@@ -101,10 +212,7 @@ class LimitsPool(models.Model):
         return False
 
     def get_limit(self, lname):
-        try:
-            return self.limit_set.get(name=lname)
-        except Limit.DoesNotExist:
-            return None
+        return self.get_limits().get(lname)
 
 
 class Limit(models.Model):
@@ -126,10 +234,8 @@ class Limit(models.Model):
 
     @property
     def label(self):
-        for l in LimitTemplates().templates:
-            if l[0] == self.name:
-                return l[1]
-        return ""
+        tpl = LimitTemplates().get(self.name)
+        return tpl[1] if tpl is not None else ""
 
     def __str__(self):
         if self.maxvalue == -2:
@@ -137,3 +243,8 @@ class Limit(models.Model):
         if self.maxvalue == -1:
             return _("unlimited")
         return "%d%%" % self.usage
+
+
+@receiver([post_save, post_delete], sender=Limit)
+def limit_changed(sender, instance, **kwargs):
+    LimitsPool.limits_changed()
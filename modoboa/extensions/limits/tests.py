@@ -1,12 +1,20 @@
+import json
+from StringIO import StringIO
+from django.core.files.base import ContentFile
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
-from modoboa.lib.tests import ExtTestCase
-from modoboa.lib import parameters
+from modoboa.lib.tests import ExtTestCase, QueriesCounter
+from modoboa.lib import events, parameters
+from modoboa.core.extensions import exts_pool
 from modoboa.core.models import User
 from modoboa.core.factories import UserFactory
 from modoboa.extensions.admin.factories import (
     DomainFactory, MailboxFactory, populate_database
 )
-from modoboa.extensions.admin.models import Alias, Domain, DomainAlias
+from modoboa.extensions.admin.models import (
+    Alias, Domain, DomainAlias, ImportJob
+)
+from modoboa.extensions.limits.lib import get_usage_report
 from modoboa.extensions.limits.models import LimitTemplates
 
 
@@ -38,6 +46,37 @@ class PermissionsTestCase(ExtTestCase):
         )
         self.assertEqual(resp, "Permission denied")
 
+    def test_templates_cache(self):
+        """Check that extra templates are collected only once
+        """
+        calls = []
+
+        def extra_templates():
+            calls.append(1)
+            return [("test_limit", "Test", "Test limit")]
+
+        events.register("GetExtraLimitTemplates", extra_templates)
+        try:
+            LimitTemplates().invalidate()
+            self.assertEqual(LimitTemplates().get("test_limit")[1], "Test")
+            self.assertEqual(LimitTemplates().templates[-1][0], "test_limit")
+            self.assertEqual(len(calls), 1)
+
+            # Extension states changed (maybe in another process)
+            exts_pool.states_version.bump()
+            exts_pool.states_version.interval = 0
+            self.assertEqual(LimitTemplates().get("test_limit")[1], "Test")
+            self.assertEqual(len(calls), 2)
+        finally:
+            exts_pool.states_version.interval = 1
+            events.unregister("GetExtraLimitTemplates", extra_templates)
+            LimitTemplates().invalidate()
+        self.assertIsNone(LimitTemplates().get("test_limit"))
+        self.assertEqual(
+            User.objects.get(username="admin@test.com")
+            .limitspool.get_limit("mailboxes_limit").label, "Mailboxes"
+        )
+
 
 class ResourceTestCase(ExtTestCase):
     fixtures = ["initial_users.json"]
@@ -124,6 +163,36 @@ class DomainAdminTestCase(ResourceTestCase):
         self.clt.logout()
         self.clt.login(username='admin@test.com', password='toto')
 
+    def test_concurrent_reservations(self):
+        """Check that stale pools can't exceed a limit
+        """
+        pool1 = User.objects.get(username='admin@test.com').limitspool
+        pool2 = User.objects.get(username='admin@test.com').limitspool
+        self.assertFalse(pool1.will_be_reached('mailboxes_limit'))
+        self.assertFalse(pool2.will_be_reached('mailboxes_limit', 2))
+        with QueriesCounter() as counter:
+            pool1.will_be_reached('mailboxes_limit')
+            pool1.getcurvalue('mailboxes_limit')
+        self.assertEqual(counter.count, 0)
+        self.assertTrue(pool1.inc_curvalue('mailboxes_limit'))
+        self.assertFalse(pool2.inc_curvalue('mailboxes_limit', 2))
+        self.assertTrue(pool2.inc_curvalue('mailboxes_limit'))
+        self.assertFalse(pool1.inc_curvalue('mailboxes_limit'))
+        self._check_limit('mailboxes', 2, 2)
+
+    def test_release_resources(self):
+        """Check that the current value of a limit can't go below 0
+        """
+        pool = self.user.limitspool
+        self.assertTrue(pool.inc_curvalue('mailboxes_limit', 2))
+        pool.dec_curvalue('mailboxes_limit', 2)
+        self._check_limit('mailboxes', 0, 2)
+        self.assertTrue(pool.inc_curvalue('mailboxes_limit'))
+        pool.dec_curvalue('mailboxes_limit', 2)
+        self._check_limit('mailboxes', 0, 2)
+        pool.dec_curvalue('mailboxes_limit')
+        self._check_limit('mailboxes', 0, 2)
+
     def test_mailboxes_limit(self):        
         self._create_account('tester1@test.com')
         self._check_limit('mailboxes', 1, 2)
@@ -138,6 +207,30 @@ class DomainAdminTestCase(ResourceTestCase):
         )
         self._check_limit('mailboxes', 1, 2)
 
+    def test_mailboxes_limit_through_import(self):
+        """Check that a limit reached in the middle of an import batch
+        is reported for each line
+        """
+        f = ContentFile(b"".join(
+            "account; tester%d@test.com; toto; Tester; %d; True; SimpleUsers; "
+            "tester%d@test.com; 10\n" % (cpt, cpt, cpt) for cpt in range(1, 5)
+        ), name="identities.csv")
+        self.clt.post(
+            reverse("modoboa.extensions.admin.views.import.import_identities"),
+            {"sourcefile": f, "crypt_password": True}
+        )
+        call_command("process_import_jobs")
+        job = ImportJob.objects.latest("id")
+        self.assertEqual(job.imported, 2)
+        self.assertEqual(job.nerrors, 2)
+        self.assertIn("Line 3: Mailboxes: limit reached", job.message)
+        self.assertIn("Line 4: Mailboxes: limit reached", job.message)
+        User.objects.get(username="tester2@test.com")
+        self.assertFalse(
+            User.objects.filter(username="tester3@test.com").exists()
+        )
+        self._check_limit('mailboxes', 2, 2)
+
     def test_aliases_limit(self):
         self._create_alias('alias1@test.com')
         self._check_limit('mailbox_aliases', 1, 2)
@@ -401,3 +494,55 @@ class ResellerTestCase(ResourceTestCase):
         self.assertEqual(resp, 'Not enough resources')
         self._check_limit('mailboxes', 1, 2)
         self._check_limit('mailbox_aliases', 0, 2)
+
+
+class UsageReportTestCase(ResourceTestCase):
+
+    def setUp(self):
+        super(UsageReportTestCase, self).setUp()
+        self.user = User.objects.get(username='admin@test.com')
+        self.user.limitspool.set_maxvalue('mailboxes_limit', 4)
+        self.user.limitspool.inc_curvalue('mailboxes_limit', 3)
+        UserFactory.create(username='reseller', groups=('Resellers',))
+
+    def test_command(self):
+        output = StringIO()
+        call_command(
+            'limits_usage_report', groups=['DomainAdmins'], stdout=output
+        )
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0], 'username,limit,curvalue,maxvalue,usage')
+        self.assertIn('admin@test.com,mailboxes_limit,3,4,75', lines)
+        self.assertFalse([l for l in lines if l.startswith('reseller,')])
+
+    def test_report_chunks(self):
+        """Check that fetching rows by chunks doesn't change the report
+        """
+        rows = list(get_usage_report())
+        self.assertTrue(len(rows) > 3)
+        with QueriesCounter() as counter:
+            self.assertEqual(list(get_usage_report(chunksize=2)), rows)
+        self.assertEqual(counter.count, len(rows) / 2 + 1)
+
+    def test_endpoint(self):
+        url = reverse('modoboa.extensions.limits.views.usage_report')
+        with QueriesCounter() as counter:
+            response = self.clt.get(url, {'threshold': 50})
+            content = ''.join(response.streaming_content)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(content), [{
+            'username': 'admin@test.com', 'limit': 'mailboxes_limit',
+            'curvalue': 3, 'maxvalue': 4, 'usage': 75
+        }])
+        response = self.clt.get(url, {'group': 'Resellers', 'format': 'csv'})
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = ''.join(response.streaming_content).splitlines()[1:]
+        self.assertTrue(rows)
+        self.assertTrue(all(row.startswith('reseller,') for row in rows))
+
+        count = counter.count
+        UserFactory.create(username='reseller2', groups=('Resellers',))
+        with QueriesCounter() as counter:
+            response = self.clt.get(url, {'threshold': 50})
+            ''.join(response.streaming_content)
+        self.assertEqual(counter.count, count)
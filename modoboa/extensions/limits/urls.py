@@ -3,4 +3,5 @@ from django.conf.urls import patterns
 urlpatterns = patterns(
     'modoboa.extensions.limits.views',
 
-    )
+    (r'^report/$', 'usage_report'),
+)
@@ -1 +1,29 @@
 # coding: utf-8
+from django.http import StreamingHttpResponse
+from django.contrib.auth.decorators import login_required, user_passes_test
+from modoboa.lib.exceptions import BadRequest
+from .lib import get_usage_report, generate_usage_report
+
+
+@login_required
+@user_passes_test(lambda u: u.is_superuser)
+def usage_report(request):
+    """Return the resources usage of every administrator.
+
+    Accepted parameters: *format* (csv or json), *group* (can be
+    repeated) and *threshold* (a percentage).
+    """
+    fmt = request.GET.get("format", "json")
+    if fmt not in ["csv", "json"]:
+        raise BadRequest("Unsupported format")
+    threshold = request.GET.get("threshold", None)
+    if threshold is not None:
+        try:
+            threshold = int(threshold)
+        except ValueError:
+            raise BadRequest("Invalid threshold")
+    rows = get_usage_report(request.GET.getlist("group"), threshold)
+    return StreamingHttpResponse(
+        generate_usage_report(rows, fmt),
+        content_type="text/csv" if fmt == "csv" else "application/json"
+    )
@@ -42,6 +42,16 @@ def init_limits_dependant_features():
     grp.save()
 
 
+def reset_limit_templates():
+    """Make the *limits* extension collect templates again.
+
+    Must be called each time our templates are (un)registered.
+    """
+    from modoboa.extensions.limits.models import LimitTemplates
+
+    LimitTemplates().invalidate()
+
+
 def init_amavis_dependant_features():
     """Populate amavis database.
 
@@ -96,6 +106,7 @@ class PostfixRelayDomains(ModoExtension):
             import limits_callbacks
             if 'modoboa.extensions.postfix_relay_domains.limits_callbacks' in sys.modules:
                 reload(limits_callbacks)
+            reset_limit_templates()
         if exts_pool.is_extension_enabled('amavis'):
             import amavis_callbacks
             if 'modoboa.extensions.postfix_relay_domains.amavis_callbacks' in sys.modules:
@@ -104,5 +115,7 @@ class PostfixRelayDomains(ModoExtension):
     def destroy(self):
         events.unregister_extension()
         parameters.unregister()
+        if exts_pool.is_extension_enabled('limits'):
+            reset_limit_templates()
 
 exts_pool.register_extension(PostfixRelayDomains)
@@ -46,7 +46,8 @@ def extra_domain_menu_entries(user):
 def extra_domain_entries(user, domfilter, searchquery, **extrafilters):
     if domfilter is not None and domfilter and domfilter != 'relaydomain':
         return []
-    relay_domains = RelayDomain.objects.get_for_admin(user)
+    relay_domains = RelayDomain.objects.get_for_admin(user) \
+        .select_related("service").prefetch_related("relaydomainalias_set")
     if searchquery is not None:
         q = Q(name__contains=searchquery)
         q |= Q(relaydomainalias__name__contains=searchquery)
@@ -55,7 +56,7 @@ def extra_domain_entries(user, domfilter, searchquery, **extrafilters):
         relay_domains = relay_domains.filter(
             Q(service__name=extrafilters['srvfilter'])
         )
-    return relay_domains
+    return [relay_domains]
 
 
 @events.observe('GetDomainModifyLink')
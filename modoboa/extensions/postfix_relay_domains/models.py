@@ -19,7 +19,9 @@ class RelayDomainManager(Manager):
         """
         if admin.is_superuser:
             return self.get_query_set()
-        return self.get_query_set().filter(owners__user=admin)
+        return self.get_query_set().filter(
+            admin.get_administered_filter(self.model)
+        )
 
 
 class ServiceManager(Manager):
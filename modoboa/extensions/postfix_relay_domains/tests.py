@@ -1,8 +1,13 @@
+from django.core.files.base import ContentFile
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
 from modoboa.core.factories import UserFactory
+from modoboa.core.models import User
 from modoboa.lib import parameters
-from modoboa.lib.tests import ExtTestCase
+from modoboa.lib.tests import ExtTestCase, QueriesCounter
 from modoboa.extensions.admin import factories
+from modoboa.extensions.admin.lib import get_domains
+from modoboa.extensions.admin.models import ImportJob
 from modoboa.extensions.limits.tests import ResourceTestCase
 from .models import RelayDomain, RelayDomainAlias, Service
 from .factories import RelayDomainFactory, RelayDomainAliasFactory
@@ -161,6 +166,55 @@ class RelayDomainsTestCase(ExtTestCase, Operations):
         with self.assertRaises(RelayDomain.DoesNotExist):
             RelayDomain.objects.get(name='relaydomainalias.tld')
 
+    def test_import_relaydomain(self):
+        """Check that relay domains are imported by the import worker
+        """
+        f = ContentFile(b"""relaydomain; relaydomain1.tld; external.host.tld; dummy; True; False
+relaydomainalias; relaydomainalias1.tld; relaydomain1.tld; True
+""", name="domains.csv")
+        self.clt.post(
+            reverse("modoboa.extensions.admin.views.import.import_domains"),
+            {"sourcefile": f}
+        )
+        call_command("process_import_jobs")
+        job = ImportJob.objects.get(filename="domains.csv")
+        self.assertEqual(job.status, "done")
+        self.assertEqual(job.imported, 2)
+        rdom = RelayDomain.objects.get(name="relaydomain1.tld")
+        self.assertEqual(rdom.target_host, "external.host.tld")
+        RelayDomainAlias.objects.get(name="relaydomainalias1.tld", target=rdom)
+
+    def test_domains_listing(self):
+        """Check that domains and relay domains are merged by the database
+        """
+        user = User.objects.get(username='admin')
+        domains = get_domains(user)
+        self.assertEqual(domains.count(), 3)
+        self.assertEqual(
+            [dom.name for dom in domains],
+            ['relaydomain.tld', 'test.com', 'test2.com']
+        )
+        self.assertEqual(
+            [dom.name for dom in domains.order_by('-name')[1:3]],
+            ['test.com', 'relaydomain.tld']
+        )
+        self.assertEqual(
+            [dom.tags[0]['name'] for dom in domains.order_by('type', 'name')],
+            ['domain', 'domain', 'relaydomain']
+        )
+        with QueriesCounter() as counter:
+            domains[0:2]
+        self.assertEqual(counter.count, 5)
+
+        response = self.ajax_get(
+            "%s?sort_order=-name" %
+            reverse("modoboa.extensions.admin.views.domain._domains"), {}
+        )
+        self.assertLess(
+            response['table'].index('test.com'),
+            response['table'].index('relaydomain.tld')
+        )
+
 
 class LimitsTestCase(ExtTestCase, Operations):
     fixtures = ['initial_users.json']
@@ -0,0 +1,67 @@
+# coding: utf-8
+"""
+Helpers for process-local caches.
+"""
+import time
+from django.core.cache import cache
+
+
+class SharedVersion(object):
+    """A version number shared between processes using the Django cache.
+
+    A process-local cache records a *stamp* (see :meth:`stamp`) when
+    it is built and checks it with :meth:`is_valid` before each
+    access. The stamp becomes invalid when another process calls
+    :meth:`bump` or when it is older than ``timeout`` seconds (so
+    modifications are eventually seen even if the cache backend is not
+    shared between processes).
+
+    To avoid one cache access per lookup, the shared version is read
+    at most every ``interval`` seconds.
+
+    :param str key: the cache key holding the version
+    :param int interval: seconds between two checks of the version
+    :param int timeout: maximum lifetime of a stamp in seconds
+    """
+
+    def __init__(self, key, interval=1, timeout=60):
+        self.key = key
+        self.interval = interval
+        self.timeout = timeout
+
+    def get(self):
+        """Return the current version."""
+        version = cache.get(self.key)
+        if version is None:
+            version = int(time.time() * 1000)
+            cache.add(self.key, version)
+        return version
+
+    def bump(self):
+        """Invalidate the stamps of every process."""
+        try:
+            cache.incr(self.key)
+        except ValueError:
+            cache.set(self.key, int(time.time() * 1000))
+
+    def stamp(self):
+        """Return a stamp for a cache being built.
+
+        :return: a list (version, creation time, last check time)
+        """
+        now = time.time()
+        return [self.get(), now, now]
+
+    def is_valid(self, stamp):
+        """Tell if a cache built with the given stamp can be used.
+
+        :param list stamp: a value returned by :meth:`stamp`
+        :rtype: bool
+        """
+        now = time.time()
+        if now - stamp[1] > self.timeout:
+            return False
+        if now - stamp[2] > self.interval:
+            stamp[2] = now
+            return self.get() == stamp[0]
+        return True
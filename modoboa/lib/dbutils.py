@@ -38,3 +38,148 @@ def db_type(cname="default"):
         if settings.DATABASES[cname]['ENGINE'].find(t) != -1:
             return t
     return None
+
+
+def sql_concat(*expressions):
+    """Return a SQL expression concatenating the given ones
+
+    :param expressions: SQL expressions
+    :return: a string
+    """
+    if db_type() == "mysql":
+        return "CONCAT(%s)" % ", ".join(expressions)
+    return "(%s)" % " || ".join(expressions)
+
+
+class QuerySetUnion(object):
+    """A sorted union of querysets evaluated by the database.
+
+    Each queryset is reduced to its primary key, a type name and some
+    sort columns. The database merges, sorts and slices the result
+    using a single ``UNION ALL`` query, then only the objects of the
+    requested slice are loaded. This way, the cost of a listing page
+    does not depend on the total number of rows.
+
+    This object can be given to a ``Paginator``.
+
+    :param list parts: a list of (type name, queryset, fields) tuples,
+                       ``fields`` being the fields matching ``keys``
+    :param list keys: the names of the sort columns
+    :param list ordering: sort columns (a ``-`` prefix means
+                          descending order, ``type`` is also accepted)
+    """
+
+    chunk_size = 500
+
+    def __init__(self, parts, keys, ordering=None):
+        self.parts = parts
+        self.keys = keys
+        self.ordering = ordering if ordering is not None else keys
+        self._count = None
+
+    def order_by(self, *ordering):
+        """Return a copy of this union using a new ordering."""
+        return QuerySetUnion(self.parts, self.keys, ordering)
+
+    def count(self):
+        if self._count is None:
+            self._count = sum(qs.count() for typ, qs, fields in self.parts)
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def _get_sql(self, limit, offset):
+        from django.db import connections
+
+        columns = ["type", "pk"] + list(self.keys)
+        selects = []
+        params = []
+        for idx, (typename, qs, fields) in enumerate(self.parts):
+            qset = qs.order_by().values_list("pk", *fields)
+            # Columns coming from extra() are always selected first,
+            # so we reference them by name to get the same layout
+            # for every part.
+            colnames = dict((name, name) for name in qset.extra_names)
+            for fname, col in zip(qset.field_names, qset.query.select):
+                colnames[fname] = col[1]
+            qn = connections[qs.db].ops.quote_name
+            sql, qparams = qset.query.sql_with_params()
+            selects.append("SELECT %%s, %s FROM (%s) t%d" % (
+                ", ".join(["t%d.%s" % (idx, qn(colnames[fname]))
+                           for fname in ["pk"] + list(fields)]),
+                sql, idx
+            ))
+            params += [typename] + list(qparams)
+        orders = []
+        for name in self.ordering:
+            position = columns.index(name.lstrip("-")) + 1
+            orders.append(
+                "%d DESC" % position if name.startswith("-") else str(position)
+            )
+        sql = "SELECT * FROM (%s) u ORDER BY %s LIMIT %d OFFSET %d" % (
+            " UNION ALL ".join(selects), ", ".join(orders + ["1", "2"]),
+            limit, offset
+        )
+        return sql, params
+
+    def _fetch(self, limit, offset):
+        from django.db import connections
+
+        if not self.parts or limit <= 0:
+            return []
+        sql, params = self._get_sql(limit, offset)
+        cursor = connections[self.parts[0][1].db].cursor()
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+        ids = {}
+        for row in rows:
+            ids.setdefault(row[0], []).append(row[1])
+        objects = {}
+        for typename, qs, fields in self.parts:
+            if not typename in ids:
+                continue
+            for obj in qs.filter(pk__in=ids[typename]):
+                objects[(typename, obj.pk)] = obj
+        return [objects[(row[0], row[1])] for row in rows
+                if (row[0], row[1]) in objects]
+
+    def __getitem__(self, k):
+        if not isinstance(k, slice):
+            result = self._fetch(1, k)
+            if not result:
+                raise IndexError
+            return result[0]
+        start = k.start or 0
+        if k.stop is None:
+            return list(self)[start:]
+        return self._fetch(k.stop - start, start)
+
+    def iterator(self):
+        """Iterate over all objects, part after part, without sorting.
+
+        Each part is read by chunks using its primary key (no
+        ``OFFSET``), so the cost of a chunk does not depend on its
+        position and only one chunk is kept in memory at a time.
+        """
+        for typename, qs, fields in self.parts:
+            qs = qs.order_by("pk")
+            last = None
+            while True:
+                chunk = qs if last is None else qs.filter(pk__gt=last)
+                chunk = list(chunk[:self.chunk_size])
+                for obj in chunk:
+                    yield obj
+                if len(chunk) < self.chunk_size:
+                    break
+                last = chunk[-1].pk
+
+    def __iter__(self):
+        offset = 0
+        while True:
+            objects = self._fetch(self.chunk_size, offset)
+            for obj in objects:
+                yield obj
+            if len(objects) < self.chunk_size:
+                break
+            offset += self.chunk_size
@@ -7,16 +7,24 @@
 This module provides a simple way of managing events between Modoboa
 core application and additional components.
 
+Event dispatching can be profiled (see :func:`enable_profiling`): for
+each event and each callback, the number of calls, the cumulative wall
+time and the number of SQL queries are recorded.
+
 """
 from functools import wraps
-import inspect
 import re
+import time
+import threading
 from django.conf import settings
 from modoboa.lib.sysutils import guess_extension_name
 
 events = []
 callbacks = {}
 
+_profile = None
+_profile_lock = threading.Lock()
+
 
 def declare(nevents):
     """Declare new events
@@ -55,10 +63,9 @@ class observe(object):
     check before each call if the extension is enabled or not. If
     that's not the case, the callback is not called.
 
-    .. note::
-
-        That's not a really optimized behaviour but I haven't found
-        another solution to achieve that feature.
+    Extension states are kept in memory by the extensions pool (see
+    ``ExtensionsPool.get_extension_state``) so this check doesn't
+    query the database.
 
     :param evtname: the event's name
     """
@@ -75,24 +82,21 @@ class observe(object):
         return None
 
     def __call__(self, f):
-        modname = inspect.getmodule(inspect.stack()[1][0]).__name__
+        modname = f.__module__
         extname = self.extname if hasattr(self, "extname") \
             else self.__guess_extension_name(modname)
 
         @wraps(f)
         def wrapped_f(*args, **kwargs):
             if extname:
-                from modoboa.core.models import Extension
                 from modoboa.core.extensions import exts_pool
-                try:
-                    ext = Extension.objects.get(name=extname)
-                except Extension.DoesNotExist:
+                state = exts_pool.get_extension_state(extname)
+                if state is None:
                     extdef = exts_pool.get_extension(extname)
                     if not extdef.always_active:
                         return []
-                else:
-                    if not ext.enabled:
-                        return None
+                elif not state:
+                    return None
             elif not modname in settings.MODOBOA_APPS:
                 return []
             return f(*args, **kwargs)
@@ -131,6 +135,100 @@ def unregister_extension(extension=None):
                 del callbacks[evt][name]
 
 
+def enable_profiling():
+    """Start recording statistics about events dispatching.
+    """
+    global _profile
+
+    if _profile is None:
+        _profile = {}
+
+
+def disable_profiling():
+    """Stop recording statistics and forget the collected ones.
+    """
+    global _profile
+
+    _profile = None
+
+
+def reset_profiling():
+    """Forget collected statistics.
+    """
+    with _profile_lock:
+        if _profile is not None:
+            _profile.clear()
+
+
+def get_profiling_data():
+    """Return collected statistics.
+
+    The result is a dictionnary indexed by event names. Each entry
+    contains the number of times the event was raised (``calls``),
+    the cumulative time spent in callbacks in seconds (``time``), the
+    number of SQL queries issued by callbacks (``queries``) and the
+    same information for each callback (``callbacks``).
+
+    :return: a dictionnary or None if profiling is disabled
+    """
+    if _profile is None:
+        return None
+    with _profile_lock:
+        result = {}
+        for event, stats in _profile.items():
+            result[event] = dict(stats)
+            result[event]["callbacks"] = dict(
+                (name, dict(cbstats))
+                for name, cbstats in stats["callbacks"].items()
+            )
+    return result
+
+
+def _profile_event(profile, event):
+    with _profile_lock:
+        if not event in profile:
+            profile[event] = {
+                "calls": 0, "time": 0.0, "queries": 0, "callbacks": {}
+            }
+        profile[event]["calls"] += 1
+
+
+def _profiled_call(profile, event, name, callback, args, kwargs):
+    """Call a callback and record statistics about it.
+
+    SQL queries are counted using the debug cursor of each database
+    connection. Recorded queries are dropped afterwards unless
+    ``DEBUG`` is enabled.
+    """
+    from django.db import connections
+
+    conns = [(conn, conn.use_debug_cursor, len(conn.queries))
+             for conn in connections.all()]
+    for conn, debug, count in conns:
+        conn.use_debug_cursor = True
+    start = time.time()
+    try:
+        return callback(*args, **kwargs)
+    finally:
+        duration = time.time() - start
+        nqueries = 0
+        for conn, debug, count in conns:
+            nqueries += len(conn.queries) - count
+            conn.use_debug_cursor = debug
+            if not debug and not settings.DEBUG:
+                del conn.queries[count:]
+        with _profile_lock:
+            evtstats = profile.get(event)
+            if evtstats is not None:
+                cbstats = evtstats["callbacks"].setdefault(
+                    name, {"calls": 0, "time": 0.0, "queries": 0}
+                )
+                for stats in [evtstats, cbstats]:
+                    stats["time"] += duration
+                    stats["queries"] += nqueries
+                cbstats["calls"] += 1
+
+
 def raiseEvent(event, *args, **kwargs):
     """Raise a specific event
 
@@ -141,8 +239,14 @@ def raiseEvent(event, *args, **kwargs):
     """
     if not event in events or not event in callbacks:
         return 0
-    for callback in callbacks[event].values():
-        callback(*args, **kwargs)
+    profile = _profile
+    if profile is not None:
+        _profile_event(profile, event)
+    for name, callback in callbacks[event].items():
+        if profile is None:
+            callback(*args, **kwargs)
+        else:
+            _profiled_call(profile, event, name, callback, args, kwargs)
     return 1
 
 
@@ -157,8 +261,14 @@ def raiseQueryEvent(event, *args, **kwargs):
     result = []
     if not event in events or not event in callbacks:
         return result
-    for callback in callbacks[event].values():
-        tmp = callback(*args, **kwargs)
+    profile = _profile
+    if profile is not None:
+        _profile_event(profile, event)
+    for name, callback in callbacks[event].items():
+        if profile is None:
+            tmp = callback(*args, **kwargs)
+        else:
+            tmp = _profiled_call(profile, event, name, callback, args, kwargs)
         if tmp is None:
             # Callback is registered but associated extension is
             # disabled.
@@ -179,8 +289,14 @@ def raiseDictEvent(event, *args):
     result = {}
     if not event in events or not event in callbacks:
         return result
-    for callback in callbacks[event].values():
-        tmp = callback(*args)
+    profile = _profile
+    if profile is not None:
+        _profile_event(profile, event)
+    for name, callback in callbacks[event].items():
+        if profile is None:
+            tmp = callback(*args)
+        else:
+            tmp = _profiled_call(profile, event, name, callback, args, {})
         if tmp is None:
             # Callback is registered but associated extension is
             # disabled.
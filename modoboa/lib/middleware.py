@@ -4,7 +4,6 @@ Custom middlewares.
 """
 import re
 from django.http import Http404, HttpResponseRedirect
-from modoboa.core.models import Extension
 from modoboa.core.extensions import exts_pool
 from modoboa.lib.webutils import (
     _render_error, ajax_response, render_to_json_response
@@ -18,14 +17,7 @@ class ExtControlMiddleware(object):
         m = re.match("modoboa\.extensions\.(\w+)", view.__module__)
         if m is None:
             return None
-        try:
-            ext = Extension.objects.get(name=m.group(1))
-        except Extension.DoesNotExist:
-            extdef = exts_pool.get_extension(m.group(1))
-            if extdef.always_active:
-                return None
-            raise Http404
-        if ext.enabled:
+        if exts_pool.is_extension_active(m.group(1)):
             return None
         raise Http404
 
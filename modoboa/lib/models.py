@@ -1,5 +1,7 @@
 import reversion
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.conf import settings
 
 
@@ -25,3 +27,19 @@ class UserParameter(models.Model):
     @property
     def shortname(self):
         return self.name.split(".")[1].lower()
+
+
+@receiver([post_save, post_delete], sender=Parameter)
+def parameter_changed(sender, instance, **kwargs):
+    """Remove outdated values from the parameters cache."""
+    from modoboa.lib.parameters import get_cache
+
+    get_cache().invalidate('A', instance.name)
+
+
+@receiver([post_save, post_delete], sender=UserParameter)
+def user_parameter_changed(sender, instance, **kwargs):
+    """Remove outdated values from the parameters cache."""
+    from modoboa.lib.parameters import get_cache
+
+    get_cache().invalidate('U', instance.name, instance.user_id)
@@ -7,13 +7,22 @@ Core components or extensions can register their own parameters, which
 will be available and modifiable directly from the web interface.
 
 Only super users will be able to access this part of the web interface.
+
+Values read from the database are kept into a process-wide cache (see
+:func:`get_cache`) to avoid running one query per parameter access.
 """
+import time
+import threading
+from collections import OrderedDict
 from django import forms
+from django.conf import settings
 from modoboa.lib import events
 from modoboa.lib.sysutils import guess_extension_name
 from modoboa.lib.exceptions import ModoboaException
 
 _params = {'A': {}, 'U': {}}
+_cache = None
+_missing = object()
 
 
 class NotDefined(ModoboaException):
@@ -104,6 +113,7 @@ class AdminParametersForm(GenericParametersForm):
                 p = Parameter()
                 p.name = fullname
             self._save_parameter(p, name, value)
+            get_cache().invalidate('A', fullname)
 
     def to_django_settings(self):
         pass
@@ -151,6 +161,174 @@ class UserParametersForm(GenericParametersForm):
                 p.user = self.user
                 p.name = fullname
             self._save_parameter(p, name, value)
+            get_cache().invalidate('U', fullname, self.user.pk)
+
+
+class NullParametersCache(object):
+    """Cache implementation used when caching is disabled."""
+
+    def get(self, level, fullname, user_id=None):
+        return _missing
+
+    def set(self, level, fullname, value, user_id=None):
+        pass
+
+    def invalidate(self, level, fullname, user_id=None):
+        pass
+
+    def clear(self):
+        pass
+
+
+class LocalParametersCache(object):
+    """In-process parameters cache.
+
+    Administrative parameters are stored into a simple dictionnary
+    whereas user parameters are grouped by user. The number of users
+    kept in memory is bounded: the least recently used entry is
+    evicted when the limit is reached.
+
+    Cached values are the raw values stored into the database (or
+    ``None`` if no record exists).
+
+    :param int maxusers: maximum number of users to keep in memory
+    :param int timeout: entries lifetime in seconds (0 means forever)
+    """
+
+    def __init__(self, maxusers=1000, timeout=300):
+        self.maxusers = maxusers
+        self.timeout = timeout
+        self._admin = {}
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __expired(self, entry):
+        return self.timeout and entry[1] < time.time()
+
+    def get(self, level, fullname, user_id=None):
+        with self._lock:
+            if level == 'A':
+                entries = self._admin
+            else:
+                entries = self._users.pop(user_id, None)
+                if entries is None:
+                    return _missing
+                self._users[user_id] = entries
+            entry = entries.get(fullname)
+            if entry is None or self.__expired(entry):
+                return _missing
+            return entry[0]
+
+    def set(self, level, fullname, value, user_id=None):
+        entry = (value, time.time() + self.timeout)
+        with self._lock:
+            if level == 'A':
+                self._admin[fullname] = entry
+                return
+            entries = self._users.pop(user_id, None)
+            if entries is None:
+                entries = {}
+                if len(self._users) >= self.maxusers:
+                    self._users.popitem(last=False)
+            entries[fullname] = entry
+            self._users[user_id] = entries
+
+    def invalidate(self, level, fullname, user_id=None):
+        with self._lock:
+            if level == 'A':
+                entries = self._admin
+            else:
+                entries = self._users.get(user_id, {})
+            entries.pop(fullname, None)
+
+    def clear(self):
+        with self._lock:
+            self._admin = {}
+            self._users = OrderedDict()
+
+
+class SharedParametersCache(object):
+    """Parameters cache based on a Django cache backend.
+
+    Useful when several processes serve Modoboa: a modification made
+    by one process is immediately visible to the others.
+
+    :param str alias: the name of a cache declared in ``CACHES``
+    :param int timeout: entries lifetime in seconds
+    """
+    prefix = "modoboa.parameters"
+
+    def __init__(self, alias, timeout=300):
+        from django.core.cache import get_cache
+
+        self.backend = get_cache(alias)
+        self.timeout = timeout
+
+    def __key(self, level, fullname, user_id):
+        if level == 'A':
+            return "%s.A.%s" % (self.prefix, fullname)
+        return "%s.U.%s.%s" % (self.prefix, user_id, fullname)
+
+    def get(self, level, fullname, user_id=None):
+        entry = self.backend.get(self.__key(level, fullname, user_id))
+        if entry is None:
+            return _missing
+        return entry[0]
+
+    def set(self, level, fullname, value, user_id=None):
+        self.backend.set(
+            self.__key(level, fullname, user_id), (value,), self.timeout
+        )
+
+    def invalidate(self, level, fullname, user_id=None):
+        self.backend.delete(self.__key(level, fullname, user_id))
+
+    def clear(self):
+        pass
+
+
+def get_cache():
+    """Return the parameters cache in use.
+
+    The cache is built on first access, according to the following
+    settings:
+
+    * ``MODOBOA_PARAMETERS_CACHE``: ``"local"`` (default) for an
+      in-process cache, the name of a cache declared in ``CACHES`` to
+      share values between processes or ``None`` to disable caching
+    * ``MODOBOA_PARAMETERS_CACHE_MAXUSERS``: maximum number of users
+      kept by the local cache (default: 1000)
+    * ``MODOBOA_PARAMETERS_CACHE_TIMEOUT``: entries lifetime in
+      seconds (default: 300)
+    """
+    global _cache
+
+    if _cache is None:
+        backend = getattr(settings, "MODOBOA_PARAMETERS_CACHE", "local")
+        timeout = getattr(settings, "MODOBOA_PARAMETERS_CACHE_TIMEOUT", 300)
+        if backend is None:
+            _cache = NullParametersCache()
+        elif backend == "local":
+            _cache = LocalParametersCache(
+                getattr(settings, "MODOBOA_PARAMETERS_CACHE_MAXUSERS", 1000),
+                timeout
+            )
+        else:
+            _cache = SharedParametersCache(backend, timeout)
+    return _cache
+
+
+def reset_cache():
+    """Empty the parameters cache.
+
+    The cache will be built again (using current settings) on next
+    access.
+    """
+    global _cache
+
+    if _cache is not None:
+        _cache.clear()
+    _cache = None
 
 
 def register(formclass, label):
@@ -255,11 +433,17 @@ def get_admin(name, app=None, raise_error=True):
         if raise_error:
             raise
         return None
-    try:
-        p = Parameter.objects.get(name="%s.%s" % (app, name))
-    except Parameter.DoesNotExist:
+    fullname = "%s.%s" % (app, name)
+    value = get_cache().get('A', fullname)
+    if value is _missing:
+        try:
+            value = Parameter.objects.get(name=fullname).value
+        except Parameter.DoesNotExist:
+            value = None
+        get_cache().set('A', fullname, value)
+    if value is None:
         return _params["A"][app]["defaults"][name]
-    return p.value.decode("unicode_escape").replace('\\r\\n', '\n')
+    return value.decode("unicode_escape").replace('\\r\\n', '\n')
 
 
 def get_user(user, name, app=None, raise_error=True):
@@ -282,11 +466,17 @@ def get_user(user, name, app=None, raise_error=True):
         if raise_error:
             raise
         return None
-    try:
-        p = UserParameter.objects.get(user=user, name="%s.%s" % (app, name))
-    except UserParameter.DoesNotExist:
+    fullname = "%s.%s" % (app, name)
+    value = get_cache().get('U', fullname, user.pk)
+    if value is _missing:
+        try:
+            value = UserParameter.objects.get(user=user, name=fullname).value
+        except UserParameter.DoesNotExist:
+            value = None
+        get_cache().set('U', fullname, value, user.pk)
+    if value is None:
         return _params["U"][app]["defaults"][name]
-    return p.value.decode("unicode_escape")
+    return value.decode("unicode_escape")
 
 
 def get_sorted_apps(level, first="core"):
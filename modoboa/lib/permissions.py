@@ -1,7 +1,10 @@
 # coding: utf-8
+from django.contrib.auth.models import Permission
 from django.contrib.contenttypes.models import ContentType
 from django.utils.translation import ugettext as _
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.db.models.query import QuerySet
 from modoboa.core.models import ObjectAccess, User
 from modoboa.lib import events
 from modoboa.lib.exceptions import ModoboaException
@@ -30,6 +33,95 @@ def get_account_roles(user, account=None):
     return sorted(std_roles, key=lambda role: role[1])
 
 
+def get_administrators():
+    """Return the accounts allowed to administrate domains.
+
+    Same test as ``User.has_perm("admin.add_domain")``, using a single
+    query.
+
+    :return: a ``QuerySet`` of ``User`` objects
+    """
+    perm = Q(codename="add_domain", content_type__app_label="admin")
+    return User.objects.filter(is_active=True).filter(
+        Q(is_superuser=True) |
+        Q(groups__permissions__in=Permission.objects.filter(perm)) |
+        Q(user_permissions__in=Permission.objects.filter(perm))
+    ).distinct()
+
+
+def _chunks(ids, size=500):
+    ids = sorted(set(ids))
+    for pos in range(0, len(ids), size):
+        yield ids[pos:pos + size]
+
+
+def _get_ct_and_ids(objects, ct=None):
+    """Return the content type and the identifiers of a collection.
+
+    :param objects: a ``QuerySet`` or a list of objects
+    :param ct: the content type (guessed if None)
+    """
+    if isinstance(objects, QuerySet):
+        if ct is None:
+            ct = ContentType.objects.get_for_model(objects.model)
+        return ct, list(objects.values_list("pk", flat=True))
+    objects = list(objects)
+    if objects and ct is None:
+        ct = ContentType.objects.get_for_model(objects[0])
+    return ct, [obj.pk for obj in objects]
+
+
+def _grant(user_ids, ct, ids, is_owner=False):
+    """Create the missing access entries for the given users/objects.
+
+    Existing entries are kept (and marked as owned if ``is_owner`` is
+    True). A few queries are issued per chunk of objects, whatever the
+    number of users and objects.
+    """
+    for chunk in _chunks(ids):
+        existing = set(ObjectAccess.objects.filter(
+            user__in=user_ids, content_type=ct, object_id__in=chunk
+        ).values_list("user", "object_id"))
+        if is_owner and existing:
+            ObjectAccess.objects.filter(
+                user__in=user_ids, content_type=ct, object_id__in=chunk,
+                is_owner=False
+            ).update(is_owner=True)
+        entries = [
+            ObjectAccess(user_id=uid, content_type=ct, object_id=oid,
+                         is_owner=is_owner)
+            for uid in user_ids for oid in chunk
+            if not (uid, oid) in existing
+        ]
+        sid = transaction.savepoint()
+        try:
+            ObjectAccess.objects.bulk_create(entries)
+        except IntegrityError:
+            # Entries created concurrently. The failed statement must
+            # be rolled back first, otherwise the transaction remains
+            # aborted (PostgreSQL).
+            transaction.savepoint_rollback(sid)
+            for entry in entries:
+                ObjectAccess.objects.get_or_create(
+                    user_id=entry.user_id, content_type=ct,
+                    object_id=entry.object_id,
+                    defaults={"is_owner": is_owner}
+                )
+        else:
+            transaction.savepoint_commit(sid)
+    ObjectAccess.entries_changed()
+
+
+def _grant_to_superusers(ct, ids, exclude=None):
+    superusers = User.objects.filter(is_superuser=True)
+    if exclude is not None:
+        superusers = superusers.exclude(pk=exclude.pk)
+    user_ids = list(superusers.values_list("pk", flat=True))
+    if user_ids:
+        _grant(user_ids, ct, ids)
+    ObjectAccess.entries_changed()
+
+
 def grant_access_to_object(user, obj, is_owner=False):
     """Grant access to an object for a given user
 
@@ -47,44 +139,70 @@ def grant_access_to_object(user, obj, is_owner=False):
     :param is_owner: the user is the unique object's owner
     """
     ct = ContentType.objects.get_for_model(obj)
-    try:
-        entry = user.objectaccess_set.get(content_type=ct, object_id=obj.id)
-        entry.is_owner = is_owner
-        entry.save()
-    except ObjectAccess.DoesNotExist:
-        pass
-    else:
+    if user.objectaccess_set.filter(content_type=ct, object_id=obj.id) \
+            .update(is_owner=is_owner):
+        ObjectAccess.entries_changed()
         return
-
     ObjectAccess.objects.create(
         user=user, content_type=ct, object_id=obj.id, is_owner=is_owner
     )
-    if not is_owner:
+    ObjectAccess.entries_changed()
+    if is_owner:
+        _grant_to_superusers(ct, [obj.id], exclude=user)
+
+
+def grant_access_to_new_objects(user, objects, is_owner=False):
+    """Grant access to objects that have just been created
+
+    Bulk version of ``grant_access_to_object``: since the objects are
+    new, no access entry can exist yet so all entries are created
+    using a single query.
+
+    All objects in the collection must share the same type.
+
+    :param user: a ``User`` object
+    :param objects: a list of objects
+    :param is_owner: the user is the unique objects' owner
+    """
+    if not objects:
         return
-    from modoboa.core.models import User
-    for su in User.objects.filter(is_superuser=True):
-        if su == user:
-            continue
-        ObjectAccess.objects.get_or_create(
-            user=su, content_type=ct, object_id=obj.id
-        )
+    ct = ContentType.objects.get_for_model(objects[0])
+    entries = [
+        ObjectAccess(user=user, content_type=ct, object_id=obj.id,
+                     is_owner=is_owner)
+        for obj in objects
+    ]
+    if is_owner:
+        for su in User.objects.filter(is_superuser=True).exclude(pk=user.pk):
+            entries += [
+                ObjectAccess(user=su, content_type=ct, object_id=obj.id)
+                for obj in objects
+            ]
+    ObjectAccess.objects.bulk_create(entries)
+    ObjectAccess.entries_changed()
 
 
-def grant_access_to_objects(user, objects, ct):
+def grant_access_to_objects(user, objects, ct=None, is_owner=False):
     """Grant access to a collection of objects
 
     All objects in the collection must share the same type (ie. ``ct``
-    applies to all objects).
+    applies to all objects). Missing entries are created using bulk
+    queries, existing ones are kept.
+
+    If the user is the owner, we also grant access to these objects to
+    all super users.
 
     :param user: a ``User`` object
-    :param objects: a list of objects
-    :param ct: the content type
+    :param objects: a ``QuerySet`` or a list of objects
+    :param ct: the content type (guessed if None)
+    :param is_owner: the user is the unique objects' owner
     """
-    for obj in objects:
-        try:
-            ObjectAccess.objects.create(user=user, content_type=ct, object_id=obj.id)
-        except IntegrityError:
-            pass
+    ct, ids = _get_ct_and_ids(objects, ct)
+    if not ids:
+        return
+    _grant([user.pk], ct, ids, is_owner)
+    if is_owner:
+        _grant_to_superusers(ct, ids, exclude=user)
 
 
 def ungrant_access_to_object(obj, user=None):
@@ -99,36 +217,40 @@ def ungrant_access_to_object(obj, user=None):
     :param obj: an object inheriting from ``models.Model``
     :param user: a ``User`` object
     """
-    ct = ContentType.objects.get_for_model(obj)
-    if user is not None:
-        try:
-            ObjectAccess.objects.get(
-                user=user, content_type=ct, object_id=obj.id
-            ).delete()
-        except ObjectAccess.DoesNotExist:
-            pass
-        try:
-            ObjectAccess.objects.get(
-                content_type=ct, object_id=obj.id, is_owner=True
-            )
-        except ObjectAccess.DoesNotExist:
-            grant_access_to_object(
-                User.objects.filter(is_superuser=True)[0], obj, True
-            )
-    else:
-        ObjectAccess.objects.filter(
-            content_type=ct, object_id=obj.id
-        ).delete()
-
-
-def ungrant_access_to_objects(objects):
-    """Cancel all accesses for a given objects list
-
-    :param objects: a list of objects inheriting from ``model.Model``
+    ungrant_access_to_objects([obj], user)
+
+
+def ungrant_access_to_objects(objects, user=None):
+    """Cancel accesses for a given objects list
+
+    All objects in the collection must share the same type. Entries
+    are removed using one ``DELETE`` query per chunk of objects.
+
+    If a user is provided, we only remove his accesses. Objects left
+    without owner are given to the first super admin we find.
+
+    :param objects: a ``QuerySet`` or a list of objects inheriting
+                    from ``model.Model``
+    :param user: a ``User`` object
     """
-    for obj in objects:
-        ct = ContentType.objects.get_for_model(obj)
-        ObjectAccess.objects.filter(content_type=ct, object_id=obj.id).delete()
+    ct, ids = _get_ct_and_ids(objects)
+    for chunk in _chunks(ids):
+        entries = ObjectAccess.objects.filter(
+            content_type=ct, object_id__in=chunk
+        )
+        if user is None:
+            entries.delete()
+            continue
+        entries.filter(user=user).delete()
+        owned = set(entries.filter(is_owner=True)
+                    .values_list("object_id", flat=True))
+        orphans = [oid for oid in chunk if not oid in owned]
+        if not orphans:
+            continue
+        su = User.objects.filter(is_superuser=True)[0]
+        _grant([su.pk], ct, orphans, is_owner=True)
+        _grant_to_superusers(ct, orphans, exclude=su)
+    ObjectAccess.entries_changed()
 
 
 def get_object_owner(obj):
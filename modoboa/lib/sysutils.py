@@ -4,10 +4,12 @@
 This module extra functions/shortcuts to communicate with the system
 (executing commands, etc.)
 """
+import sys
 import subprocess
-import inspect
 import re
 
+_extnames = {}
+
 
 def exec_cmd(cmd, sudo_user=None, **kwargs):
     """Execute a shell command.
@@ -29,12 +31,20 @@ def exec_cmd(cmd, sudo_user=None, **kwargs):
 
 
 def guess_extension_name():
-    """Tries to guess the application's name by inspecting the stack.
+    """Tries to guess the application's name by looking at the caller.
+
+    The name is deduced from the module the caller of our caller
+    belongs to. Only this frame is accessed (the stack is not
+    walked) and results are cached by module name.
 
     :return: a string or None
     """
-    modname = inspect.getmodule(inspect.stack()[2][0]).__name__
+    modname = sys._getframe(2).f_globals.get("__name__", "")
+    try:
+        return _extnames[modname]
+    except KeyError:
+        pass
     match = re.match(r"(?:modoboa\.)?(?:extensions\.)?([^\.$]+)", modname)
-    if match is not None:
-        return match.group(1)
-    return None
+    extname = match.group(1) if match is not None else None
+    _extnames[modname] = extname
+    return extname
@@ -2,14 +2,42 @@
 import json
 from django.test import TestCase
 from django.test.client import Client
+from django.test.utils import override_settings
 from django import forms
+from django.db import connection, reset_queries
+from django.core.signals import request_started
 from django.core.urlresolvers import reverse
 from modoboa.lib import parameters
 
 
+class QueriesCounter(object):
+    """Context manager counting the SQL queries executed in a block.
+
+    Once the block is exited, the result is available through the
+    ``count`` attribute.
+    """
+
+    def __enter__(self):
+        self.old_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        self.start = len(connection.queries)
+        # Requests made with the test client must not reset the log
+        request_started.disconnect(reset_queries)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        request_started.connect(reset_queries)
+        self.count = len(connection.queries) - self.start
+        connection.use_debug_cursor = self.old_debug_cursor
+
+
 class ModoTestCase(TestCase):
 
     def setUp(self, username="admin", password="password"):
+        from modoboa.core.extensions import exts_pool
+
+        parameters.reset_cache()
+        exts_pool.invalidate_states()
         self.clt = Client()
         self.assertEqual(self.clt.login(username=username, password=password), True)
 
@@ -69,6 +97,7 @@ class ParameterTestCase(TestCase):
 
     def setUp(self):
         from modoboa.core.models import User
+        parameters.reset_cache()
         parameters.register(TestParams, "Test")
         parameters.register(TestUserParams, "TestUser")
         self.user = User.objects.create(username="tester")
@@ -104,3 +133,273 @@ class ParameterTestCase(TestCase):
     def test_save_user(self):
         parameters.save_user(self.user, "PARAM1", "pouet", "test")
         self.assertEqual(parameters.get_user(self.user, "PARAM1", "test"), "pouet")
+
+
+class ParametersCacheTestCase(TestCase):
+    """Test cases for the parameters cache.
+    """
+
+    def setUp(self):
+        from modoboa.core.models import User
+        parameters.reset_cache()
+        parameters.register(TestParams, "Test")
+        parameters.register(TestUserParams, "TestUser")
+        self.user = User.objects.create(username="tester")
+
+    def tearDown(self):
+        parameters.reset_cache()
+
+    def test_get_admin_cached(self):
+        parameters.get_admin("PARAM1", app="test")
+        with self.assertNumQueries(0):
+            self.assertEqual(parameters.get_admin("PARAM1", app="test"), "toto")
+
+    def test_get_user_cached(self):
+        parameters.get_user(self.user, "PARAM1", app="test")
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                parameters.get_user(self.user, "PARAM1", app="test"), "titi"
+            )
+
+    def test_invalidation(self):
+        from modoboa.lib.models import Parameter, UserParameter
+
+        parameters.get_admin("PARAM1", app="test")
+        parameters.save_admin("PARAM1", "45", app="test")
+        self.assertEqual(parameters.get_admin("PARAM1", app="test"), "45")
+        Parameter.objects.filter(name="test.PARAM1").get().delete()
+        self.assertEqual(parameters.get_admin("PARAM1", app="test"), "toto")
+
+        parameters.get_user(self.user, "PARAM1", app="test")
+        parameters.save_user(self.user, "PARAM1", "pouet", app="test")
+        self.assertEqual(
+            parameters.get_user(self.user, "PARAM1", app="test"), "pouet"
+        )
+        UserParameter.objects.get(user=self.user, name="test.PARAM1").delete()
+        self.assertEqual(
+            parameters.get_user(self.user, "PARAM1", app="test"), "titi"
+        )
+
+    def test_form_save(self):
+        class CacheTestParams(parameters.AdminParametersForm):
+            app = "cachetest"
+
+            param1 = forms.CharField(label="Test", initial="toto")
+
+        parameters.register(CacheTestParams, "CacheTest")
+        parameters.get_admin("PARAM1", app="cachetest")
+        form = CacheTestParams({"cachetest-param1": "tutu"})
+        self.assertTrue(form.is_valid())
+        form.save()
+        self.assertEqual(
+            parameters.get_admin("PARAM1", app="cachetest"), "tutu"
+        )
+        parameters.unregister("cachetest")
+
+    def test_lru_eviction(self):
+        cache = parameters.LocalParametersCache(maxusers=2)
+        cache.set('U', 'test.PARAM1', 'v1', 1)
+        cache.set('U', 'test.PARAM1', 'v2', 2)
+        cache.get('U', 'test.PARAM1', 1)
+        cache.set('U', 'test.PARAM1', 'v3', 3)
+        self.assertEqual(cache.get('U', 'test.PARAM1', 1), 'v1')
+        self.assertIs(cache.get('U', 'test.PARAM1', 2), parameters._missing)
+        self.assertEqual(cache.get('U', 'test.PARAM1', 3), 'v3')
+
+    def test_timeout(self):
+        cache = parameters.LocalParametersCache(timeout=-1)
+        cache.set('A', 'test.PARAM1', 'value')
+        self.assertIs(cache.get('A', 'test.PARAM1'), parameters._missing)
+
+    @override_settings(
+        MODOBOA_PARAMETERS_CACHE="default",
+        CACHES={"default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache"
+        }}
+    )
+    def test_shared_backend(self):
+        parameters.reset_cache()
+        self.assertIsInstance(
+            parameters.get_cache(), parameters.SharedParametersCache
+        )
+        parameters.get_admin("PARAM1", app="test")
+        with self.assertNumQueries(0):
+            self.assertEqual(parameters.get_admin("PARAM1", app="test"), "toto")
+        parameters.save_admin("PARAM1", "45", app="test")
+        self.assertEqual(parameters.get_admin("PARAM1", app="test"), "45")
+
+
+class ParametersCacheBenchmark(ModoTestCase):
+    """Count the queries issued by a few views with and without cache.
+    """
+    fixtures = ["initial_users.json"]
+
+    def tearDown(self):
+        parameters.reset_cache()
+
+    def _count_queries(self, url):
+        self.clt.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        with QueriesCounter() as counter:
+            response = self.clt.get(
+                url, HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+            )
+        self.assertEqual(response.status_code, 200)
+        return counter.count
+
+    def test_views(self):
+        from modoboa.extensions.admin import factories
+
+        factories.populate_database()
+        urls = [
+            reverse("modoboa.extensions.admin.views.domain._domains"),
+            reverse("modoboa.extensions.admin.views.identity._identities"),
+        ]
+        for url in urls:
+            with self.settings(MODOBOA_PARAMETERS_CACHE=None):
+                parameters.reset_cache()
+                before = self._count_queries(url)
+            parameters.reset_cache()
+            after = self._count_queries(url)
+            self.assertLess(after, before, "%s: %d -> %d queries" % (
+                url, before, after
+            ))
+
+
+class GuessExtensionNameTestCase(TestCase):
+    """Test cases for ``modoboa.lib.sysutils.guess_extension_name``.
+    """
+
+    def test_guess(self):
+        from modoboa.lib.sysutils import guess_extension_name
+
+        def caller():
+            return guess_extension_name()
+
+        self.assertEqual(caller(), "lib")
+
+    def test_guess_from_extension(self):
+        from modoboa.lib import sysutils
+
+        def helper():
+            return sysutils.guess_extension_name()
+
+        # Simulate a function defined inside an extension package
+        modname = "modoboa.extensions.postfix_autoreply.models"
+        namespace = {"__name__": modname}
+        exec "def extfunc(helper):\n    return helper()\n" in namespace
+        sysutils._extnames.pop(modname, None)
+
+        self.assertEqual(namespace["extfunc"](helper), "postfix_autoreply")
+        self.assertEqual(sysutils._extnames[modname], "postfix_autoreply")
+        sysutils._extnames[modname] = "cached"
+        self.assertEqual(namespace["extfunc"](helper), "cached")
+        del sysutils._extnames[modname]
+
+    def test_extension(self):
+        from modoboa.extensions.admin import AdminConsole
+
+        AdminConsole().load()
+        self.assertIn("admin", parameters._params['A'])
+        AdminConsole().destroy()
+        self.assertNotIn("admin", parameters._params['A'])
+        AdminConsole().load()
+        self.assertIn("admin", parameters._params['A'])
+
+
+def profiled_callback(user):
+    from modoboa.core.models import User
+    return [User.objects.count()]
+
+
+class EventsProfilingTestCase(ModoTestCase):
+    """Test cases for events dispatching statistics.
+    """
+    fixtures = ["initial_users.json"]
+
+    def setUp(self):
+        from modoboa.lib import events
+
+        super(EventsProfilingTestCase, self).setUp()
+        events.declare(["ProfiledEvent"])
+        events.register("ProfiledEvent", profiled_callback)
+
+    def tearDown(self):
+        from modoboa.lib import events
+
+        events.unregister("ProfiledEvent", profiled_callback)
+        events.disable_profiling()
+
+    def test_disabled(self):
+        from modoboa.lib import events
+
+        self.assertEqual(events.raiseQueryEvent("ProfiledEvent", None), [1])
+        self.assertIsNone(events.get_profiling_data())
+
+    def test_statistics(self):
+        from modoboa.lib import events
+
+        events.enable_profiling()
+        events.raiseQueryEvent("ProfiledEvent", None)
+        events.raiseEvent("ProfiledEvent", None)
+        data = events.get_profiling_data()["ProfiledEvent"]
+        self.assertEqual(data["calls"], 2)
+        self.assertEqual(data["queries"], 2)
+        cbstats = data["callbacks"]["modoboa.lib.tests.profiled_callback"]
+        self.assertEqual(cbstats["calls"], 2)
+        self.assertEqual(cbstats["queries"], 2)
+        self.assertGreater(cbstats["time"], 0)
+
+    def test_endpoint(self):
+        from modoboa.lib import events
+
+        url = reverse("modoboa.core.views.admin.events_profile")
+        response = self.ajax_get(url, {})
+        self.assertFalse(response["enabled"])
+        events.enable_profiling()
+        events.raiseEvent("ProfiledEvent", None)
+        response = self.ajax_get(url, {"reset": "1"})
+        self.assertTrue(response["enabled"])
+        self.assertEqual(response["events"]["ProfiledEvent"]["calls"], 1)
+        response = self.ajax_get(url, {})
+        self.assertNotIn("ProfiledEvent", response["events"])
+
+
+class PermissionsTestCase(ModoTestCase):
+    """Test cases for ``modoboa.lib.permissions``.
+    """
+    fixtures = ["initial_users.json"]
+
+    def test_concurrent_grant(self):
+        """Check that entries created concurrently are handled
+        """
+        from django.contrib.contenttypes.models import ContentType
+        from modoboa.core.factories import UserFactory
+        from modoboa.core.models import ObjectAccess, User
+        from modoboa.lib.permissions import grant_access_to_objects
+
+        admin = User.objects.get(username="admin")
+        accounts = [UserFactory(username="user%d@test.com" % cpt)
+                    for cpt in range(3)]
+        ct = ContentType.objects.get_for_model(User)
+        manager = ObjectAccess.objects
+        bulk_create = manager.bulk_create
+
+        def concurrent_bulk_create(entries):
+            # Another process creates one of the entries meanwhile
+            ObjectAccess.objects.create(
+                user=admin, content_type=ct, object_id=accounts[1].pk
+            )
+            return bulk_create(entries)
+
+        manager.bulk_create = concurrent_bulk_create
+        try:
+            grant_access_to_objects(admin, accounts)
+        finally:
+            del manager.bulk_create
+        # The transaction can still be used
+        self.assertEqual(
+            ObjectAccess.objects.filter(
+                user=admin, content_type=ct,
+                object_id__in=[account.pk for account in accounts]
+            ).count(), 3
+        )
@@ -0,0 +1,45 @@
+# coding: utf-8
+"""
+Micro-benchmark for ``modoboa.lib.sysutils.guess_extension_name``.
+
+Compare the per-call cost of the current implementation with the
+previous one (based on ``inspect.stack``)::
+
+  $ python tests/bench_guess_extension_name.py
+"""
+import inspect
+import re
+import timeit
+
+from modoboa.lib.sysutils import guess_extension_name
+
+
+def legacy_guess_extension_name():
+    modname = inspect.getmodule(inspect.stack()[2][0]).__name__
+    match = re.match(r"(?:modoboa\.)?(?:extensions\.)?([^\.$]+)", modname)
+    if match is not None:
+        return match.group(1)
+    return None
+
+
+def get_admin(func):
+    """Simulate a call made from ``parameters.get_admin``."""
+    return func()
+
+
+def nested_call(func, depth=20):
+    """Simulate a realistic stack depth (middlewares, views, etc.)."""
+    if depth:
+        return nested_call(func, depth - 1)
+    return get_admin(func)
+
+
+if __name__ == "__main__":
+    number = 2000
+    assert nested_call(guess_extension_name) == \
+        nested_call(legacy_guess_extension_name)
+    for func in [legacy_guess_extension_name, guess_extension_name]:
+        duration = timeit.timeit(lambda: nested_call(func), number=number)
+        print "%s: %.2f us per call" % (
+            func.__name__, duration / number * 1000000
+        )